@@ -1,7 +1,9 @@
 from cStringIO import StringIO
 from datetime import datetime
-from functools import partial
+from functools import wraps
+from hashlib import sha1
 from itertools import chain, imap, izip
+import json
 from logging import StreamHandler
 import os
 from os import chdir
@@ -13,22 +15,26 @@ from urllib import quote_plus
 
 from flask import (Blueprint, Flask, send_from_directory, current_app,
                    send_file, request, redirect, jsonify, render_template,
-                   url_for)
+                   url_for, Response, stream_with_context, make_response)
 from funcy import merge, imap
+from pkg_resources import get_distribution, DistributionNotFound
 from pyelasticsearch import ElasticSearch
 from werkzeug.exceptions import NotFound
 
-from dxr.config import Config
-from dxr.es import (filtered_query, frozen_config, frozen_configs,
-                    es_alias_or_not_found)
+from dxr.config import Config, FORMAT
+from dxr.es import (filtered_query, filtered_query_body, frozen_config,
+                    frozen_configs, es_alias_or_not_found, multi_search,
+                    CatalogCache, SearchCache)
 from dxr.exceptions import BadTerm
 from dxr.filters import FILE, LINE
-from dxr.lines import html_line, tags_per_line, finished_tags, Ref, Region
+from dxr.lines import (html_line, tags_per_line, finished_tags, Ref, Region,
+                       unpack_rendered_lines)
 from dxr.mime import icon, is_image, is_text
 from dxr.plugins import plugins_named
 from dxr.query import Query, filter_menu_items
 from dxr.utils import (non_negative_int, decode_es_datetime, DXR_BLUEPRINT,
-                       format_number, append_update, append_by_line, cumulative_sum)
+                       format_number, append_update, append_by_line, cumulative_sum,
+                       if_raises)
 from dxr.vcs import file_contents_at_rev
 
 # Look in the 'dxr' package for static files, etc.:
@@ -41,6 +47,19 @@ dxr_blueprint = Blueprint(DXR_BLUEPRINT,
                           # url_for('static', ...).
                           static_folder='static')
 
+# The fields of LINE docs that showing a file needs:
+LINE_FIELDS = ['content', 'refs', 'regions', 'annotations']
+
+# How many bits of template output to gather up before sending them out, when
+# streaming a page:
+STREAM_BUFFER_SIZE = 100
+
+# The version of DXR serving pages, so an upgrade, which may bring new
+# templates, invalidates pages browsers have cached:
+VERSION = getattr(if_raises(DistributionNotFound, get_distribution, None, 'dxr'),
+                  'version',
+                  '')
+
 
 def make_app(config):
     """Return a DXR application which uses ``config`` as its configuration.
@@ -58,9 +77,63 @@ def make_app(config):
     # Make an ES connection pool shared among all threads:
     app.es = ElasticSearch(config.es_hosts)
 
+    # And keep the tree catalog handy, since nearly every page consults it:
+    app.catalog = CatalogCache(config.catalog_cache_ttl)
+    app.search_cache = SearchCache(config.search_cache_size)
+
     return app
 
 
+def _revalidated(view):
+    """Decorate a view of a tree so browsers and proxies can cache what it
+    returns until the tree's next build is deployed.
+
+    Responses get an ETag naming that build and the configured Cache-Control
+    header. A request which already holds the current tag gets a 304 without
+    the view ever running, so it costs us no ES queries beyond the cached
+    catalog.
+
+    """
+    @wraps(view)
+    def revalidated_view(tree, *args, **kwargs):
+        etag = _etag(tree)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(view(tree, *args, **kwargs))
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = \
+                current_app.dxr_config.cache_control
+            # Searches answer with HTML or JSON depending on Accept:
+            response.vary.add('Accept')
+        return response
+    return revalidated_view
+
+
+def _etag(tree):
+    """Return an ETag for the current request, good as long as the same build
+    of ``tree`` is deployed.
+
+    Indices never change once deployed, so the concrete index behind the
+    tree's alias stands in for the contents. The Switch Tree menu on each
+    page lists all the trees, so they go in as well. So do the DXR version
+    and the config, which shape the rest of the page.
+
+    """
+    frozen = frozen_config(tree)
+    return sha1(json.dumps([
+        FORMAT,
+        VERSION,
+        current_app.dxr_config.digest,
+        # Catalogs written before es_index was recorded have to make do with
+        # the build time:
+        frozen.get('es_index') or frozen['generated_date'],
+        [(t['name'], t['description']) for t in frozen_configs()],
+        request.full_path,
+        _request_wants_json()])).hexdigest()
+
+
 @dxr_blueprint.route('/')
 def index():
     return redirect(url_for('.browse',
@@ -68,6 +141,7 @@ def index():
 
 
 @dxr_blueprint.route('/<tree>/search')
+@_revalidated
 def search(tree):
     """Normalize params, and dispatch between JSON- and HTML-returning
     searches, based on Accept header.
@@ -83,11 +157,13 @@ def search(tree):
     is_case_sensitive = req.get('case') == 'true'
 
     # Make a Query:
-    query = Query(partial(current_app.es.search,
-                          index=frozen['es_alias']),
+    search_cache = current_app.search_cache
+    search_args = current_app.es, frozen['es_alias'], frozen.get('es_index')
+    query = Query(search_cache.searcher(*search_args),
                   query_text,
                   plugins_named(frozen['enabled_plugins']),
-                  is_case_sensitive=is_case_sensitive)
+                  is_case_sensitive=is_case_sensitive,
+                  es_multi_search=search_cache.multi_searcher(*search_args))
 
     # Fire off one of the two search routines:
     searcher = _search_json if _request_wants_json() else _search_html
@@ -99,22 +175,25 @@ def _search_json(query, tree, query_text, is_case_sensitive, offset, limit, conf
     then return {redirect: hit location}.If that doesn't work, fall back to a normal search
     and return the results as JSON."""
 
-    # If we're asked to redirect and have a direct hit, then return the url to that.
-    if request.values.get('redirect') == 'true':
-        result = query.direct_result()
-        if result:
-            path, line = result
-            # TODO: Does this escape query_text properly?
-            params = {
-                'tree': tree,
-                'path': path,
-                'from': query_text
-            }
-            if is_case_sensitive:
-                params['case'] = 'true'
-            return jsonify({'redirect': url_for('.browse', _anchor=line, **params)})
     try:
-        count_and_results = query.results(offset, limit)
+        # If we're asked to redirect and have a direct hit, then return the
+        # url to that. Search normally at the same time, in case we don't.
+        if request.values.get('redirect') == 'true':
+            result, count_and_results = query.direct_result_and_results(
+                offset, limit)
+            if result:
+                path, line = result
+                # TODO: Does this escape query_text properly?
+                params = {
+                    'tree': tree,
+                    'path': path,
+                    'from': query_text
+                }
+                if is_case_sensitive:
+                    params['case'] = 'true'
+                return jsonify({'redirect': url_for('.browse', _anchor=line, **params)})
+        else:
+            count_and_results = query.results(offset, limit)
         # Convert to dicts for ease of manipulation in JS:
         results = [{'icon': icon,
                     'path': path,
@@ -171,6 +250,7 @@ def _tree_tuples(query_text, is_case_sensitive):
 
 
 @dxr_blueprint.route('/<tree>/raw/<path:path>')
+@_revalidated
 def raw(tree, path):
     """Send raw data at path from tree, for binary things like images."""
     query = {
@@ -196,6 +276,7 @@ def raw(tree, path):
 
 @dxr_blueprint.route('/<tree>/source/')
 @dxr_blueprint.route('/<tree>/source/<path:path>')
+@_revalidated
 def browse(tree, path=''):
     """Show a directory listing or a single file from one of the trees.
 
@@ -203,58 +284,83 @@ def browse(tree, path=''):
 
     """
     config = current_app.dxr_config
-    try:
-        # Strip any trailing slash because we do not store it in ES.
-        return _browse_folder(tree, path.rstrip('/'), config)
-    except NotFound:
-        frozen = frozen_config(tree)
-        # Grab the FILE doc, just for the sidebar nav links and the symlink target:
-        files = filtered_query(
-            frozen['es_alias'],
-            FILE,
-            filter={'path': path},
-            size=1,
-            include=['link', 'links'])
-        if not files:
-            raise NotFound
-        if 'link' in files[0]:
-            # Then this path is a symlink, so redirect to the real thing.
-            return redirect(url_for('.browse', tree=tree, path=files[0]['link'][0]))
-
-        lines = filtered_query(
-            frozen['es_alias'],
-            LINE,
-            filter={'path': path},
-            sort=['number'],
-            size=1000000,
-            include=['content', 'refs', 'regions', 'annotations'])
-        # Deref the content field in each document. We can do this because we
-        # do not store empty lines in ES.
-        for doc in lines:
-            doc['content'] = doc['content'][0]
-
-        return _browse_file(tree, path, lines, files[0], config, frozen['generated_date'])
-
-
-def _browse_folder(tree, path, config):
-    """Return a rendered folder listing for folder ``path``.
+    frozen = frozen_config(tree)
+    # Strip any trailing slash because we do not store it in ES.
+    folder_path = path.rstrip('/')
+    # We don't yet know whether path is a folder or a file, so ask ES about
+    # both at once: the folder's listing, the FILE doc (just for the sidebar
+    # nav links, the symlink target, and the lines, if they were rendered at
+    # index time), and, unless it's been prerendered, the file's lines:
+    searches = [
+        (merge(filtered_query_body({'folder': folder_path},
+                                   sort=[{'is_folder': 'desc'}, 'name'],
+                                   exclude=['raw_data', 'rendered']),
+               {'size': 10000}),
+         FILE),
+        (merge(filtered_query_body({'path': path},
+                                   include=['link', 'links', 'rendered']),
+               {'size': 1}),
+         FILE)]
+    if not config.trees[tree].prerender:
+        searches.append((merge(filtered_query_body({'path': path},
+                                                   sort=['number'],
+                                                   include=LINE_FIELDS),
+                               {'size': 1000000}),
+                         LINE))
+    responses = [[hit['_source'] for hit in response['hits']['hits']]
+                 for response in
+                 multi_search(current_app.es, frozen['es_alias'], searches)]
+    files_and_folders, files = responses[:2]
+
+    if files_and_folders:
+        return _browse_folder(tree, folder_path, config, frozen,
+                              files_and_folders)
+    if not files:
+        raise NotFound
+    if 'link' in files[0]:
+        # Then this path is a symlink, so redirect to the real thing.
+        return redirect(url_for('.browse', tree=tree, path=files[0]['link'][0]))
+
+    if 'rendered' in files[0]:
+        rendered = unpack_rendered_lines(files[0]['rendered'])
+        lines = [{'content': text, 'annotations': annotations}
+                 for text, _, annotations in rendered]
+        contents = u''.join(text for text, _, _ in rendered)
+        # Skimmers would have to be merged in line by line, so if any has
+        # something to add, fall back to rendering it all now:
+        if not any(skimmer.is_interesting() for skimmer in
+                   _skimmers(path, contents, config.trees[tree], files[0],
+                             lines)):
+            return _browse_file(tree, path, lines, files[0], config,
+                                frozen['generated_date'],
+                                contents=contents,
+                                rendered=rendered)
+
+    if len(responses) > 2:
+        lines = responses[2]
+    else:
+        lines = filtered_query(frozen['es_alias'],
+                               LINE,
+                               filter={'path': path},
+                               sort=['number'],
+                               size=1000000,
+                               include=LINE_FIELDS)
+    # Deref the content field in each document. We can do this because we do
+    # not store empty lines in ES.
+    for doc in lines:
+        doc['content'] = doc['content'][0]
 
-    Search for FILEs having folder == path. If any matches, render the folder
-    listing. Otherwise, raise NotFound.
+    return _browse_file(tree, path, lines, files[0], config, frozen['generated_date'])
 
-    """
-    frozen = frozen_config(tree)
 
-    files_and_folders = filtered_query(
-        frozen['es_alias'],
-        FILE,
-        filter={'folder': path},
-        sort=[{'is_folder': 'desc'}, 'name'],
-        size=10000,
-        exclude=['raw_data'])
-    if not files_and_folders:
-        raise NotFound
+def _browse_folder(tree, path, config, frozen, files_and_folders):
+    """Return a rendered folder listing for folder ``path``.
 
+    :arg frozen: The catalog doc of the tree
+    :arg files_and_folders: The _sources of the FILE docs having folder ==
+        path, folders first
+
+    """
     return render_template(
         'folder.html',
         # Common template variables:
@@ -336,7 +442,8 @@ def _build_common_file_template(tree, path, date, config):
     }
 
 
-def _browse_file(tree, path, line_docs, file_doc, config, date=None, contents=None):
+def _browse_file(tree, path, line_docs, file_doc, config, date=None, contents=None,
+                 rendered=None):
     """Return a rendered page displaying a source file.
 
     :arg string tree: name of tree on which file is found
@@ -348,6 +455,9 @@ def _browse_file(tree, path, line_docs, file_doc, config, date=None, contents=No
     :arg date: a formatted string representing the generated date, default to now
     :arg string contents: the contents of the source file, defaults to joining
         the `content` field of all line_docs
+    :arg list rendered: (text, HTML, annotations) for each line, as rendered
+        at index time for a prerendered tree. If given, no skimmers are run,
+        so use it only if none are interested in the file.
     """
     def sidebar_links(sections):
         """Return data structure to build nav sidebar from. ::
@@ -371,6 +481,17 @@ def _browse_file(tree, path, line_docs, file_doc, config, date=None, contents=No
         return render_template(
             'image_file.html',
             **common)
+    elif rendered is not None:
+        # Everything was worked out at index time.
+        return _stream_template(
+            'text_file.html',
+            **merge(common, {
+                'lines': (html for _, html, _ in rendered),
+                'num_lines': len(rendered),
+                'annotations_by_line': [annotations for _, _, annotations
+                                        in rendered],
+                'is_text': True,
+                'sections': sidebar_links(links)}))
     else:  # We don't allow browsing binary files, so this must be a text file.
         # We concretize the lines into a list because we iterate over it multiple times
         lines = [doc['content'] for doc in line_docs]
@@ -380,16 +501,7 @@ def _browse_file(tree, path, line_docs, file_doc, config, date=None, contents=No
             contents = ''.join(lines)
         offsets = cumulative_sum(imap(len, lines))
         tree_config = config.trees[tree]
-        # Construct skimmer objects for all enabled plugins that define a
-        # file_to_skim class.
-        skimmers = [plugin.file_to_skim(path,
-                                        contents,
-                                        plugin.name,
-                                        tree_config,
-                                        file_doc,
-                                        line_docs)
-                    for plugin in tree_config.enabled_plugins
-                    if plugin.file_to_skim]
+        skimmers = _skimmers(path, contents, tree_config, file_doc, line_docs)
         skim_links, refses, regionses, annotationses = skim_file(skimmers, len(line_docs))
         index_refs = (Ref.es_to_triple(ref, tree_config) for ref in
                       chain.from_iterable(doc.get('refs', [])
@@ -400,19 +512,43 @@ def _browse_file(tree, path, line_docs, file_doc, config, date=None, contents=No
         tags = finished_tags(lines,
                              chain(chain.from_iterable(refses), index_refs),
                              chain(chain.from_iterable(regionses), index_regions))
-        return render_template(
+        return _stream_template(
             'text_file.html',
             **merge(common, {
-                # Someday, it would be great to stream this and not concretize
-                # the whole thing in RAM. The template will have to quit
-                # looping through the whole thing 3 times.
-                'lines': [(html_line(doc['content'], tags_in_line, offset),
-                           doc.get('annotations', []) + skim_annotations)
-                          for doc, tags_in_line, offset, skim_annotations
-                              in izip(line_docs, tags_per_line(tags), offsets, annotationses)],
+                # HTML-ify lines only as the template gets to them, so the top
+                # of the page can go out before the bottom is done:
+                'lines': (html_line(doc['content'], tags_in_line, offset)
+                          for doc, tags_in_line, offset
+                              in izip(line_docs, tags_per_line(tags), offsets)),
+                'num_lines': len(line_docs),
+                'annotations_by_line': [
+                    doc.get('annotations', []) + skim_annotations
+                    for doc, skim_annotations in izip(line_docs, annotationses)],
                 'is_text': True,
                 'sections': sidebar_links(links + skim_links)}))
 
+
+def _skimmers(path, contents, tree_config, file_doc, line_docs):
+    """Construct skimmer objects for all enabled plugins that define a
+    file_to_skim class."""
+    return [plugin.file_to_skim(path,
+                                contents,
+                                plugin.name,
+                                tree_config,
+                                file_doc,
+                                line_docs)
+            for plugin in tree_config.enabled_plugins
+            if plugin.file_to_skim]
+
+
+def _stream_template(template_name, **context):
+    """Like ``render_template()``, but return a response which sends the page
+    out as it renders."""
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return Response(stream_with_context(stream))
+
 @dxr_blueprint.route('/<tree>/rev/<revision>/<path:path>')
 def rev(tree, revision, path):
     """Display a page showing the file at path at specified revision by
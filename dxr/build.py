@@ -1,40 +1,56 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from cPickle import dump, load, HIGHEST_PROTOCOL
 from datetime import datetime
+from multiprocessing import Condition, Process, Value
 from errno import ENOENT
-from fnmatch import fnmatchcase
-from itertools import chain, izip, repeat
+from functools import partial
+from glob import glob
+from hashlib import sha1
+from itertools import chain, imap, islice, izip, repeat
+import json
 from operator import attrgetter
 import os
 from os import stat, mkdir, makedirs
-from os.path import dirname, islink, relpath, join, split
+from os.path import basename, dirname, getsize, islink, relpath, join, split, splitext
 from shutil import rmtree
+from socket import gethostname
 import subprocess
 import sys
 from sys import exc_info
+from threading import Event, Thread
+from time import sleep, time
 from traceback import format_exc
 from uuid import uuid1
 
-from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures import (as_completed, wait, FIRST_COMPLETED,
+                                ProcessPoolExecutor, ThreadPoolExecutor)
 from click import progressbar
 from flask import current_app
-from funcy import merge, chunks, first, suppress
+from funcy import merge, first, suppress
 import jinja2
 from more_itertools import chunked
 from ordereddict import OrderedDict
-from pyelasticsearch import (ElasticSearch, ElasticHttpNotFoundError,
-                             IndexAlreadyExistsError, bulk_chunks, Timeout,
-                             ConnectionError)
+from pyelasticsearch import (ElasticSearch, ElasticHttpError,
+                             ElasticHttpNotFoundError, IndexAlreadyExistsError,
+                             bulk_chunks, Timeout, ConnectionError)
 
 import dxr
 from dxr.app import make_app
 from dxr.config import FORMAT
-from dxr.es import UNINDEXED_STRING, TREE, create_index_and_wait
+from dxr.es import (UNINDEXED_STRING, TREE, create_index_and_wait, scroll,
+                    BulkSender, multi_search)
 from dxr.exceptions import BuildError
 from dxr.filters import LINE, FILE
-from dxr.lines import es_lines, finished_tags
+from dxr.lines import (es_line, finished_tags, html_line, pack_rendered_lines,
+                       tags_per_line)
 from dxr.mime import is_text, icon, is_image
-from dxr.query import filter_menu_items
+from dxr.profiling import FRAMEWORK, NullElasticSearch, NullProfile, Profile
+from dxr.query import filter_menu_items, Query
 from dxr.utils import (open_log, deep_update, append_update,
-                       append_update_by_line, append_by_line, bucket)
+                       lazy_update_by_line, lazy_extend_by_line, bucket,
+                       decode_es_datetime, glob_matcher, if_raises, walk,
+                       cumulative_sum)
 from dxr.vcs import VcsCache
 
 
@@ -53,15 +69,161 @@ def full_traceback(callable, *args, **kwargs):
         raise Exception(format_exc())
 
 
-def index_and_deploy_tree(tree, verbose=False):
+# How often, in seconds, to check whether trees indexing at once have finished:
+TREE_POLL_INTERVAL = 1
+
+
+def index_and_deploy_trees(trees, benchmark=False, **kwargs):
+    """Index and deploy several trees, up to ``concurrent_trees`` of them at
+    once.
+
+    Each tree runs in a process of its own, forked from this one's only
+    thread. (Threads would be lighter, but each tree forks pools of workers,
+    and forking while other threads run can deadlock in Python 2.) The trees
+    running at once split a :class:`WorkerBudget` of ``workers`` processes
+    evenly. If any tree fails, let the rest finish, and then raise a
+    BuildError.
+
+    Keyword args are passed along to :func:`index_and_deploy_tree()`.
+
+    """
+    if not trees:
+        return
+    config = trees[0].config
+    # Benchmarking points the config at a stand-in ES of its own, so it
+    # can't be shared.
+    if benchmark or config.concurrent_trees <= 1 or len(trees) == 1:
+        for tree in trees:
+            index_and_deploy_tree(tree, benchmark=benchmark, **kwargs)
+        return
+
+    budget = WorkerBudget.for_trees(config.workers, config.concurrent_trees)
+    waiting, running, failed = list(trees), [], []
+    while waiting or running:
+        while waiting and len(running) < config.concurrent_trees:
+            tree = waiting.pop(0)
+            process = Process(target=index_and_deploy_tree,
+                              args=(tree,),
+                              kwargs=merge(kwargs, {'budget': budget}))
+            process.start()
+            running.append((tree, process))
+        sleep(TREE_POLL_INTERVAL)
+        for tree, process in [(t, p) for t, p in running if not p.is_alive()]:
+            running.remove((tree, process))
+            if process.exitcode:
+                # The process has already printed the traceback.
+                print >> sys.stderr, "Indexing '%s' failed." % tree.name
+                failed.append(tree.name)
+    if failed:
+        raise BuildError('Indexing failed for %s.' % ', '.join(failed))
+
+
+class WorkerBudget(object):
+    """A count of worker processes to be shared among trees indexing at once,
+    each in a process of its own
+
+    The parallel stages of indexing each take what they can get of the
+    budget, and their pools are torn down, returning it, between stages. That
+    way, a tree in a serial stage holds no workers.
+
+    """
+    def __init__(self, workers, minimum=1, maximum=None):
+        """
+        :arg minimum: The fewest workers a stage should settle for, if it
+            wants that many. It waits until that many are free.
+        :arg maximum: The most workers a stage may take, however many it
+            wants. Default: all of them
+
+        """
+        self.total = workers
+        self.minimum = max(1, min(minimum, workers))
+        self.maximum = max(1, workers if maximum is None else maximum)
+        self._free = Value('i', workers, lock=False)
+        self._condition = Condition()
+
+    @classmethod
+    def for_trees(cls, workers, trees):
+        """Return a budget that gives each of ``trees`` trees at once an even
+        share of ``workers``.
+
+        Each stage gets its share, no less, so one that happens to ask while
+        the others are busy isn't left with a single worker, and no more, so
+        one tree's hours-long build can't hold every worker while the others
+        wait.
+
+        """
+        share = workers // trees
+        return cls(workers, minimum=share, maximum=share)
+
+    @property
+    def free(self):
+        return self._free.value
+
+    @contextmanager
+    def workers(self, wanted):
+        """Block until at least :attr:`minimum` workers (or ``wanted``, if
+        fewer) are free, and then take up to ``wanted`` of them, but no more
+        than :attr:`maximum`, until the end of the ``with`` block.
+
+        Yield how many I took. If ``wanted`` is 0, meaning to do everything
+        in the master process, take none, and don't wait.
+
+        """
+        taken = 0
+        if wanted:
+            with self._condition:
+                while self._free.value < min(wanted, self.minimum):
+                    self._condition.wait()
+                taken = min(wanted, self.maximum, self._free.value)
+                self._free.value -= taken
+        try:
+            yield taken
+        finally:
+            if taken:
+                with self._condition:
+                    self._free.value += taken
+                    self._condition.notify_all()
+
+
+def index_and_deploy_tree(tree, verbose=False, incremental=False,
+                          profile=False, resume=False, benchmark=False,
+                          distribute=False, budget=None):
     """Index a tree, and make it accessible.
 
     :arg tree: The TreeConfig of the tree to build
+    :arg incremental: Whether to copy the docs of unchanged files from the
+        tree's currently deployed index rather than reindexing them
+    :arg profile: Whether to report the time spent in each plugin and stage
+        of indexing
+    :arg resume: Whether to pick up where a failed build of the tree left off
+    :arg benchmark: Whether to index into a
+        :class:`~dxr.profiling.NullElasticSearch` instead of the real
+        cluster, deploying nothing, and report the throughput along with a
+        profile
+    :arg distribute: Whether to let ``dxr index-worker`` processes help
+        index the files
+    :arg budget: A :class:`WorkerBudget` shared with other trees being
+        indexed at the same time, if any
 
     """
     config = tree.config
+    if benchmark:
+        with NullElasticSearch() as sink:
+            print ('Benchmarking against a stand-in elasticsearch at %s.' %
+                   sink.url)
+            # Workers make their own connections from the config, so give
+            # them one that points at the sink:
+            tree = config.overridden(es_hosts=[sink.url]).trees[tree.name]
+            es = ElasticSearch(tree.config.es_hosts,
+                               timeout=config.es_indexing_timeout)
+            index_tree(tree, es, verbose=verbose, profile=True,
+                       distribute=distribute, resumable=False)
+        print sink.report()
+        return
     es = ElasticSearch(config.es_hosts, timeout=config.es_indexing_timeout)
-    index_name = index_tree(tree, es, verbose=verbose)
+    index_name = index_tree(tree, es, verbose=verbose, incremental=incremental,
+                            profile=profile, resume=resume,
+                            distribute=distribute, budget=budget)
     if 'index' not in tree.config.skip_stages:
         deploy_tree(tree, es, index_name)
 
@@ -108,12 +270,18 @@ def deploy_tree(tree, es, index_name):
                             },
                             # In case es_alias changes in the conf file:
                             'es_alias': UNINDEXED_STRING,
+                            # The index es_alias points to, so the web app
+                            # can cache by it:
+                            'es_index': UNINDEXED_STRING,
                             # Needed so new trees or edited descriptions can show
                             # up without a WSGI restart:
                             'description': UNINDEXED_STRING,
                             # ["clang", "pygmentize"]:
                             'enabled_plugins': UNINDEXED_STRING,
-                            'generated_date': UNINDEXED_STRING
+                            'generated_date': UNINDEXED_STRING,
+                            # So incremental builds can tell whether the
+                            # index's docs are fit to copy:
+                            'indexing_fingerprint': UNINDEXED_STRING
                             # We may someday also need to serialize some plugin
                             # configuration here.
                         }
@@ -130,9 +298,11 @@ def deploy_tree(tree, es, index_name):
              doc=dict(name=tree.name,
                       format=FORMAT,
                       es_alias=alias,
+                      es_index=index_name,
                       description=tree.description,
                       enabled_plugins=[p.name for p in tree.enabled_plugins],
-                      generated_date=config.generated_date),
+                      generated_date=config.generated_date,
+                      indexing_fingerprint=tree.indexing_fingerprint),
              id='%s/%s' % (FORMAT, tree.name))
 
 
@@ -155,15 +325,49 @@ def swap_alias(alias, index, es):
         es.delete_index(old_index)
 
 
-def index_tree(tree, es, verbose=False):
+def index_tree(tree, es, verbose=False, incremental=False, profile=False,
+               resume=False, distribute=False, budget=None, resumable=True):
     """Index a single tree into ES and the filesystem, and return the
     name of the new ES index.
 
+    Files no plugin needs the build for are indexed while the build runs;
+    see :func:`build_during_indexing()`.
+
+    As it goes, record a :class:`Checkpoint` in the temp folder. If the build
+    fails, leave the partial index and the temp folder in place so a later
+    call with ``resume`` can finish the job.
+
+    :arg incremental: If truthy, reindex only the files which have changed
+        since the currently deployed index was built, copying the rest from
+        it. Falls back to a full reindex if there is no compatible index to
+        copy from.
+    :arg profile: If truthy, time each plugin and stage of indexing, print a
+        report, and leave a JSON version, including the slowest files, in
+        the log folder as ``profile.json``
+    :arg resume: If truthy, skip the stages and files a previous, failed
+        build finished, adding to its index. Falls back to a full build if
+        there's no checkpoint to resume from.
+    :arg distribute: If truthy, once post_build is done, hand the files out
+        through a :class:`ChunkQueue` in the temp folder, so ``dxr
+        index-worker`` processes on other hosts can help index them
+    :arg budget: A :class:`WorkerBudget` to draw worker processes from, if
+        other trees are being indexed at the same time
+    :arg resumable: If falsy, keep the :class:`Checkpoint` only in memory,
+        neither reading nor leaving one on disk, as for a benchmark nobody
+        will resume
+
     """
     config = tree.config
+    if budget is None:
+        budget = WorkerBudget(config.workers)
 
+    @contextmanager
     def new_pool():
-        return ProcessPoolExecutor(max_workers=config.workers)
+        """Yield a process pool of as many workers as we can get from the
+        budget, and how many that is."""
+        with budget.workers(config.workers) as workers:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                yield pool, workers
 
     def farm_out(method_name):
         """Farm out a call to all tree indexers across a process pool.
@@ -174,7 +378,7 @@ def index_tree(tree, es, verbose=False):
         Show progress while doing it.
 
         """
-        if not config.workers:
+        if not workers:
             return [save_scribbles(ti, method_name) for ti in tree_indexers]
         else:
             futures = [pool.submit(full_traceback, save_scribbles, ti, method_name)
@@ -203,22 +407,51 @@ def index_tree(tree, es, verbose=False):
 
     skip_indexing = 'index' in config.skip_stages
     skip_build = 'build' in config.skip_stages
-    skip_cleanup  = skip_indexing or skip_build
+
+    checkpoint = Checkpoint.load(tree) if resumable else None
+    if resume and not checkpoint:
+        print 'Nothing to resume. Starting from scratch.'
+    elif resume:
+        print 'Resuming. Already done: %s.' % (', '.join(checkpoint.stages) or
+                                               'nothing')
+    elif checkpoint:
+        # We're starting over, so nobody will ever resume into these:
+        if checkpoint.index:
+            delete_index_quietly(es, checkpoint.index)
+        checkpoint.delete()
+    if not resume:
+        checkpoint = None
+    skip_cleanup = skip_indexing or skip_build
+    # Don't clear out what we're resuming from:
+    clean = not skip_cleanup and not checkpoint
+
+    # Grab the previous run's timings before the log folder gets cleared:
+    weights = extension_weights(tree.log_folder)
 
     # Create and/or clear out folders:
-    ensure_folder(tree.object_folder, tree.source_folder != tree.object_folder)
-    ensure_folder(tree.temp_folder, not skip_cleanup)
-    ensure_folder(tree.log_folder, not skip_cleanup)
-    ensure_folder(join(tree.temp_folder, 'plugins'), not skip_cleanup)
+    ensure_folder(tree.object_folder,
+                  tree.source_folder != tree.object_folder and not checkpoint)
+    ensure_folder(tree.temp_folder, clean)
+    ensure_folder(tree.log_folder, clean)
+    ensure_folder(join(tree.temp_folder, 'plugins'), clean)
     for plugin in tree.enabled_plugins:
-        ensure_folder(join(tree.temp_folder, 'plugins', plugin.name),
-                      not skip_cleanup)
+        ensure_folder(join(tree.temp_folder, 'plugins', plugin.name), clean)
 
-    vcs_cache = VcsCache(tree)
-    tree_indexers = [p.tree_to_index(p.name, tree, vcs_cache) for p in
-                     tree.enabled_plugins if p.tree_to_index]
+    if checkpoint:
+        tree_indexers = checkpoint.tree_indexers()
+    else:
+        checkpoint = (Checkpoint if resumable else NullCheckpoint)(tree)
+        tree_indexers = None
+    if tree_indexers is None:
+        vcs_cache = VcsCache(tree)
+        tree_indexers = [p.tree_to_index(p.name, tree, vcs_cache) for p in
+                         tree.enabled_plugins if p.tree_to_index]
+    index = checkpoint.index
+    timings, files_profile = {}, Profile() if profile else None
     try:
-        if not skip_indexing:
+        if index:
+            print "Reopening index '%s'." % index
+        elif not skip_indexing:
             # Substitute the format, tree name, and uuid into the index identifier.
             index = tree.es_index.format(format=FORMAT,
                                          tree=tree.name,
@@ -241,10 +474,8 @@ def index_tree(tree, es, verbose=False):
                         # DXR indices are immutable once built. Turn the
                         # refresh interval down to keep the segment count low
                         # while indexing. It will make for less merging later.
-                        # We could also simply call "optimize" after we're
-                        # done indexing, but it is unthrottled; we'd have to
-                        # use shard allocation to do the indexing on one box
-                        # and then move it elsewhere for actual use.
+                        # Set es_optimize_segments to also merge, throttled,
+                        # once we're done indexing.
                         'refresh_interval':
                             '%is' % config.es_refresh_interval
                     },
@@ -253,26 +484,67 @@ def index_tree(tree, es, verbose=False):
                                             tree.enabled_plugins),
                                        {})
                 })
+            checkpoint.index = index
+            checkpoint.save()
         else:
-            index = None
             print "Skipping indexing (due to 'index' in 'skip_stages')"
 
         # Run pre-build hooks:
-        with new_pool() as pool:
-            tree_indexers = farm_out('pre_build')
-            # Tear down pool to let the build process use more RAM.
+        if not checkpoint.done('pre_build'):
+            with new_pool() as (pool, workers):
+                tree_indexers = farm_out('pre_build')
+                # Tear down pool to let the build process use more RAM.
+            checkpoint.finish('pre_build', tree_indexers)
 
-        if not skip_build:
-            # Set up env vars, and build:
-            build_tree(tree, tree_indexers, verbose)
-        else:
+        if skip_build:
             print "Skipping rebuild (due to 'build' in 'skip_stages')"
+        elif checkpoint.done('build'):
+            print 'Skipping rebuild (already done before resuming)'
+        else:
+            # Set up env vars, and build:
+            with budget.workers(config.workers) as workers:
+                # Incremental builds copy most docs over after post_build, so
+                # indexing files early would mostly be wasted work.
+                workers_during_build = min(workers,
+                                           config.workers_during_build)
+                if skip_indexing or incremental or not workers_during_build:
+                    build_tree(tree, tree_indexers, verbose, workers)
+                    checkpoint.finish('build')
+                else:
+                    # This finishes the build stage itself, even if the
+                    # indexing fails, so --resume won't redo a good build:
+                    timings, files_profile = build_during_indexing(
+                        tree, tree_indexers, index, es, workers_during_build,
+                        checkpoint, verbose=verbose, weights=weights,
+                        profile=profile, build_workers=workers)
 
         # Post-build, and index files:
         if not skip_indexing:
-            with new_pool() as pool:
-                tree_indexers = farm_out('post_build')
-                index_files(tree, tree_indexers, index, pool, es)
+            with new_pool() as (pool, workers):
+                if not checkpoint.done('post_build'):
+                    print 'Listing files.'
+                    walk_source(tree, pool if workers else None).save(tree)
+                    tree_indexers = farm_out('post_build')
+                    checkpoint.finish('post_build', tree_indexers)
+                # When resuming, any file a worker got partway through at the
+                # time of the failure is simply redone. Its docs have
+                # deterministic IDs, so the new ones overwrite the old.
+
+                if incremental and not checkpoint.done('copy_unchanged'):
+                    checkpoint.add_paths(copy_unchanged_docs(tree, es, index))
+                    checkpoint.finish('copy_unchanged')
+                more_timings, more_profile = index_files(
+                    tree, tree_indexers, index, pool, es,
+                    skip_paths=checkpoint.done_paths,
+                    weights=weights,
+                    profile=profile,
+                    checkpoint=checkpoint,
+                    workers=workers,
+                    distribute=distribute)
+            write_timings(add_timings(timings, more_timings), tree.log_folder)
+            if files_profile:
+                report_profile(files_profile.merge(more_profile),
+                               tree.log_folder)
 
             # refresh() times out in prod. Wait until it doesn't. That
             # probably means things are ready to rock again.
@@ -285,30 +557,141 @@ def index_tree(tree, es, verbose=False):
                     else:
                         break
 
+            # Merge before replicating, so the replicas needn't do it too:
+            if config.es_optimize_segments:
+                optimize_index(es,
+                               index,
+                               config.es_optimize_segments,
+                               config.es_optimize_throttle)
+
+            replicas = 1  # fairly arbitrary
             es.update_settings(
                 index,
                 {
                     'settings': {
                         'index': {
-                            'number_of_replicas': 1  # fairly arbitrary
+                            'number_of_replicas': replicas
                         }
                     }
                 })
+
+            if config.es_optimize_segments or tree.warmup_queries:
+                wait_for_replicas(es, index, replicas)
+                warm_up(tree, es, index)
     except Exception as exc:
-        # If anything went wrong, delete the index, because we're not
-        # going to have a way of returning its name if we raise an
-        # exception.
-        if not skip_indexing:
+        # If anything went wrong, leave the index and temp folder for
+        # --resume. The next non-resuming build of the tree will delete the
+        # index.
+        if resumable and checkpoint.index:
+            print ("Leaving the partial index '%s'. Run `dxr index --resume "
+                   "%s` to finish it." % (checkpoint.index, tree.name))
+        elif index:
+            # It never made it into the checkpoint, so nobody would find it.
             delete_index_quietly(es, index)
         raise
 
     print "Finished '%s' in %s." % (tree.name, datetime.now() - start_time)
+    checkpoint.delete()  # Nothing left to resume.
     if not skip_cleanup:
         # By default, we remove the temp files, because they're huge.
         rmtree(tree.temp_folder)
     return index
 
 
+def optimize_index(es, index, max_segments, throttle):
+    """Merge each shard of an index down to at most ``max_segments``
+    segments, and wait for it to finish.
+
+    Optimize itself is unthrottled, so first limit the index's disk
+    bandwidth for merges to ``throttle``, an ES byte size like "20mb".
+
+    """
+    es.update_settings(
+        index,
+        {
+            'settings': {
+                'index': {
+                    'store': {
+                        'throttle': {
+                            'type': 'merge',
+                            'max_bytes_per_sec': throttle
+                        }
+                    }
+                }
+            }
+        })
+    # Waiting for the merge would outlast the HTTP timeout, so poll instead:
+    es.send_request('POST',
+                    [index, '_optimize'],
+                    query_params={'max_num_segments': max_segments,
+                                  'wait_for_merge': 'false'})
+    with aligned_progressbar(repeat(None), label='Optimizing index') as bar:
+        for _ in bar:
+            shards = es.send_request('GET', [index, '_segments'])[
+                'indices'].get(index, {}).get('shards', {})
+            if all(copy['num_search_segments'] <= max_segments
+                   for copies in shards.itervalues() for copy in copies):
+                break
+            sleep(10)
+
+
+# The HTTP status ES 1.x answers a cluster health wait that times out with:
+REQUEST_TIMEOUT = 408
+
+
+def wait_for_replicas(es, index, replicas):
+    """Wait for an index's ``replicas`` replicas to be allocated, unless
+    there aren't enough data nodes to hold them all, in which case they never
+    will be."""
+    with aligned_progressbar(repeat(None), label='Replicating index') as bar:
+        for _ in bar:
+            try:
+                health = es.health(index=index,
+                                   wait_for_status='green',
+                                   timeout='30s')
+            except ElasticHttpError as exc:
+                if exc.status_code != REQUEST_TIMEOUT:
+                    raise
+                # Not green yet. See whether it ever could be:
+                health = es.health(index=index)
+            if (health.get('status') == 'green' or
+                    health.get('number_of_data_nodes', 1) <= replicas):
+                break
+
+
+def warm_up(tree, es, index):
+    """Run the tree's warm-up queries against a new index so its caches are
+    loaded before anybody else searches it.
+
+    Report, but otherwise ignore, queries that fail: they shouldn't throw away
+    a whole build.
+
+    """
+    for query_text in tree.warmup_queries:
+        start = time()
+        try:
+            query = Query(partial(es.search, index=index),
+                          query_text,
+                          tree.enabled_plugins,
+                          es_multi_search=partial(multi_search, es, index))
+            # Search the way the web app's search-as-you-type does:
+            query.direct_result_and_results()
+        except Exception as exc:
+            print 'Warm-up query "%s" failed: %s' % (query_text, exc)
+        else:
+            print 'Warmed up with "%s" in %.2fs.' % (query_text, time() - start)
+
+
+def report_profile(profile, log_folder):
+    """Print a :class:`~dxr.profiling.Profile`, and write it to the log
+    folder as JSON."""
+    print profile.report()
+    path = join(log_folder, 'profile.json')
+    with open(path, 'w') as file:
+        json.dump(profile.as_json(), file, indent=2)
+    print 'Profile written to %s.' % path
+
+
 def aligned_progressbar(*args, **kwargs):
     """Fall through to click's progress bar, but line up all the bars so they
     aren't askew."""
@@ -326,6 +709,30 @@ def show_progress(futures, message):
             yield future
 
 
+def bounded_futures(pool, calls, max_in_flight):
+    """Submit calls to a pool, keeping no more than ``max_in_flight`` of them
+    outstanding at once, and yield their futures as they complete.
+
+    Holding the rest back lets workers pull from a short queue rather than
+    from a long, fixed plan made up front.
+
+    :arg calls: An iterable of (callable, args, kwargs) tuples
+
+    """
+    calls = iter(calls)
+
+    def submit(how_many):
+        return set(pool.submit(callable, *args, **kwargs) for
+                   callable, args, kwargs in islice(calls, how_many))
+
+    pending = submit(max_in_flight)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        pending |= submit(len(done))
+        for future in done:
+            yield future
+
+
 def save_scribbles(obj, method):
     """Call obj.method(), then return obj and the result so the master process
     can see anything method() scribbled on it.
@@ -349,22 +756,6 @@ def ensure_folder(folder, clean=False):
         makedirs(folder)
 
 
-def _unignored_folders(folders, source_path, ignore_filenames, ignore_paths):
-    """Yield the folders from ``folders`` which are not ignored by the given
-    patterns and paths.
-
-    :arg source_path: Relative path to the source directory
-    :arg ignore_filenames: Filename-based globs to be ignored
-    :arg ignore_paths: Path-based globs to be ignored
-
-    """
-    for folder in folders:
-        if not any(fnmatchcase(folder, p) for p in ignore_filenames):
-            folder_path = '/' + join(source_path, folder).replace(os.sep, '/') + '/'
-            if not any(fnmatchcase(folder_path, p) for p in ignore_paths):
-                yield folder
-
-
 def file_contents(path, encoding_guess):  # TODO: Make accessible to TreeToIndex.post_build.
     """Return the unicode contents of a file if we can figure out a decoding.
     Otherwise, return the contents as a string.
@@ -388,61 +779,368 @@ def file_contents(path, encoding_guess):  # TODO: Make accessible to TreeToIndex
     return contents
 
 
+class _Ignorer(object):
+    """The ignore patterns of a tree, compiled for speed"""
+
+    def __init__(self, ignore_filenames, ignore_paths):
+        self._name_ignored = glob_matcher(ignore_filenames)
+        self._path_ignored = glob_matcher(ignore_paths)
+
+    def is_ignored(self, name, slashed_path):
+        """Return whether a file or folder is ignored.
+
+        :arg name: The name of the file or folder
+        :arg slashed_path: Its path relative to the source folder, with a
+            leading slash and, if it's a folder, a trailing one, as
+            ``ignore_paths`` expects
+
+        """
+        return self._name_ignored(name) or self._path_ignored(slashed_path)
+
+
+def _walk_unignored(source_folder, rel_folder, ignore_filenames, ignore_paths):
+    """Walk an unignored folder and everything unignored beneath it, yielding
+    (path relative to the source folder, unignored subfolder names,
+    unignored file names) for each folder.
+
+    :arg rel_folder: The folder to start at, relative to the source folder.
+        '' means the source folder itself.
+
+    """
+    def raise_(exc):
+        raise exc
+
+    ignorer = _Ignorer(ignore_filenames, ignore_paths)
+    for root, folders, files in walk(join(source_folder, rel_folder),
+                                     topdown=True,
+                                     onerror=raise_):
+        rel_root = relpath(root, source_folder)
+        if rel_root == '.':
+            rel_root = ''
+        prefix = '/' + join(rel_root, '').replace(os.sep, '/')
+
+        # Exclude folders that match an ignore pattern.
+        # walk() listens to any changes we make in `folders`.
+        folders[:] = [f for f in folders if
+                      not ignorer.is_ignored(f, prefix + f + '/')]
+        yield rel_root, folders, [f for f in files if
+                                  not ignorer.is_ignored(f, prefix + f)]
+
+
+def _walk_subtree(source_folder, rel_folder, ignore_filenames, ignore_paths):
+    """Return lists of the paths of unignored files and of unignored folders
+    beneath a folder, relative to the source folder.
+
+    This is the entrypoint for parallel tree walkers.
+
+    """
+    files, folders = [], []
+    for rel_root, subfolders, names in _walk_unignored(
+            source_folder, rel_folder, ignore_filenames, ignore_paths):
+        files.extend(join(rel_root, name) for name in names)
+        folders.extend(join(rel_root, name) for name in subfolders)
+    return files, folders
+
+
 def unignored(folder, ignore_paths, ignore_filenames, want_folders=False):
     """Return an iterable of absolute paths to unignored source tree files or
     the folders that contain them.
 
-    Returned files include both binary and text ones.
+    Returned files include both binary and text ones. Within a build, it's
+    generally faster to use the cached :func:`source_manifest()`.
 
     :arg want_folders: If falsey, return files. If truthy, return folders
         instead.
 
     """
-    def raise_(exc):
-        raise exc
+    for rel_root, folders, files in _walk_unignored(
+            folder, '', ignore_filenames, ignore_paths):
+        for name in folders if want_folders else files:
+            yield join(folder, rel_root, name)
 
-    # TODO: Expose a lot of pieces of this as routines plugins can call.
-    for root, folders, files in os.walk(folder, topdown=True, onerror=raise_):
-        # Find relative path
-        rel_path = relpath(root, folder)
-        if rel_path == '.':
-            rel_path = ''
 
-        if not want_folders:
-            for f in files:
-                # Ignore file if it matches an ignore pattern
-                if any(fnmatchcase(f, e) for e in ignore_filenames):
-                    continue  # Ignore the file.
+# Where we leave the SourceManifest, in the temp folder:
+MANIFEST_FILE = 'source-manifest.pickle'
 
-                path = join(rel_path, f)
 
-                # Ignore file if its path (relative to the root) matches an
-                # ignore path.
-                if any(fnmatchcase("/" + path.replace(os.sep, "/"), e) for e in ignore_paths):
-                    continue  # Ignore the file.
+class SourceManifest(object):
+    """The unignored files and folders of a tree, as paths relative to its
+    source folder
 
-                yield join(root, f)
+    Walking a big tree and matching everything against the ignore patterns
+    takes a while, and several things need the results during each build,
+    some of them in worker processes. So :func:`index_tree()` walks once,
+    after the build (which may add files), and leaves the results in the temp
+    folder for everybody to get at through :func:`source_manifest()`.
 
-        # Exclude folders that match an ignore pattern.
-        # os.walk listens to any changes we make in `folders`.
-        folders[:] = _unignored_folders(
-            folders, rel_path, ignore_filenames, ignore_paths)
-        if want_folders:
-            for f in folders:
-                yield join(root, f)
+    """
+    # Per-process cache of manifest file path -> SourceManifest:
+    _loaded = {}
+
+    def __init__(self, files, folders):
+        self.files = files
+        self.folders = folders
+
+    def save(self, tree):
+        """Write myself to the tree's temp folder, where
+        :func:`source_manifest()` will find me."""
+        path = join(tree.temp_folder, MANIFEST_FILE)
+        with open(path, 'wb') as file:
+            dump(self, file, HIGHEST_PROTOCOL)
+        SourceManifest._loaded[path] = self
+
+
+def walk_source(tree, pool=None):
+    """Walk a tree's source folder, and return a :class:`SourceManifest`.
+
+    :arg pool: An executor across which to fan out the walking of the
+        top-level folders, or None to walk serially
+
+    """
+    patterns = tree.ignore_filenames, tree.ignore_paths
+    if pool is None:
+        return SourceManifest(*_walk_subtree(tree.source_folder, '',
+                                             *patterns))
+
+    walker = _walk_unignored(tree.source_folder, '', *patterns)
+    _, top_folders, top_files = next(walker)
+    walker.close()  # The workers will do the rest.
+    futures = [pool.submit(full_traceback,
+                           _walk_subtree,
+                           tree.source_folder,
+                           folder,
+                           *patterns)
+               for folder in top_folders]
+    files, folders = list(top_files), list(top_folders)
+    # Collect results in order, so the manifest comes out the same as a serial
+    # walk's:
+    for future in futures:
+        subtree_files, subtree_folders = future.result()
+        files.extend(subtree_files)
+        folders.extend(subtree_folders)
+    return SourceManifest(files, folders)
+
+
+def source_manifest(tree):
+    """Return the :class:`SourceManifest` saved for the current build of a
+    tree, loading it only if this process hasn't already.
+
+    If there isn't one, as when running outside a build, walk the tree
+    afresh.
+
+    """
+    path = join(tree.temp_folder, MANIFEST_FILE)
+    loaded = SourceManifest._loaded
+    if path not in loaded:
+        try:
+            with open(path, 'rb') as file:
+                loaded[path] = load(file)
+        except IOError as exc:
+            if exc.errno != ENOENT:
+                raise
+            return walk_source(tree)
+    return loaded[path]
+
+
+# Where a Checkpoint records the build's progress, in the temp folder:
+CHECKPOINT_FILE = 'checkpoint.json'
+
+# ...and the paths of files whose docs are all in the index, one per line, as
+# recorded by the master:
+CHECKPOINT_PATHS_FILE = 'checkpoint-paths.txt'
+
+# ...and as recorded, file by file, by each worker process, named after its
+# host and PID:
+WORKER_PATHS_FILE = 'checkpoint-paths-%s-%s.txt'
+
+
+class Checkpoint(object):
+    """A record of how far a build of a tree got, so ``dxr index --resume``
+    can pick up where a failed one left off
+
+    It lives in the temp folder and holds the name of the index being built,
+    the stages finished (along with the TreeToIndexes as they stood after any
+    stage that changes them), and the paths of the files whose docs are all
+    safely in the index. Workers record those paths as they go, in files of
+    their own, so the files of a chunk in flight at the time of a failure
+    needn't all be redone.
+
+    """
+    # Whether I'm kept on disk, where workers can add to me:
+    persistent = True
+
+    def __init__(self, tree, index=None, stages=None, done_paths=None):
+        self.tree = tree
+        self.index = index
+        self.stages = stages or []
+        self.done_paths = done_paths or set()
+
+    @classmethod
+    def load(cls, tree):
+        """Return the Checkpoint an unfinished build of a tree left behind,
+        or None if there isn't one."""
+        try:
+            with open(join(tree.temp_folder, CHECKPOINT_FILE)) as file:
+                state = json.load(file)
+        except IOError as exc:
+            if exc.errno == ENOENT:
+                return None
+            raise
+        checkpoint = cls(tree, state['index'], state['stages'])
+        for path in checkpoint._paths_files():
+            with suppress(IOError):
+                with open(path) as file:
+                    checkpoint.done_paths.update(json.loads(line) for line in
+                                                 file)
+        return checkpoint
+
+    def _path(self, file_name):
+        return join(self.tree.temp_folder, file_name)
+
+    def _paths_files(self):
+        """Return the paths of the master's and all the workers' files of
+        finished paths."""
+        return glob(self._path('checkpoint-paths*.txt'))
+
+    def _indexers_path(self, stage):
+        return self._path('checkpoint-%s.pickle' % stage)
+
+    def save(self):
+        """Write the index name and finished stages to disk."""
+        path = self._path(CHECKPOINT_FILE)
+        with open(path + '.new', 'w') as file:
+            json.dump({'index': self.index, 'stages': self.stages}, file)
+        os.rename(path + '.new', path)  # atomic, so a crash can't corrupt it
+
+    def done(self, stage):
+        """Return whether a stage was finished."""
+        return stage in self.stages
+
+    def finish(self, stage, tree_indexers=None):
+        """Record that a stage is finished.
+
+        :arg tree_indexers: The TreeToIndexes, if the stage changed them
+
+        """
+        if tree_indexers is not None:
+            with open(self._indexers_path(stage), 'wb') as file:
+                dump(tree_indexers, file, HIGHEST_PROTOCOL)
+        self.stages.append(stage)
+        self.save()
+
+    def tree_indexers(self):
+        """Return the TreeToIndexes as the last stage that changed them left
+        them, or None if no stage has."""
+        for stage in reversed(self.stages):
+            with suppress(IOError):
+                with open(self._indexers_path(stage), 'rb') as file:
+                    return load(file)
+
+    def add_paths(self, paths):
+        """Record that all the docs of some files are in the index.
+
+        :arg paths: Paths to the files, relative to the source folder
+
+        """
+        paths = list(paths)
+        with open(self._path(CHECKPOINT_PATHS_FILE), 'a') as file:
+            file.writelines(json.dumps(path) + '\n' for path in paths)
+        self.done_paths.update(paths)
 
+    def remove_paths(self, paths):
+        """Record that the docs of some files are no longer in the index, so
+        they'll be indexed again.
 
-def index_file(tree, tree_indexers, path, es, index):
+        :arg paths: Paths to the files, relative to the source folder
+
+        """
+        paths = set(paths)
+        self.done_paths.difference_update(paths)
+        for paths_file in self._paths_files():
+            with open(paths_file) as file:
+                lines = [line for line in file if
+                         json.loads(line) not in paths]
+            with open(paths_file + '.new', 'w') as file:
+                file.writelines(lines)
+            os.rename(paths_file + '.new', paths_file)
+
+    def delete(self):
+        """Remove my files from disk."""
+        for path in ([self._path(CHECKPOINT_FILE)] +
+                     self._paths_files() +
+                     [self._indexers_path(s) for s in self.stages]):
+            with suppress(OSError):
+                os.remove(path)
+
+
+class NullCheckpoint(Checkpoint):
+    """A :class:`Checkpoint` that lives only in memory, for builds nobody will
+    resume"""
+
+    persistent = False
+
+    def save(self):
+        pass
+
+    def finish(self, stage, tree_indexers=None):
+        self.stages.append(stage)
+
+    def add_paths(self, paths):
+        self.done_paths.update(paths)
+
+    def remove_paths(self, paths):
+        self.done_paths.difference_update(paths)
+
+    def delete(self):
+        pass
+
+
+class PickledTreeIndexers(object):
+    """A lightweight stand-in for a list of TreeToIndexes, which have been
+    pickled to a file in the temp folder
+
+    Passing potentially large TreesToIndex to worker processes goes at 52MB/s
+    on my OS X laptop, measuring by the size of the pickled object and
+    including the pickling and unpickling time. Rather than paying that for
+    every chunk of files, we pickle them once in the master and send this
+    instead. Each worker process unpickles them the first time it needs them
+    and keeps them for subsequent chunks of the same build.
+
+    """
+    # Per-process cache of build ID -> list of TreeToIndexes:
+    _loaded = {}
+
+    def __init__(self, tree_indexers, folder):
+        """Pickle ``tree_indexers`` into a new file in ``folder``."""
+        self.build_id = uuid1().hex
+        self.path = join(folder, 'tree-indexers-%s.pickle' % self.build_id)
+        with open(self.path, 'wb') as file:
+            dump(tree_indexers, file, HIGHEST_PROTOCOL)
+
+    def load(self):
+        """Return the list of TreeToIndexes, unpickling them only if this
+        process hasn't already."""
+        loaded = PickledTreeIndexers._loaded
+        if self.build_id not in loaded:
+            loaded.clear()  # Let any previous build's indexers go.
+            with open(self.path, 'rb') as file:
+                loaded[self.build_id] = load(file)
+        return loaded[self.build_id]
+
+
+def index_file(tree, tree_indexers, path, es, sender, profile=NullProfile(),
+               line_doc_cache=None):
     """Index a single file into ES, and build a static HTML representation of it.
 
     For the moment, we execute plugins in series, figuring that we have plenty
-    of files to keep our processors busy in most trees that take very long. I'm
-    a little afraid of the cost of passing potentially large TreesToIndex to
-    worker processes. That goes at 52MB/s on my OS X laptop, measuring by the
-    size of the pickled object and including the pickling and unpickling time.
+    of files to keep our processors busy in most trees that take very long.
 
     :arg path: Absolute path to the file to index
-    :arg index: The ES index name
+    :arg sender: The :class:`~dxr.es.BulkSender` to add bulk actions to
+    :arg profile: A :class:`~dxr.profiling.Profile` to record the time spent
+        in each plugin and stage to
+    :arg line_doc_cache: A :class:`LineDocCache` through which to share line
+        docs among identical files, or None not to
 
     """
     try:
@@ -460,39 +1158,105 @@ def index_file(tree, tree_indexers, path, es, index):
     is_link = islink(path)
     # Index by line if the contents are text and the path is not a symlink.
     index_by_line = is_text and not is_link
-    if index_by_line:
-        lines = contents.splitlines(True)
-        num_lines = len(lines)
-        needles_by_line = [{} for _ in xrange(num_lines)]
-        annotations_by_line = [[] for _ in xrange(num_lines)]
-        refses, regionses = [], []
     needles = {}
     linkses = []
+    interested = []  # (plugin name, FileToIndex) pairs
 
     for tree_indexer in tree_indexers:
-        file_to_index = tree_indexer.file_to_index(rel_path, contents)
-        if file_to_index.is_interesting():
+        plugin = tree_indexer.plugin_name
+        file_to_index = profile.call(plugin, 'file_to_index',
+                                     tree_indexer.file_to_index,
+                                     rel_path, contents)
+        if profile.call(plugin, 'is_interesting',
+                        file_to_index.is_interesting):
             # Per-file stuff:
-            append_update(needles, file_to_index.needles())
+            append_update(needles, profile.iterate(plugin, 'needles',
+                                                   file_to_index.needles))
             if not is_link:
-                linkses.append(file_to_index.links())
+                linkses.append(profile.iterate(plugin, 'links',
+                                               file_to_index.links))
+            interested.append((plugin, file_to_index))
+
+    if index_by_line:
+        # If only path-independent plugins are interested, a byte-identical
+        # file of the same name elsewhere in the tree will have the same line
+        # docs, give or take the file-wide needles.
+        cache_key = None
+        if (line_doc_cache is not None and
+                len(contents) <= DEDUP_MAX_FILE_SIZE and
+                all(f.path_independent for _, f in interested)):
+            cache_key = (sha1(contents.encode('utf-8')).digest(),
+                         basename(path),
+                         tuple(plugin for plugin, _ in interested))
+        cached = cache_key and line_doc_cache.get(cache_key)
+
+    def line_docs(rendered=None):
+        """Yield the docs for each line, minus the file-wide needles.
+
+        :arg rendered: A list to which to append (text, HTML, annotations)
+            for each line as we go, or None not to render the lines
 
-            # Per-line stuff:
-            if index_by_line:
-                refses.append(file_to_index.refs())
-                regionses.append(file_to_index.regions())
-                append_update_by_line(needles_by_line,
-                                      file_to_index.needles_by_line())
-                append_by_line(annotations_by_line,
-                               file_to_index.annotations_by_line())
+        """
+        # Per-line stuff stays as each plugin's lazy iterables until we emit
+        # the line docs, so a huge file never has all its lines' needles and
+        # annotations in memory at once:
+        refses, regionses = [], []
+        needles_by_lines, annotations_by_lines = [], []
+        for plugin, file_to_index in interested:
+            refses.append(profile.iterate(plugin, 'refs',
+                                          file_to_index.refs))
+            regionses.append(profile.iterate(plugin, 'regions',
+                                             file_to_index.regions))
+            needles_by_lines.append(
+                profile.iterate(plugin, 'needles_by_line',
+                                file_to_index.needles_by_line))
+            annotations_by_lines.append(
+                profile.iterate(plugin, 'annotations_by_line',
+                                file_to_index.annotations_by_line))
+
+        texts = contents.splitlines(True)
+        tags = profile.iterate(FRAMEWORK, 'finished_tags',
+                               finished_tags,
+                               texts,
+                               chain.from_iterable(refses),
+                               chain.from_iterable(regionses))
+        # tags_per_line() yields exactly one item per line, so it goes first
+        # and decides when we stop. The others are merged a line at a time as
+        # we go.
+        for line_tags, total, annotations_for_this_line, text, offset in izip(
+                tags_per_line(tags),
+                lazy_update_by_line(needles_by_lines),
+                lazy_extend_by_line(annotations_by_lines),
+                texts,
+                cumulative_sum(imap(len, texts))):
+            if rendered is not None:
+                rendered.append((text,
+                                 profile.call(FRAMEWORK, 'html_line',
+                                              html_line,
+                                              text, line_tags, offset),
+                                 annotations_for_this_line or []))
+            tags = profile.call(FRAMEWORK, 'es_lines', es_line, line_tags)
+            # We bucket tags into refs and regions for ES because later at
+            # request time we want to be able to merge them individually
+            # with those from skimmers.
+            refs_and_regions = bucket(tags, lambda index_obj: "regions" if
+                                      isinstance(index_obj['payload'], basestring) else
+                                      "refs")
+            if 'refs' in refs_and_regions:
+                total['refs'] = refs_and_regions['refs']
+            if 'regions' in refs_and_regions:
+                total['regions'] = refs_and_regions['regions']
+            if annotations_for_this_line:
+                total['annotations'] = annotations_for_this_line
+            yield total
 
     def docs():
         """Yield documents for bulk indexing."""
         # Index a doc of type 'file' so we can build folder listings.
-        # At the moment, we send to ES in the same worker that does the
-        # indexing. We could interpose an external queueing system, but I'm
-        # willing to potentially sacrifice a little speed here for the easy
-        # management of self-throttling.
+        # We send to ES from a background thread in the same worker that
+        # does the indexing. We could interpose an external queueing system,
+        # but I'm willing to potentially sacrifice a little speed here for the
+        # easy management of self-throttling.
         file_info = stat(path)
         folder_name, file_name = split(rel_path)
         # Hard-code the keys that are hard-coded in the browse()
@@ -516,40 +1280,136 @@ def index_file(tree, tree_indexers, path, es, index):
                     chain.from_iterable(linkses)]
         if links:
             doc['links'] = links
-        yield es.index_op(doc, doc_type=FILE)
 
         # Index all the lines.
         if index_by_line:
-            for total, annotations_for_this_line, tags in izip(
-                    needles_by_line,
-                    annotations_by_line,
-                    es_lines(finished_tags(lines,
-                                           chain.from_iterable(refses),
-                                           chain.from_iterable(regionses)))):
+            if cached is not None:
+                lines, packed = cached
+                rendered = None
+            else:
+                rendered = [] if tree.prerender else None
+                lines = line_docs(rendered)
+                packed = None
+                if cache_key:
+                    # It's small; keep it for any identical copies.
+                    lines = list(lines)
+            for number, line in enumerate(lines, 1):
                 # Duplicate the file-wide needles into this line:
-                total.update(needles)
-
-                # We bucket tags into refs and regions for ES because later at
-                # request time we want to be able to merge them individually
-                # with those from skimmers.
-                refs_and_regions = bucket(tags, lambda index_obj: "regions" if
-                                          isinstance(index_obj['payload'], basestring) else
-                                          "refs")
-                if 'refs' in refs_and_regions:
-                    total['refs'] = refs_and_regions['refs']
-                if 'regions' in refs_and_regions:
-                    total['regions'] = refs_and_regions['regions']
-                if annotations_for_this_line:
-                    total['annotations'] = annotations_for_this_line
-                yield es.index_op(total)
+                yield es.index_op(merge(line, needles),
+                                  id=line_doc_id(rel_path, number))
+            # Now that the lines have rendered themselves along the way:
+            if rendered:
+                packed = profile.call(FRAMEWORK, 'pack_rendered_lines',
+                                      pack_rendered_lines, rendered)
+            if cache_key and cached is None:
+                line_doc_cache.put(cache_key, lines, packed)
+            if packed:
+                doc['rendered'] = packed
+        yield es.index_op(doc, doc_type=FILE, id=rel_path)
 
     # Indexing a 277K-line file all in one request makes ES time out (>60s),
-    # so we chunk it up. 300 docs is optimal according to the benchmarks in
-    # https://bugzilla.mozilla.org/show_bug.cgi?id=1122685. So large docs like
-    # images don't make our chunk sizes ridiculous, there's a size ceiling as
-    # well: 10000 is based on the 300 and an average of 31 chars per line.
-    for chunk in bulk_chunks(docs(), docs_per_chunk=300, bytes_per_chunk=10000):
-        es.bulk(chunk, index=index, doc_type=LINE)
+    # so we chunk it up. The sender batches docs across files, so small ones
+    # don't make for tiny requests, and sizes the batches to suit ES.
+    for action in docs():
+        sender.add(action)
+        if sender.full:
+            # Time spent here is time spent waiting for the sender to catch
+            # up:
+            profile.call(FRAMEWORK, 'bulk (blocked)', sender.flush)
+
+
+def line_doc_id(path, number):
+    """Return the ES ID of the LINE doc for a line of a file.
+
+    FILE and folder docs take their paths as IDs. Giving every doc a
+    deterministic one means a bulk request that :class:`~dxr.es.BulkSender`
+    retries after a timeout overwrites whatever ES already applied of it
+    rather than indexing it twice.
+
+    :arg path: The path of the file, relative to the source folder
+    :arg number: The 1-based line number
+
+    """
+    return '%s:%s' % (path, number)
+
+
+# Files with more characters than this don't have their line docs cached for
+# identical copies, so the cache is spread over plenty of files:
+DEDUP_MAX_FILE_SIZE = 256 * 1024
+
+# How many bytes of JSON-encoded line docs and packed rendered lines each
+# worker caches for identical copies:
+DEDUP_CACHE_SIZE = 8 * 1024 * 1024
+
+
+class LineDocCache(object):
+    """A per-process, least-recently-used cache of the line docs of files in
+    which only path-independent plugins are interested
+
+    Keys are (content hash, file name, names of interested plugins). Values
+    are the line docs without the file-wide needles, which vary by path and
+    are merged in afresh for each copy, paired with the packed rendered lines
+    if the tree is prerendered.
+
+    The line docs are kept JSON-encoded. That costs a decode per hit, but
+    Python dicts are many times the size of their JSON, and encoding lets
+    ``max_size`` bound the bytes the cache actually holds.
+
+    """
+    # Per-process map of ES index -> LineDocCache, so a worker shares one
+    # across all its chunks of a build but lets go of it for the next build:
+    _by_index = {}
+
+    def __init__(self, max_size=DEDUP_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (encoded lines, packed, size)
+
+    @classmethod
+    def for_index(cls, index):
+        """Return this process's cache for the build of ``index``."""
+        caches = cls._by_index
+        if index not in caches:
+            caches.clear()
+            caches[index] = cls()
+        return caches[index]
+
+    def get(self, key):
+        """Return the cached (line docs, packed rendered lines) for ``key``,
+        or None."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._entries[key] = entry  # Move it to the recent end.
+        encoded_lines, packed, _ = entry
+        return imap(json.loads, encoded_lines), packed
+
+    def put(self, key, lines, packed=None):
+        """Cache some line docs and, optionally, the packed rendered lines
+        that go with them, evicting the least recently used entries to keep
+        within ``max_size``.
+
+        """
+        encoded_lines = [json.dumps(line, separators=(',', ':'))
+                         for line in lines]
+        size = sum(imap(len, encoded_lines)) + len(packed or '')
+        if size > self.max_size:
+            return
+        while self.size + size > self.max_size:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+        self._entries[key] = encoded_lines, packed, size
+        self.size += size
+
+
+# What a worker hands back when it fails while swallow_exc is on:
+ChunkFailure = namedtuple('ChunkFailure',
+                          ['formatted_tb', 'type', 'value', 'path'])
+
+# What a worker hands back when it succeeds: the paths it indexed, the time
+# spent on each file extension, as a dict of extension -> [seconds, bytes,
+# number of files], and a Profile, if we're profiling
+ChunkResult = namedtuple('ChunkResult', ['paths', 'timings', 'profile'])
 
 
 def index_chunk(tree,
@@ -557,92 +1417,805 @@ def index_chunk(tree,
                 paths,
                 index,
                 swallow_exc=False,
-                worker_number=None):
+                worker_number=None,
+                profile=False,
+                record_progress=False):
     """Index a pile of files.
 
     This is the entrypoint for indexer pool workers.
 
+    Return a :class:`ChunkResult`. If something goes wrong and
+    ``swallow_exc`` is on, return a :class:`ChunkFailure` instead.
+
+    :arg tree_indexers: A list of TreeToIndexes or, to save re-sending them
+        to a worker process with every chunk, a :class:`PickledTreeIndexers`
     :arg worker_number: A unique number assigned to this worker so it knows
         what to call its log file
+    :arg profile: Whether to record a :class:`~dxr.profiling.Profile` of the
+        time spent in each plugin and stage
+    :arg record_progress: Whether to add each file to the build's
+        :class:`Checkpoint` as soon as its docs are all in ES, so a resumed
+        build can skip it even if the chunk as a whole fails
 
     """
     path = '(no file yet)'
+    timings = {}
+    profile = Profile() if profile else NullProfile()
     try:
+        if isinstance(tree_indexers, PickledTreeIndexers):
+            tree_indexers = tree_indexers.load()
         # So we can use Flask's url_from():
         with make_app(tree.config).test_request_context():
             es = current_app.es
+            progress = None
             try:
                 # Don't log if single-process:
                 log = (worker_number and
                        open_log(tree.log_folder,
                                 'index-chunk-%s.log' % worker_number))
-                for path in paths:
-                    log and log.write('Starting %s.\n' % path)
-                    index_file(tree, tree_indexers, path, es, index)
+                if record_progress:
+                    progress = open(join(tree.temp_folder,
+                                         WORKER_PATHS_FILE % (gethostname(),
+                                                              os.getpid())),
+                                    'a')
+
+                def record_sent():
+                    """Add the files whose docs are all in ES so far to my
+                    part of the checkpoint."""
+                    sent = sender.sent()
+                    if progress and sent:
+                        progress.writelines(
+                            json.dumps(relpath(p, tree.source_folder)) + '\n'
+                            for p in sent)
+                        progress.flush()  # in case we die soon
+                line_doc_cache = LineDocCache.for_index(index)
+                # Send to ES in a background thread so we can go on
+                # computing the next file's docs in the meantime:
+                config = tree.config
+                sender = BulkSender(es,
+                                    index,
+                                    doc_type=LINE,
+                                    min_size=config.es_bulk_min_size,
+                                    max_size=config.es_bulk_max_size,
+                                    target_latency=config.es_bulk_latency)
+                with sender:
+                    for path in paths:
+                        log and log.write('Starting %s.\n' % path)
+                        start = time()
+                        profile.call(FRAMEWORK, 'index_file', index_file,
+                                     tree, tree_indexers, path, es, sender,
+                                     profile=profile,
+                                     line_doc_cache=line_doc_cache)
+                        sender.mark(path)
+                        record_sent()
+                        elapsed = time() - start
+                        profile.add_file(path, elapsed)
+                        timing = timings.setdefault(extension(path),
+                                                    [0, 0, 0])
+                        timing[0] += elapsed
+                        timing[1] += file_size(path)
+                        timing[2] += 1
+                record_sent()
+                # This overlaps the rest, so it doesn't count toward the total:
+                profile.add(FRAMEWORK, 'bulk (background)',
+                            sender.seconds_sending, 0, sender.requests)
                 log and log.write('Finished chunk.\n')
             finally:
                 log and log.close()
+                progress and progress.close()
     except Exception as exc:
         if swallow_exc:
             type, value, traceback = exc_info()
-            return format_exc(), type, value, path
+            return ChunkFailure(format_exc(), type, value, path)
         else:
             raise
+    return ChunkResult(paths,
+                       timings,
+                       profile if isinstance(profile, Profile) else None)
+
+
+def index_folders(tree, index, es=None):
+    """Index the folder hierarchy into ES.
+
+    This can run as a pool task alongside the file-indexing chunks, in which
+    case it makes its own connection to ES.
 
+    """
+    if es is None:
+        config = tree.config
+        es = ElasticSearch(config.es_hosts,
+                           timeout=config.es_indexing_timeout)
 
-def index_folders(tree, index, es):
-    """Index the folder hierarchy into ES."""
-    with aligned_progressbar(unignored(tree.source_folder,
-                                       tree.ignore_paths,
-                                       tree.ignore_filenames,
-                                       want_folders=True),
-                     show_eta=False,  # never even close
-                     label='Indexing folders') as folders:
-        for folder in folders:
-            rel_path = relpath(folder, tree.source_folder)
+    def docs():
+        for rel_path in source_manifest(tree).folders:
             superfolder_path, folder_name = split(rel_path)
-            es.index(index, FILE, {
+            yield es.index_op({
                 'path': [rel_path],  # array for consistency with non-folder file docs
                 'folder': superfolder_path,
                 'name': folder_name,
-                'is_folder': True})
+                'is_folder': True},
+                id=rel_path)
+
+    with BulkSender(es, index, doc_type=FILE) as sender:
+        for chunk in bulk_chunks(docs(),
+                                 docs_per_chunk=1000,
+                                 bytes_per_chunk=100000):
+            sender.send(chunk)
+
 
+# The per-file cost of indexing, expressed in equivalent bytes of contents, so
+# scads of tiny files don't look free:
+FILE_OVERHEAD = 2000
 
-def index_files(tree, tree_indexers, index, pool, es):
-    """Divide source files into groups, and send them out to be indexed."""
+# How many chunks to cut the work into per worker. More means less idling at
+# the end, when the last few chunks are running, but more per-chunk overhead.
+CHUNKS_PER_WORKER = 8
 
-    def path_chunks(tree):
-        """Return an iterable of worker-sized iterables of paths."""
-        return chunks(500, unignored(tree.source_folder,
-                                     tree.ignore_paths,
-                                     tree.ignore_filenames))
+# Where we leave per-extension timings for the next run, in the log folder:
+EXTENSION_COSTS_FILE = 'extension-costs.json'
 
-    index_folders(tree, index, es)
 
-    if not tree.config.workers:
-        for paths in path_chunks(tree):
-            index_chunk(tree,
-                        tree_indexers,
-                        paths,
-                        index,
-                        swallow_exc=False)
+def extension(path):
+    """Return the extension of a path, for grouping timings."""
+    return splitext(path)[1].lower()
+
+
+def file_size(path):
+    """Return the size of a file in bytes, or 0 if it's a bad symlink or
+    otherwise unstattable."""
+    try:
+        return getsize(path)
+    except OSError:
+        return 0
+
+
+def extension_weights(log_folder):
+    """Return a map of file extension -> relative cost per byte, derived from
+    the timings of a previous run left in ``log_folder``.
+
+    An extension that indexed at the average rate gets a weight of 1. Return
+    an empty map if there are no timings.
+
+    """
+    try:
+        with open(join(log_folder, EXTENSION_COSTS_FILE)) as file:
+            timings = json.load(file)
+    except (IOError, ValueError):
+        return {}
+    total_seconds = sum(seconds for seconds, _, _ in timings.itervalues())
+    total_bytes = sum(bytes + files * FILE_OVERHEAD for
+                      _, bytes, files in timings.itervalues())
+    if not total_seconds or not total_bytes:
+        return {}
+    average_rate = float(total_seconds) / total_bytes
+    return dict((ext,
+                 seconds / float(bytes + files * FILE_OVERHEAD) / average_rate)
+                for ext, (seconds, bytes, files) in timings.iteritems()
+                if seconds)
+
+
+def balanced_chunks(paths, num_chunks, weights=None, max_files=500):
+    """Divide paths into about ``num_chunks`` chunks of roughly equal
+    estimated indexing cost, and return them costliest first.
+
+    Cost is estimated from file size, scaled by per-extension ``weights``.
+    Files stay in walk order within chunks so neighbors are indexed together,
+    but a chunk is cut short when it would exceed its share of the cost, so a
+    pile of huge generated files gets spread across several chunks rather than
+    straggling in one. Handing out the costliest chunks first keeps any
+    remaining straggler from starting last.
+
+    :arg paths: An iterable of absolute paths to files
+    :arg weights: A map of extension -> relative cost, as from
+        :func:`extension_weights()`
+    :arg max_files: The most files to put in a chunk, regardless of cost
+
+    """
+    weights = weights or {}
+    costed_paths = [(path,
+                     (file_size(path) + FILE_OVERHEAD) *
+                         weights.get(extension(path), 1))
+                    for path in paths]
+    target = sum(cost for _, cost in costed_paths) / max(num_chunks, 1)
+
+    costed_chunks = []
+    chunk, chunk_cost = [], 0
+    for path, cost in costed_paths:
+        if chunk and (chunk_cost + cost > target or len(chunk) >= max_files):
+            costed_chunks.append((chunk_cost, chunk))
+            chunk, chunk_cost = [], 0
+        chunk.append(path)
+        chunk_cost += cost
+    if chunk:
+        costed_chunks.append((chunk_cost, chunk))
+    costed_chunks.sort(key=lambda (cost, chunk): cost, reverse=True)
+    return [chunk for cost, chunk in costed_chunks]
+
+
+def add_timings(total, timings):
+    """Add the per-extension timings from one :func:`index_chunk()` run into
+    a running total, and return the total."""
+    for ext, timing in timings.iteritems():
+        total[ext] = [t + u for t, u in izip(total.get(ext, [0, 0, 0]), timing)]
+    return total
+
+
+def index_files(tree, tree_indexers, index, pool, es, paths=None,
+                skip_paths=frozenset(), weights=None, profile=False,
+                checkpoint=None, folders=True, workers=None,
+                distribute=False):
+    """Divide source files into groups, and send them out to be indexed.
+
+    Return a map of extension -> the time spent on files having it, as
+    :func:`write_timings()` wants, and, if ``profile`` is truthy, a
+    :class:`~dxr.profiling.Profile` merged from all the workers' ones (or
+    else None).
+
+    :arg paths: Paths, relative to the source folder, of the files to index.
+        Default: all the ones in the :func:`source_manifest()`
+    :arg skip_paths: Paths, relative to the source folder, of files not to
+        index, generally because their docs have already been copied into
+        ``index`` from a previous build, indexed during the build, or done by
+        a build we're resuming
+    :arg weights: A map of extension -> relative cost per byte, as from
+        :func:`extension_weights()`
+    :arg checkpoint: A :class:`Checkpoint` to record finished files and
+        folders in, or None. If its folders are already done, they're skipped.
+    :arg folders: Whether to index the folders as well
+    :arg workers: How many processes ``pool`` has, if not ``workers`` from
+        the config
+    :arg distribute: Whether to hand the chunks out through a
+        :class:`ChunkQueue`, so ``dxr index-worker`` processes on other hosts
+        can help index them
+
+    """
+    if workers is None:
+        workers = tree.config.workers
+    if paths is None:
+        paths = source_manifest(tree).files
+    num_chunks = max(workers, 1) * CHUNKS_PER_WORKER
+    if distribute:
+        # We don't know how many workers will turn up:
+        num_chunks = max(num_chunks, DISTRIBUTED_CHUNKS)
+    path_chunks = balanced_chunks(
+        (join(tree.source_folder, path) for path in paths
+         if path not in skip_paths),
+        num_chunks,
+        weights=weights)
+
+    timings = {}
+    total_profile = Profile() if profile else None
+
+    def add_result(result):
+        add_timings(timings, result.timings)
+        if total_profile:
+            total_profile.merge(result.profile)
+        if checkpoint:
+            checkpoint.add_paths(relpath(path, tree.source_folder) for path in
+                                 result.paths)
+
+    record_progress = checkpoint is not None and checkpoint.persistent
+    do_folders = folders and not (checkpoint and checkpoint.done('folders'))
+    if not workers and not distribute:
+        if do_folders:
+            index_folders(tree, index, es)
+            checkpoint and checkpoint.finish('folders')
+        for paths in path_chunks:
+            add_result(index_chunk(tree,
+                                   tree_indexers,
+                                   paths,
+                                   index,
+                                   swallow_exc=False,
+                                   profile=profile,
+                                   record_progress=record_progress))
     else:
-        futures = [pool.submit(index_chunk,
-                               tree,
-                               tree_indexers,
-                               paths,
-                               index,
-                               worker_number=worker_number,
-                               swallow_exc=True)
-                   for worker_number, paths in enumerate(path_chunks(tree), 1)]
-        for future in show_progress(futures, 'Indexing files'):
-            result = future.result()
-            if result:
-                formatted_tb, type, value, path = result
-                print 'A worker failed while indexing %s:' % path
-                print formatted_tb
-                # Abort everything if anything fails:
-                raise type, value  # exits with non-zero
+        # Folders are quick; do them alongside the first chunks of files:
+        if do_folders and workers:
+            folders_future = pool.submit(full_traceback,
+                                         index_folders,
+                                         tree,
+                                         index)
+        elif do_folders:
+            index_folders(tree, index, es)
+        pickled_indexers = PickledTreeIndexers(tree_indexers, tree.temp_folder)
+        if distribute:
+            results = distributed_results(tree,
+                                          pickled_indexers,
+                                          path_chunks,
+                                          index,
+                                          pool,
+                                          workers,
+                                          profile=profile,
+                                          record_progress=record_progress)
+        else:
+            calls = ((index_chunk,
+                      (tree, pickled_indexers, paths, index),
+                      {'worker_number': worker_number,
+                       'swallow_exc': True,
+                       'profile': profile,
+                       'record_progress': record_progress})
+                     for worker_number, paths in enumerate(path_chunks, 1))
+            # Keep only a couple chunks queued per worker so a worker that
+            # finishes early grabs the next costliest one:
+            results = (future.result() for future in
+                       bounded_futures(pool, calls, workers * 2))
+        with aligned_progressbar(results,
+                                 length=len(path_chunks),
+                                 show_eta=False,  # never even close
+                                 label='Indexing files') as bar:
+            for result in bar:
+                if isinstance(result, ChunkFailure):
+                    print 'A worker failed while indexing %s:' % result.path
+                    print result.formatted_tb
+                    # Abort everything if anything fails:
+                    raise result.type, result.value  # exits with non-zero
+                add_result(result)
+        if do_folders:
+            workers and folders_future.result()
+            checkpoint and checkpoint.finish('folders')
+    return timings, total_profile
+
+
+# The fewest chunks to divide files into for a distributed build:
+DISTRIBUTED_CHUNKS = 256
+
+# Where, within the temp folder, to put the queue of chunks for a distributed
+# build:
+QUEUE_FOLDER = 'chunk-queue'
+
+# How often, in seconds, a worker vouches that it's still indexing the chunk
+# it claimed:
+VOUCH_INTERVAL = 30
+
+# How long, in seconds, a claimed chunk can go unvouched for before the master
+# decides its worker died and puts it back in the queue:
+CLAIM_TIMEOUT = 300
+
+
+class ChunkQueue(object):
+    """A queue of chunks of files to index, kept in a folder so worker
+    processes on any host that can see it can take part
+
+    Each chunk is a pickle moved, by atomic renames, from the ``todo``
+    subfolder to ``claimed`` when a worker takes it and then, as a
+    :class:`ChunkResult` or :class:`ChunkFailure`, into ``done``. While it
+    works, a worker keeps touching its claimed chunk, so a chunk that goes
+    untouched for long can be put back into ``todo`` for somebody else. A
+    ``closed`` file tells workers to stop taking chunks.
+
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self._todo, self._claimed, self._done = [
+            join(folder, sub) for sub in ['todo', 'claimed', 'done']]
+
+    @classmethod
+    def create(cls, folder):
+        """Make a new, empty queue in ``folder``, clearing out any old one."""
+        queue = cls(folder)
+        ensure_folder(folder, clean=True)
+        for sub in [queue._todo, queue._claimed, queue._done]:
+            mkdir(sub)
+        return queue
+
+    def _write(self, folder, name, obj):
+        """Pickle ``obj`` into ``folder``, atomically, so nobody sees a
+        partial one."""
+        temp_path = join(self.folder, '%s.%s.%s.tmp' % (name,
+                                                        gethostname(),
+                                                        os.getpid()))
+        with open(temp_path, 'wb') as file:
+            dump(obj, file, HIGHEST_PROTOCOL)
+        os.rename(temp_path, join(folder, name))
+
+    def put(self, number, chunk):
+        """Add a chunk to be claimed. Lower numbers get claimed first."""
+        self._write(self._todo, '%08d' % number, chunk)
+
+    def claim(self):
+        """Take the next chunk, and return its name and the chunk, or None if
+        there are none left."""
+        for name in sorted(if_raises(OSError, os.listdir, [], self._todo)):
+            try:
+                os.rename(join(self._todo, name), join(self._claimed, name))
+            except OSError:
+                continue  # Somebody else got it first.
+            self.vouch(name)
+            with open(join(self._claimed, name), 'rb') as file:
+                return name, load(file)
+
+    def vouch(self, name):
+        """Mark a claimed chunk as still being worked on."""
+        with suppress(OSError):  # It may have been requeued from under us.
+            os.utime(join(self._claimed, name), None)
+
+    def claims(self):
+        """Return a map of the names of the claimed chunks to the times,
+        by the clock of the filesystem, they were last vouched for."""
+        claims = {}
+        for name in if_raises(OSError, os.listdir, [], self._claimed):
+            with suppress(OSError):  # It may have just been finished.
+                claims[name] = os.stat(join(self._claimed, name)).st_mtime
+        return claims
+
+    def requeue(self, name):
+        """Put a claimed chunk back up for grabs."""
+        with suppress(OSError):  # It may have just been finished.
+            os.rename(join(self._claimed, name), join(self._todo, name))
+
+    def finish(self, name, result):
+        """Hand back the result of a claimed chunk."""
+        self._write(self._done, name, result)
+        with suppress(OSError):  # It may have been requeued.
+            os.remove(join(self._claimed, name))
+
+    def results(self):
+        """Return a list of (chunk name, result) for the results handed back
+        since last I was called.
+
+        A requeued chunk can come back more than once.
+
+        """
+        results = []
+        for name in sorted(os.listdir(self._done)):
+            path = join(self._done, name)
+            with open(path, 'rb') as file:
+                results.append((name, load(file)))
+            os.remove(path)
+        return results
+
+    def close(self):
+        """Tell workers not to take any more chunks."""
+        open(join(self.folder, 'closed'), 'w').close()
+
+    @property
+    def closed(self):
+        return os.path.exists(join(self.folder, 'closed'))
+
+
+def distributed_results(tree, tree_indexers, path_chunks, index, pool,
+                        workers, profile=False, record_progress=False,
+                        poll_interval=1, claim_timeout=CLAIM_TIMEOUT):
+    """Put chunks of files in a :class:`ChunkQueue` in the temp folder, and
+    yield results from whatever workers index them: ``workers`` of our own
+    from ``pool`` and any number of ``dxr index-worker`` processes.
+
+    If a chunk's worker stops vouching for it for ``claim_timeout`` seconds,
+    presumably having died, put the chunk back in the queue. Its docs have
+    deterministic IDs, so whoever indexes it next overwrites anything the
+    dead worker got partway through. Our own workers quit once the queue
+    runs dry, so start another to take it, lest nobody be left who will.
+
+    Close the queue when done, or when the caller stops listening.
+
+    :arg tree_indexers: A :class:`PickledTreeIndexers`, pickled somewhere the
+        workers can see
+
+    """
+    queue = ChunkQueue.create(join(tree.temp_folder, QUEUE_FOLDER))
+    try:
+        for number, paths in enumerate(path_chunks, 1):
+            queue.put(number,
+                      (tree_indexers, paths, index, profile, record_progress))
+        def work():
+            return pool.submit(full_traceback, work_on_queue, tree,
+                               queue.folder)
+
+        futures = [work() for _ in xrange(workers)]
+        finished = set()
+        # Claimed chunk name -> (time last vouched for, by the filesystem's
+        # clock, time we noticed that, by ours), so clock skew between hosts
+        # doesn't matter:
+        vouches = {}
+        while len(finished) < len(path_chunks):
+            results = queue.results()
+            for name, result in results:
+                if name not in finished:
+                    finished.add(name)
+                    yield result
+            for future in futures:
+                if future.done():
+                    future.result()  # Raise anything that went wrong.
+
+            now = time()
+            claims = queue.claims()
+            for name, vouched in claims.iteritems():
+                if vouches.get(name, (None,))[0] != vouched:
+                    vouches[name] = vouched, now
+                elif now - vouches[name][1] > claim_timeout:
+                    print ('Chunk %s went %ss without word from its worker. '
+                           'Requeueing it.' % (name, claim_timeout))
+                    queue.requeue(name)
+                    del vouches[name]
+                    if workers:
+                        futures.append(work())
+            for name in set(vouches) - set(claims):
+                del vouches[name]
+
+            if not results:
+                sleep(poll_interval)
+    finally:
+        queue.close()
+
+
+def work_on_queue(tree, folder, wait=False, poll_interval=1):
+    """Index chunks from the :class:`ChunkQueue` in ``folder`` until it's
+    empty.
+
+    :arg wait: Instead of stopping when the queue is empty, wait for it to
+        exist and to get chunks, and stop only once it's closed.
+
+    """
+    worker_name = '%s-%s' % (gethostname(), os.getpid())
+    queue = ChunkQueue(folder)
+    seen = False
+    while True:
+        # If the queue goes away without our seeing it closed, the master
+        # finished and cleaned up already:
+        exists = os.path.exists(folder)
+        seen = seen or exists
+        claimed = None if queue.closed else queue.claim()
+        if claimed:
+            name, (tree_indexers, paths, index, profile,
+                   record_progress) = claimed
+            # Keep vouching for the chunk from another thread, so the master
+            # knows we haven't died:
+            indexed = Event()
+            vouching = Thread(target=_vouch_until,
+                              args=(queue, name, indexed))
+            vouching.daemon = True
+            vouching.start()
+            try:
+                result = index_chunk(tree,
+                                     tree_indexers,
+                                     paths,
+                                     index,
+                                     swallow_exc=True,
+                                     worker_number='%s-%s' % (worker_name,
+                                                              name),
+                                     profile=profile,
+                                     record_progress=record_progress)
+            finally:
+                indexed.set()
+            queue.finish(name, result)
+        elif wait and not queue.closed and (exists or not seen):
+            sleep(poll_interval)
+        else:
+            return
+
+
+def _vouch_until(queue, name, event, interval=VOUCH_INTERVAL):
+    """Vouch for a claimed chunk every ``interval`` seconds until ``event``
+    is set."""
+    while not event.wait(interval):
+        queue.vouch(name)
+
+
+def write_timings(timings, log_folder):
+    """Leave the time spent on each file extension in the log folder, so the
+    next run can balance its chunks better."""
+    with open(join(log_folder, EXTENSION_COSTS_FILE), 'w') as file:
+        json.dump(timings, file)
+
+
+def build_independent_paths(paths, tree_indexers):
+    """Return the ones of ``paths`` no TreeToIndex needs the build for."""
+    return [path for path in paths
+            if not any(ti.depends_on_build(path) for ti in tree_indexers)]
+
+
+def build_during_indexing(tree, tree_indexers, index, es, workers, checkpoint,
+                          verbose=False, weights=None, profile=False,
+                          build_workers=None):
+    """Run the build command while a pool of ``workers`` processes indexes
+    the files no plugin needs the build for, recording them in
+    ``checkpoint``.
+
+    Once the build succeeds, delete the docs of any of those files it changed
+    or deleted, and forget them in ``checkpoint``, so the post-build pass
+    indexes whatever is left of them afresh. Then record the build stage as
+    finished in ``checkpoint``, and return the timings and profile of the
+    indexing, as from :func:`index_files()`, or raise whatever made the
+    indexing fail. If the build fails, finish indexing anyway, and raise
+    BuildError; a resumed build can then skip what we did.
+
+    :arg tree_indexers: The TreeToIndexes as they stand after ``pre_build``
+    :arg build_workers: How many jobs to tell the build to run, as in
+        :func:`build_tree()`
+
+    """
+    paths = build_independent_paths(
+        (path for path in walk_source(tree).files
+         if path not in checkpoint.done_paths),
+        tree_indexers)
+    # Note how the files stand, so we can tell which ones the build touches:
+    states = dict((path, file_state(join(tree.source_folder, path)))
+                  for path in paths)
+    print 'Indexing %s files not needing the build while building.' % len(paths)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Futures forks the workers at the first submit. Have that happen
+        # before the feeder thread starts, since forking while other threads
+        # run can deadlock in Python 2:
+        pool.submit(int).result()
+        # Feed the pool from a thread so the build can block this one:
+        with ThreadPoolExecutor(max_workers=1) as thread:
+            indexing = thread.submit(index_files,
+                                     tree,
+                                     tree_indexers,
+                                     index,
+                                     pool,
+                                     es,
+                                     paths=paths,
+                                     weights=weights,
+                                     profile=profile,
+                                     checkpoint=checkpoint,
+                                     folders=False,
+                                     workers=workers)
+            build_tree(tree, tree_indexers, verbose, build_workers)
+            wait([indexing])
+
+    # Workers may have recorded some of these in the checkpoint without the
+    # master's knowing, so consider them all:
+    touched = [path for path in paths if
+               file_state(join(tree.source_folder, path)) != states[path]]
+    if touched:
+        print 'Reindexing %s files the build changed.' % len(touched)
+        delete_docs(es, index, touched)
+        checkpoint.remove_paths(touched)
+    checkpoint.finish('build')
+    return indexing.result()
+
+
+def file_state(path):
+    """Return the size and mod time of a file (not following symlinks), or
+    None if it doesn't exist."""
+    try:
+        file_info = os.lstat(path)
+    except OSError:
+        return None
+    return file_info.st_size, file_info.st_mtime
+
+
+def delete_docs(es, index, paths):
+    """Delete the FILE and LINE docs of some files from an index.
+
+    Rather than lean on delete-by-query, which ES 2.0 drops, find the docs'
+    IDs with a scroll, and bulk-delete them.
+
+    :arg paths: Paths of the files, relative to the source folder
+
+    """
+    def hits():
+        for batch in chunked(paths, 1000):
+            for hit in scroll(
+                    es,
+                    index,
+                    {'query': {'filtered': {'query': {'match_all': {}},
+                                            'filter': {'terms':
+                                                           {'path': batch}}}},
+                     '_source': False}):
+                yield hit
+
+    es.refresh(index)
+    with BulkSender(es, index) as sender:
+        for chunk in bulk_chunks((es.delete_op(doc_type=hit['_type'],
+                                               id=hit['_id'])
+                                  for hit in hits()),
+                                 docs_per_chunk=1000,
+                                 bytes_per_chunk=100000):
+            sender.send(chunk)
+
+
+def deployed_index(tree, es):
+    """Return the name of the index the tree's alias currently points to, or
+    None if it isn't deployed.
+
+    Return None as well if that index was built with a different set of
+    plugins, different plugin config, or a different ``prerender`` setting,
+    since its docs wouldn't be comparable to what we'd make now.
+
+    """
+    config = tree.config
+    try:
+        frozen = es.get(config.es_catalog_index,
+                        TREE,
+                        '%s/%s' % (FORMAT, tree.name))['_source']
+    except (ElasticHttpNotFoundError, KeyError):
+        return None
+    if (frozen['enabled_plugins'] != [p.name for p in tree.enabled_plugins] or
+            frozen.get('indexing_fingerprint') != tree.indexing_fingerprint):
+        return None
+    return first(es.aliases(config.es_alias.format(format=FORMAT,
+                                                   tree=tree.name)))
+
+
+def is_unchanged(file_doc, path):
+    """Return whether the file at ``path`` still has the size and mod time
+    recorded in its FILE doc from a previous build.
+
+    Symlinks are never considered unchanged, since their targets may have
+    moved without touching them.
+
+    :arg file_doc: The _source of a FILE doc, including at least ``size`` and
+        ``modified``
+    :arg path: Absolute path to the file
+
+    """
+    if 'link' in file_doc or islink(path):
+        return False
+    try:
+        file_info = stat(path)
+    except OSError:
+        return False
+    return (file_info.st_size == file_doc['size'] and
+            datetime.fromtimestamp(file_info.st_mtime) ==
+                decode_es_datetime(file_doc['modified']))
+
+
+def copy_unchanged_docs(tree, es, index):
+    """Copy the FILE and LINE docs of files that haven't changed since the
+    deployed index was built into ``index``, and return the set of their
+    paths, relative to the source folder.
+
+    Folders aren't copied; :func:`index_folders()` is cheap and always redoes
+    them. If there's nothing deployed to copy from, copy nothing.
+
+    This takes no account of cross-file analysis: if a changed file alters
+    what a plugin would say about an unchanged one (like the callers of a
+    function), the unchanged one's docs will be stale until the next full
+    build.
+
+    """
+    old_index = deployed_index(tree, es)
+    if not old_index:
+        print 'No compatible deployed index to update. Indexing everything.'
+        return frozenset()
+
+    current_paths = set(source_manifest(tree).files)
+    file_docs = scroll(
+        es,
+        old_index,
+        {'query': {'filtered': {'query': {'match_all': {}},
+                                'filter': {'term': {'is_folder': False}}}},
+         '_source': {'include': ['path', 'size', 'modified', 'link']}},
+        doc_type=FILE)
+    with aligned_progressbar(file_docs,
+                             show_eta=False,
+                             label='Diffing files') as bar:
+        unchanged = frozenset(
+            doc['_source']['path'][0] for doc in bar if
+            doc['_source']['path'][0] in current_paths and
+            is_unchanged(doc['_source'],
+                         join(tree.source_folder, doc['_source']['path'][0])))
+
+    def hits():
+        """Yield every doc of an unchanged file, letting ES do the picking
+        so docs of changed files never leave it."""
+        for batch in chunked(unchanged, 1000):
+            for hit in scroll(
+                    es,
+                    old_index,
+                    {'query': {'filtered': {'query': {'match_all': {}},
+                                            'filter': {'terms':
+                                                           {'path': batch}}}}}):
+                yield hit
+
+    def docs():
+        """Yield bulk ops for every doc of an unchanged file."""
+        with aligned_progressbar(hits(),
+                                 show_eta=False,
+                                 label='Copying unchanged') as bar:
+            for hit in bar:
+                yield es.index_op(hit['_source'],
+                                  doc_type=hit['_type'],
+                                  id=hit['_id'])
+
+    with BulkSender(es, index) as sender:
+        for chunk in bulk_chunks(docs(),
+                                 docs_per_chunk=300,
+                                 bytes_per_chunk=10000):
+            sender.send(chunk)
+    return unchanged
 
 
 def _fill_and_write_template(jinja_env, template_name, out_path, vars):
@@ -652,8 +2225,13 @@ def _fill_and_write_template(jinja_env, template_name, out_path, vars):
     template.stream(**vars).dump(out_path, encoding='utf-8')
 
 
-def build_tree(tree, tree_indexers, verbose):
-    """Set up env vars, and run the build command."""
+def build_tree(tree, tree_indexers, verbose, workers=None):
+    """Set up env vars, and run the build command.
+
+    :arg workers: How many jobs to substitute into the build command, if not
+        ``workers`` from the config
+
+    """
 
     if not tree.build_command:
         return
@@ -666,7 +2244,9 @@ def build_tree(tree, tree_indexers, verbose):
     # Call make or whatever:
     with open_log(tree.log_folder, 'build.log', verbose) as log:
         print 'Building tree'
-        workers = max(tree.config.workers, 1)
+        if workers is None:
+            workers = tree.config.workers
+        workers = max(workers, 1)
         r = subprocess.call(
             tree.build_command.replace('$jobs', str(workers))
                               .format(workers=workers),
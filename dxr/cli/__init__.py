@@ -9,6 +9,7 @@ from dxr.cli.clean import clean
 from dxr.cli.delete import delete
 from dxr.cli.deploy import deploy
 from dxr.cli.index import index
+from dxr.cli.index_worker import index_worker
 from dxr.cli.serve import serve
 from dxr.cli.shell import shell
 from dxr.cli.utils import tree_objects, config_option, tree_names_argument
@@ -38,6 +39,7 @@ def dxr():
 
 
 dxr.add_command(index)
+dxr.add_command(index_worker)
 dxr.add_command(clean)
 dxr.add_command(delete)
 dxr.add_command(serve)
@@ -1,6 +1,6 @@
 from click import command, option
 
-from dxr.build import index_and_deploy_tree
+from dxr.build import index_and_deploy_trees
 from dxr.cli.utils import tree_objects, config_option, tree_names_argument
 
 
@@ -10,8 +10,35 @@ from dxr.cli.utils import tree_objects, config_option, tree_names_argument
         is_flag=True,
         help='Display the build logs during the build instead of only '
              'on error.')
+@option('--incremental', '-i',
+        is_flag=True,
+        help='Reindex only files whose size or modification date has '
+             'changed since the last build, copying the rest from the '
+             'currently deployed index. Cross-file analysis concerning '
+             'unchanged files may go stale.')
+@option('--profile', '-p',
+        is_flag=True,
+        help='Time each plugin and stage of file indexing, and report the '
+             'results and the slowest files. A JSON version is left in the '
+             'log folder as profile.json.')
+@option('--resume', '-r',
+        is_flag=True,
+        help='Pick up where a failed build of each tree left off, reusing '
+             'its partial index and skipping the stages and files it '
+             'finished.')
+@option('--benchmark', '-b',
+        is_flag=True,
+        help='Index into a stand-in for elasticsearch which throws the docs '
+             'away, and report the docs and bytes per second DXR produced, '
+             'along with a profile. Nothing is deployed.')
+@option('--distribute', '-d',
+        is_flag=True,
+        help='Once the build and post-build analysis are done, queue the '
+             'files up in the temp folder so `dxr index-worker` processes '
+             'on other hosts can help index them.')
 @tree_names_argument
-def index(config, verbose, tree_names):
+def index(config, verbose, incremental, profile, resume, benchmark,
+          distribute, tree_names):
     """Build indices for one or more trees.
 
     When finished, update elasticsearch aliases and the catalog index to make
@@ -19,8 +46,14 @@ def index(config, verbose, tree_names):
 
     Each of TREES is an INI section title from the config file, specifying a
     source tree to build. If none are specified, we build all trees, in the
-    order they occur in the file.
+    order they occur in the file, as many at once as the concurrent_trees
+    option allows.
 
     """
-    for tree in tree_objects(tree_names, config):
-        index_and_deploy_tree(tree, verbose=verbose)
+    index_and_deploy_trees(tree_objects(tree_names, config),
+                           verbose=verbose,
+                           incremental=incremental,
+                           profile=profile,
+                           resume=resume,
+                           benchmark=benchmark,
+                           distribute=distribute)
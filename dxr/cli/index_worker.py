@@ -0,0 +1,24 @@
+from os.path import join
+
+from click import argument, command
+
+from dxr.build import QUEUE_FOLDER, work_on_queue
+from dxr.cli.utils import tree_objects, config_option
+
+
+@command('index-worker')
+@config_option
+@argument('tree_name', metavar='TREE')
+def index_worker(config, tree_name):
+    """Help index a tree whose build was started with `dxr index
+    --distribute`.
+
+    Wait for the master to finish building and post-processing TREE, then
+    index chunks of its files into elasticsearch until there are none left.
+    Run as many of these as you like, on any hosts which see the tree's source
+    and temp folders at the same paths as the master and use the same config
+    file.
+
+    """
+    tree = tree_objects([tree_name], config)[0]
+    work_on_queue(tree, join(tree.temp_folder, QUEUE_FOLDER), wait=True)
@@ -3,7 +3,10 @@
 Please update docs/source/configuration.rst when you change this.
 
 """
+from copy import copy
 from datetime import datetime
+from hashlib import sha1
+import json
 from multiprocessing import cpu_count
 from ordereddict import OrderedDict
 from operator import attrgetter
@@ -90,6 +93,13 @@ class Config(DotSection):
         Raise ConfigError if the configuration is invalid.
 
         """
+        # A digest of the config, so caches of what's made from it, like the
+        # web app's ETags, can change along with it:
+        self.digest = sha1(
+            input.encode('utf-8') if isinstance(input, unicode) else
+            input if isinstance(input, str) else
+            json.dumps(input, sort_keys=True, default=repr)).hexdigest()
+
         schema = Schema({
             'DXR': {
                 Optional('temp_folder', default=abspath('dxr-temp-{tree}')):
@@ -109,6 +119,15 @@ class Config(DotSection):
                     And(Use(int),
                         lambda v: v >= 0,
                         error='"workers" must be a non-negative integer.'),
+                Optional('workers_during_build', default=0):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"workers_during_build" must be a non-negative '
+                              'integer.'),
+                Optional('concurrent_trees', default=1):
+                    And(Use(int),
+                        lambda v: v >= 1,
+                        error='"concurrent_trees" must be a positive integer.'),
                 Optional('skip_stages', default=[]): WhitespaceList,
                 Optional('www_root', default=''): Use(lambda v: v.rstrip('/')),
                 Optional('google_analytics_key', default=''): basestring,
@@ -119,10 +138,36 @@ class Config(DotSection):
                     basestring,
                 Optional('es_alias', default='dxr_{format}_{tree}'):
                     basestring,
+                Optional('es_bulk_min_size', default=10000):
+                    And(Use(int),
+                        lambda v: v > 0,
+                        error='"es_bulk_min_size" must be a positive '
+                              'integer.'),
+                Optional('es_bulk_max_size', default=5000000):
+                    And(Use(int),
+                        lambda v: v > 0,
+                        error='"es_bulk_max_size" must be a positive '
+                              'integer.'),
+                Optional('es_bulk_latency', default=2):
+                    And(Use(float),
+                        lambda v: v > 0,
+                        error='"es_bulk_latency" must be a positive number.'),
                 Optional('es_catalog_index', default='dxr_catalog'):
                     basestring,
                 Optional('es_catalog_replicas', default=1):
                     Use(int, error='"es_catalog_replicas" must be an integer.'),
+                Optional('catalog_cache_ttl', default=10):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"catalog_cache_ttl" must be a non-negative '
+                              'integer.'),
+                Optional('search_cache_size', default=50000000):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"search_cache_size" must be a non-negative '
+                              'integer.'),
+                Optional('cache_control', default='no-cache'):
+                    basestring,
                 Optional('max_thumbnail_size', default=20000):
                     And(Use(int),
                         lambda v: v >= 0,
@@ -133,6 +178,12 @@ class Config(DotSection):
                         lambda v: v >= 0,
                         error='"es_indexing_timeout" must be a non-negative '
                               'integer.'),
+                Optional('es_optimize_segments', default=0):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"es_optimize_segments" must be a non-negative '
+                              'integer.'),
+                Optional('es_optimize_throttle', default='20mb'): basestring,
                 Optional('es_refresh_interval', default=60):
                     Use(int, error='"es_indexing_timeout" must be an integer.')
             },
@@ -185,6 +236,19 @@ class Config(DotSection):
         del self._section['enabled_plugins']
         del self._section['disabled_plugins']
 
+    def overridden(self, **settings):
+        """Return a copy of me with some [DXR] settings replaced, and copies
+        of my trees pointing back to it. I'm left untouched.
+
+        """
+        config = copy(self)
+        config._section = merge(self._section, settings)
+        config.trees = OrderedDict()
+        for name, tree in self.trees.iteritems():
+            config.trees[name] = copy(tree)
+            config.trees[name].config = config
+        return config
+
 
 class TreeConfig(DotSectionWrapper):
     def __init__(self, name, unvalidated_tree, sections, config):
@@ -217,6 +281,8 @@ class TreeConfig(DotSectionWrapper):
             Optional('source_encoding', default='utf-8'): basestring,
             Optional('temp_folder', default=None): AbsPath,
             Optional('p4web_url', default='http://p4web/'): basestring,
+            Optional('prerender', default=False): Boolean,
+            Optional('warmup_queries', default=[]): NewlineList,
             Optional(basestring): dict})
         tree = schema.validate(unvalidated_tree)
 
@@ -283,6 +349,28 @@ class TreeConfig(DotSectionWrapper):
         """Return ``self.temp_folder`` with the tree name subbed in."""
         return self.config.temp_folder.format(tree=self.name)
 
+    @property
+    def indexing_fingerprint(self):
+        """Return a hash of the settings that affect what goes into the
+        tree's docs: prerendering, the source encoding, and the enabled
+        plugins and their sections.
+
+        Docs from an index built under a different fingerprint aren't fit to
+        copy into a new one.
+
+        """
+        settings = {
+            'prerender': self.prerender,
+            'source_encoding': self.source_encoding,
+            'plugins': [(p.name, self._section.get(p.name)) for p in
+                        self.enabled_plugins]}
+        return sha1(json.dumps(
+            settings,
+            sort_keys=True,
+            # Compiled regexes, like buglink's, by their patterns:
+            default=lambda value: getattr(value, 'pattern', repr(value))
+        )).hexdigest()
+
 
 class ListAndAll(list):
     """A list we can also store an ``all`` attr on, indicating whether it
@@ -322,6 +410,18 @@ WhitespaceList = And(basestring,
                      error='This should be a whitespace-separated list.')
 
 
+NewlineList = And(basestring,
+                  Use(lambda value: [line.strip() for line in
+                                     value.splitlines() if line.strip()]),
+                  error='This should be a list of lines.')
+
+
+Boolean = And(Use(lambda value: {'true': True, 'false': False}.get(
+                  str(value).strip().lower(), value)),
+              bool,
+              error='This should be "true" or "false".')
+
+
 # Turn a filesystem path into an absolute one so changing the working
 # directory doesn't keep us from finding them.
 AbsPath = And(basestring, Use(abspath), error='This should be a path.')
@@ -1,7 +1,18 @@
 """Elasticsearch utilities not general enough to lift into pyelasticsearch"""
 
+from collections import deque
+from functools import partial
+from itertools import izip
+import json
+from Queue import Queue
+from sys import exc_info
+from threading import Lock, Thread
+from time import sleep, time
+
 from flask import current_app
-from pyelasticsearch import ElasticHttpNotFoundError
+from ordereddict import OrderedDict
+from pyelasticsearch import (ElasticHttpNotFoundError, ElasticHttpError,
+                             BulkError, Timeout, ConnectionError)
 from werkzeug.exceptions import NotFound
 
 from dxr.config import FORMAT
@@ -28,31 +39,191 @@ UNINDEXED_LONG = {
 TREE = 'tree'  # 'tree' doctype
 
 
+class CatalogCache(object):
+    """The web app's copy of the catalog index's tree docs
+
+    A page can ask after the catalog half a dozen times, so rather than
+    making a round trip each time, we fetch the whole thing at once and keep
+    it for ``ttl`` seconds. That's as long as it can take a newly deployed
+    build's catalog doc to be noticed, since it's written by another
+    process. Trees we haven't heard of are looked for right away, though.
+
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._trees = None
+        self._fetched = 0
+
+    def trees(self, max_age=None):
+        """Return an OrderedDict of tree names to tree docs of the current
+        format version, in order by name.
+
+        :arg max_age: How many seconds old a copy will do, if not ``ttl``
+
+        """
+        if max_age is None:
+            max_age = self.ttl
+        now = time()
+        if self._trees is None or now - self._fetched >= max_age:
+            try:
+                docs = filtered_query(current_app.dxr_config.es_catalog_index,
+                                      TREE,
+                                      filter={'format': FORMAT},
+                                      sort=['name'],
+                                      size=10000)
+                trees = OrderedDict((doc['name'], doc) for doc in docs)
+            except ElasticHttpNotFoundError:  # No tree has been deployed.
+                trees = OrderedDict()
+            # Replace both at once, for other threads' sake:
+            self._trees, self._fetched = trees, now
+        return self._trees
+
+
+class SearchCache(object):
+    """A least-recently-used cache of search responses, shared among the web
+    app's threads
+
+    DXR indices never change once built, so responses are keyed by the
+    concrete index behind a tree's alias rather than the alias itself. When
+    a new build is deployed, its catalog doc names a new index, and the old
+    entries simply age out.
+
+    """
+    def __init__(self, max_size):
+        """
+        :arg max_size: How many bytes of responses, as JSON, to keep. 0
+            means not to cache anything.
+
+        """
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (response, size)
+        self._lock = Lock()
+
+    def searcher(self, es, alias, index=None):
+        """Return a callable like ``es.search``, bound to ``alias``, which
+        serves repeated searches from the cache.
+
+        :arg index: The concrete index ``alias`` points to, or None if the
+            catalog doesn't say, in which case nothing is cached
+
+        """
+        search = partial(es.search, index=alias)
+        if not index or not self.max_size:
+            return search
+
+        def cached_search(query, doc_type=None):
+            key = self._key(index, query, doc_type)
+            response = self.get(key)
+            if response is None:
+                response = search(query, doc_type=doc_type)
+                self._put_response(key, response)
+            return response
+        return cached_search
+
+    def multi_searcher(self, es, alias, index=None):
+        """Return a callable like :func:`multi_search()`, bound to ``es``
+        and ``alias``, which serves what it can from the cache and sends the
+        rest all at once.
+
+        :arg index: As in :meth:`searcher()`
+
+        """
+        search = partial(multi_search, es, alias)
+        if not index or not self.max_size:
+            return search
+
+        def cached_multi_search(searches):
+            keys = [self._key(index, query, doc_type)
+                    for query, doc_type in searches]
+            responses = [self.get(key) for key in keys]
+            misses = [i for i, response in enumerate(responses)
+                      if response is None]
+            for i, response in izip(misses,
+                                    search([searches[i] for i in misses])):
+                responses[i] = response
+                self._put_response(keys[i], response)
+            return responses
+        return cached_multi_search
+
+    @staticmethod
+    def _key(index, query, doc_type):
+        return index, json.dumps(query, sort_keys=True), doc_type
+
+    def _put_response(self, key, response):
+        self.put(key, response, len(json.dumps(response)))
+
+    def get(self, key):
+        """Return the cached response for ``key``, or None.
+
+        Callers share the response, so they mustn't modify it.
+
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry  # Move it to the recent end.
+            return entry[0]
+
+    def put(self, key, response, size):
+        """Cache a response, evicting the least recently used ones to keep
+        within ``max_size``."""
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:  # Another thread beat us to it.
+                return
+            while self.size + size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+            self._entries[key] = response, size
+            self.size += size
+
+
+def multi_search(es, index, searches):
+    """Run several searches of an index in one round trip, and return their
+    responses in order.
+
+    Raise :class:`~pyelasticsearch.ElasticHttpError` if any of them fails.
+
+    :arg searches: A list of (query, doc type) pairs
+
+    """
+    if not searches:
+        return []
+    body = ''.join('%s\n%s\n' % (json.dumps({'type': doc_type}),
+                                  json.dumps(query))
+                   for query, doc_type in searches)
+    responses = es.send_request('GET', [index, '_msearch'], body)['responses']
+    for response in responses:
+        if 'error' in response:
+            raise ElasticHttpError(response.get('status', 500),
+                                   response['error'])
+    return responses
+
+
 def frozen_configs():
     """Return a list of dicts, each describing a tree of the current format
     version."""
-    return filtered_query(current_app.dxr_config.es_catalog_index,
-                          TREE,
-                          filter={'format': FORMAT},
-                          sort=['name'],
-                          size=10000)
+    return current_app.catalog.trees().values()
 
 
 def frozen_config(tree_name):
     """Return the bits of config that are "frozen" in place upon indexing.
 
     Return the ES "tree" doc for the given tree at the current format
-    version. Raise NotFound if the tree
+    version. Raise NotFound if the tree isn't in the catalog.
 
     """
-    try:
-        frozen = current_app.es.get(current_app.dxr_config.es_catalog_index,
-                                    TREE,
-                                    '%s/%s' % (FORMAT, tree_name))
-        return frozen['_source']
-    except (ElasticHttpNotFoundError, KeyError):
-        # If nothing is found, we still get a hash, but it has no _source key.
-        raise NotFound('No such tree as %s' % tree_name)
+    catalog = current_app.catalog
+    frozen = catalog.trees().get(tree_name)
+    if frozen is None:
+        # It may have been deployed since we last looked:
+        frozen = catalog.trees(max_age=0).get(tree_name)
+        if frozen is None:
+            raise NotFound('No such tree as %s' % tree_name)
+    return frozen
 
 
 def es_alias_or_not_found(tree):
@@ -74,6 +245,17 @@ def filtered_query(*args, **kwargs):
 
 def filtered_query_hits(index, doc_type, filter, sort=None, size=1, include=None, exclude=None):
     """Do a simple, filtered term query, returning an iterable of hit hashes."""
+    return current_app.es.search(
+        filtered_query_body(filter, sort=sort, include=include,
+                            exclude=exclude),
+        index=index,
+        doc_type=doc_type,
+        size=size)['hits']['hits']
+
+
+def filtered_query_body(filter, sort=None, include=None, exclude=None):
+    """Return the body of a simple, filtered term query, for when it's to be
+    sent some other way, like by :func:`multi_search()`."""
     query = {
             'query': {
                 'filtered': {
@@ -92,11 +274,7 @@ def filtered_query_hits(index, doc_type, filter, sort=None, size=1, include=None
         query['_source'] = {'include': include}
     elif exclude is not None:
         query['_source'] = {'exclude': exclude}
-    return current_app.es.search(
-        query,
-        index=index,
-        doc_type=doc_type,
-        size=size)['hits']['hits']
+    return query
 
 
 def create_index_and_wait(es, index, settings=None):
@@ -108,6 +286,239 @@ def create_index_and_wait(es, index, settings=None):
               timeout='5m')
 
 
+def scroll(es, index, query, doc_type=None, size=500, timeout='5m'):
+    """Yield every hit matching ``query``, paging through them with a scan.
+
+    This is for walking entire indices during indexing, not for anything
+    request-time: results come back in no particular order.
+
+    :arg size: The number of hits to fetch per shard per round trip
+    :arg timeout: How long ES should keep the scroll context alive between
+        round trips
+
+    """
+    response = es.send_request(
+        'GET',
+        [index, doc_type, '_search'],
+        query,
+        query_params={'search_type': 'scan', 'scroll': timeout, 'size': size})
+    while True:
+        response = es.send_request('GET',
+                                   ['_search', 'scroll'],
+                                   response['_scroll_id'],
+                                   query_params={'scroll': timeout})
+        hits = response['hits']['hits']
+        if not hits:
+            break
+        for hit in hits:
+            yield hit
+
+
+# The HTTP status ES uses when its bulk queue is full:
+TOO_MANY_REQUESTS = 429
+
+
+class BulkSender(object):
+    """A background thread which sends bulk requests to ES while the caller
+    goes on computing the next ones
+
+    Use me as a context manager. Leaving the block sends anything still
+    buffered, waits for outstanding requests to finish, and re-raises anything
+    that went wrong sending them.
+
+    Either hand me ready-made chunks of actions with :meth:`send()` or feed me
+    actions one at a time with :meth:`add()`, calling :meth:`flush()`
+    whenever I'm :attr:`full`. In the latter case, the size of the requests
+    adapts to how ES is coping: a request that comes back in under half of
+    ``target_latency`` makes the next ones half again as big, and one that
+    takes longer than that or has to be retried halves them, all within
+    ``min_size`` and ``max_size``.
+
+    Requests that time out, can't connect, or are turned away because ES's
+    bulk queue is full are retried with exponential backoff. ES may already
+    have applied a request that timed out on our end, so give every action
+    an ID, lest a retry index it twice. Meanwhile,
+    :meth:`send()` blocks once ``max_in_flight`` requests are waiting, so a
+    struggling cluster slows indexing down rather than letting requests pile
+    up in RAM.
+
+    To learn when some piece of work is safely in ES, call :meth:`mark()`
+    after adding its last action. :meth:`sent()` hands the mark back once all
+    the actions before it have been sent.
+
+    After the block, ``seconds_sending`` holds the total time the thread spent
+    on requests, and ``requests`` holds how many chunks it sent.
+
+    """
+    def __init__(self, es, index, doc_type=None, max_in_flight=2, retries=6,
+                 backoff=1, min_size=10000, max_size=10000, target_latency=2):
+        """
+        :arg index: The index to send to
+        :arg doc_type: The default doc type of the actions sent
+        :arg max_in_flight: The most chunks to hold queued before blocking
+        :arg retries: How many times to retry a chunk before giving up
+        :arg backoff: The seconds to wait before the first retry. Each later
+            one waits twice as long as the last.
+        :arg min_size: The smallest size, in bytes of actions, the buffer of
+            :meth:`add()` adapts down to. It starts here.
+        :arg max_size: The largest size it adapts up to
+        :arg target_latency: The seconds a request should take
+
+        """
+        self._es = es
+        self._path = [index, doc_type, '_bulk']
+        self._retries = retries
+        self._backoff = backoff
+        self._queue = Queue(maxsize=max_in_flight)
+        self._exc_info = None
+        self._buffer = []
+        self._buffer_size = 0
+        self._marks = []  # marks made since the last flush
+        self._sent = deque()  # marks whose actions have been sent
+        self._min_size = min_size
+        self._max_size = max(max_size, min_size)
+        self._target_latency = target_latency
+        # Written by the sending thread, read by the adding one:
+        self.target_size = min_size
+        self.seconds_sending = 0
+        self.requests = 0
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None and (self._buffer or self._marks):
+            self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        if type is None:
+            self._raise_if_failed()
+
+    def send(self, actions, marks=()):
+        """Queue a chunk of bulk actions, JSON-encoded as by
+        ``ElasticSearch.index_op()``, for sending.
+
+        :arg marks: Marks for :meth:`sent()` to return once the chunk has been
+            sent
+
+        """
+        self._raise_if_failed()
+        self._queue.put((actions, marks))
+
+    def add(self, action):
+        """Buffer a single action, JSON-encoded as by
+        ``ElasticSearch.index_op()``, for sending with others."""
+        self._buffer.append(action)
+        self._buffer_size += len(action)
+
+    @property
+    def full(self):
+        """Whether the buffer has reached the current target size"""
+        return self._buffer_size >= self.target_size
+
+    def mark(self, mark):
+        """Note that every action added so far completes a piece of work,
+        for :meth:`sent()` to return ``mark`` once they have all been sent."""
+        self._marks.append(mark)
+
+    def sent(self):
+        """Return the marks whose actions have all been sent since last I was
+        called, in the order they were made."""
+        marks = []
+        while self._sent:
+            marks.append(self._sent.popleft())
+        return marks
+
+    def flush(self):
+        """Queue the buffered actions for sending."""
+        buffer, marks = self._buffer, self._marks
+        self._buffer, self._marks = [], []
+        self._buffer_size = 0
+        self.send(buffer, marks)
+
+    def _raise_if_failed(self):
+        if self._exc_info:
+            type, value, traceback = self._exc_info
+            raise type, value, traceback
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            actions, marks = chunk
+            # After a failure, just drain the queue:
+            if actions and not self._exc_info:
+                start = time()
+                try:
+                    retried = self._send(actions)
+                except Exception:
+                    self._exc_info = exc_info()
+                else:
+                    self._adapt(time() - start, retried)
+                self.seconds_sending += time() - start
+                self.requests += 1
+            if not self._exc_info:
+                self._sent.extend(marks)
+
+    def _adapt(self, latency, retried):
+        """Grow or shrink the target size of requests, given how the last one
+        went."""
+        if retried or latency > self._target_latency:
+            self.target_size = max(self.target_size // 2, self._min_size)
+        elif latency < self._target_latency / 2.0:
+            self.target_size = min(self.target_size * 3 // 2, self._max_size)
+
+    def _send(self, actions):
+        """Send a chunk of actions, retrying as necessary, and return whether
+        any retrying was necessary.
+
+        If ES rejects only some of them, retry just those, lest we index the
+        rest twice.
+
+        """
+        for attempt in xrange(self._retries + 1):
+            if attempt:
+                sleep(self._backoff * 2 ** (attempt - 1))
+            try:
+                response = self._es.send_request(
+                    'POST', self._path, body='\n'.join(actions) + '\n')
+            except (Timeout, ConnectionError):
+                if attempt == self._retries:
+                    raise
+                continue
+            except ElasticHttpError as exc:
+                if (exc.status_code != TOO_MANY_REQUESTS or
+                        attempt == self._retries):
+                    raise
+                continue
+            if not response.get('errors'):
+                return attempt > 0
+
+            rejected, errors, successes = [], [], []
+            for action, item in izip(actions, response['items']):
+                status = item.values()[0].get('status', 999)
+                if status == TOO_MANY_REQUESTS:
+                    rejected.append(action)
+                elif 200 <= status < 300:
+                    successes.append(item)
+                else:
+                    errors.append(item)
+            if errors:
+                raise BulkError(errors, successes)
+            if not rejected:
+                return attempt > 0
+            if attempt == self._retries:
+                raise ElasticHttpError(TOO_MANY_REQUESTS,
+                                       '%s bulk actions were still rejected '
+                                       'after %s retries.' %
+                                       (len(rejected), self._retries))
+            actions = rejected
+
+
 def _sources(search_results):
     """Return just the _source attributes of some ES search results."""
     return [r['_source'] for r in search_results]
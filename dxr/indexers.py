@@ -72,8 +72,10 @@ class TreeToIndex(PluginConfig):
     Instances must be pickleable so as to make the journey to worker processes.
     You might also want to keep the size down. It takes on the order of 2s for
     a 150MB pickle to make its way across process boundaries, including
-    pickling and unpickling time. For this reason, we send the TreeToIndex once
-    and then have it index several files before sending it again.
+    pickling and unpickling time. For this reason, we pickle the TreeToIndex
+    once after ``post_build`` and have each worker process unpickle it only
+    the first time it needs it. A worker then uses the same instance for all
+    the files it indexes.
 
     """
     def __init__(self, plugin_name, tree, vcs_cache):
@@ -122,6 +124,23 @@ class TreeToIndex(PluginConfig):
 
         """
 
+    def depends_on_build(self, path):
+        """Return whether my indexing of a file relies on the build.
+
+        Files for which no plugin returns True are indexed while the build
+        command runs, using the TreeToIndex as it stands after ``pre_build``,
+        and their :meth:`file_to_index()` calls come before ``post_build``
+        has been called. Other files wait for ``post_build``.
+
+        :arg path: A path to the file, relative to the tree's source folder
+
+        The default is conservatively True. The ad hoc TreeToIndex made for a
+        plugin without one of its own instead returns the opposite of its
+        ``FileToIndex`` class's :attr:`~FileToIndex.build_independent`.
+
+        """
+        return True
+
     def file_to_index(self, path, contents):
         """Return an object that provides data about a given file.
 
@@ -338,6 +357,22 @@ class FileToSkim(PluginConfig):
 class FileToIndex(FileToSkim):
     """A source of search and rendering data about one source file"""
 
+    #: Set this to True if :meth:`is_interesting()`, :meth:`refs()`,
+    #: :meth:`regions()`, :meth:`needles_by_line()`, and
+    #: :meth:`annotations_by_line()` depend only on the file's name and
+    #: contents, not where it is in the tree. If every plugin interested in a
+    #: file says so, the framework computes its line docs once per worker and
+    #: reuses them for any byte-identical copies of it with the same name,
+    #: like vendored libraries. :meth:`needles()` and :meth:`links()` are
+    #: always computed afresh, so path-dependent data belongs there.
+    path_independent = False
+
+    #: Set this to True in a plugin with no TreeToIndex of its own if its
+    #: analysis of a file needs nothing from the build, so files it alone
+    #: cares about can be indexed while the build runs. See
+    #: :meth:`TreeToIndex.depends_on_build()`.
+    build_independent = False
+
     def __init__(self, path, contents, plugin_name, tree):
         """Analyze a file or digest an analysis that happened at compile time.
 
@@ -415,6 +450,18 @@ class FileToIndex(FileToSkim):
 # Conveniences:
 
 
+class _FileToIgnore(object):
+    """A file that we don't want to bother indexing, usually due to
+    syntax errors
+
+    """
+    def is_interesting(self):
+        return False
+#: A stand-in :meth:`TreeToIndex.file_to_index()` can return for a file it
+#: has nothing to say about, without constructing a real FileToIndex
+FILE_TO_IGNORE = _FileToIgnore()
+
+
 Extent = namedtuple('Extent', ['start', 'end'])  # 0-based
 Position = namedtuple('Position', ['row', 'col'])  # col 0-based, row 1-based
 
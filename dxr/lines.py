@@ -5,6 +5,7 @@ The typical entrypoints are es_lines() and html_line().
 Within this file, "tag" means a tuple of (file-wide offset, is_start, payload).
 
 """
+from base64 import b64decode, b64encode
 import cgi
 from itertools import chain
 try:
@@ -15,6 +16,7 @@ except ImportError:
         return (d for d, s in izip(data, selectors) if s)
 import json
 from warnings import warn
+import zlib
 
 from jinja2 import Markup
 
@@ -508,22 +510,31 @@ def es_lines(tags):
 
     """
     for line in tags_per_line(tags):
-        payloads = {}
-        for pos, is_start, payload in line:
-            if is_start:
-                payloads[payload] = {'start': pos}
-            else:
-                payloads[payload]['end'] = pos
-        # Index objects are refs or regions. Regions' payloads are just
-        # strings; refs' payloads are objects. See mappings in plugins/core.py
-        yield [{'payload': payload.es(),
-                'start': pos['start'],
-                'end': pos['end']}
-               for payload, pos in payloads.iteritems()]
+        yield es_line(line)
     # tags always ends with a LINE closer, so we don't need any additional
     # yield here to catch remnants.
 
 
+def es_line(tags):
+    """Return the list of dicts :func:`es_lines()` would for a single line.
+
+    :arg tags: The tags of the line, as from :func:`tags_per_line()`
+
+    """
+    payloads = {}
+    for pos, is_start, payload in tags:
+        if is_start:
+            payloads[payload] = {'start': pos}
+        else:
+            payloads[payload]['end'] = pos
+    # Index objects are refs or regions. Regions' payloads are just
+    # strings; refs' payloads are objects. See mappings in plugins/core.py
+    return [{'payload': payload.es(),
+             'start': pos['start'],
+             'end': pos['end']}
+            for payload, pos in payloads.iteritems()]
+
+
 def html_line(text, tags, bof_offset):
     """Return a line of Markup, interleaved with the refs and regions that
     decorate it.
@@ -549,3 +560,22 @@ def html_line(text, tags, bof_offset):
         yield cgi.escape(text[up_to:])
 
     return Markup(u''.join(segments(text, tags, bof_offset)))
+
+
+def pack_rendered_lines(lines):
+    """Return a compact, compressed string, fit for an ES binary field, of a
+    file's rendered lines.
+
+    :arg lines: An iterable of (text, HTML from :func:`html_line()`, list of
+        annotations) for each line
+
+    """
+    return b64encode(zlib.compress(json.dumps(list(lines),
+                                              separators=(',', ':'))))
+
+
+def unpack_rendered_lines(packed):
+    """Return the list of (text, HTML Markup, list of annotations) packed up
+    by :func:`pack_rendered_lines()`."""
+    return [(text, Markup(html), annotations) for text, html, annotations in
+            json.loads(zlib.decompress(b64decode(packed)))]
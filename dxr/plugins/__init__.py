@@ -23,6 +23,10 @@ class AdHocTreeToIndex(TreeToIndex):
             return self._file_to_index_class(
                     path, contents, self.plugin_name, self.tree)
 
+    def depends_on_build(self, path):
+        return (self._file_to_index_class is not None and
+                not self._file_to_index_class.build_independent)
+
 
 class Plugin(object):
     """Top-level entrypoint for DXR plugins
@@ -10,6 +10,9 @@ from dxr.plugins import Plugin, AdHocTreeToIndex
 
 
 class FileToIndex(dxr.indexers.FileToIndex):
+    path_independent = True
+    build_independent = True
+
     def refs(self):
         for m in self.plugin_config.regex.finditer(self.contents):
             bug = m.group(1)
@@ -10,7 +10,7 @@ from funcy import (merge, imap, group_by, is_mapping, repeat,
 
 from dxr.filters import LINE
 from dxr.indexers import (FileToIndex as FileToIndexBase,
-                          TreeToIndex as TreeToIndexBase,
+                          FILE_TO_IGNORE, TreeToIndex as TreeToIndexBase,
                           QUALIFIED_LINE_NEEDLE, unsparsify, FuncSig)
 from dxr.lines import Ref
 from dxr.plugins.clang.condense import condense_file, condense_global
@@ -53,6 +53,14 @@ mappings = {
 }
 
 
+# Extensions of files the compiler might analyze, either as translation units
+# or as things they include. Case matters: .C and .H are C++.
+BUILD_EXTENSIONS = frozenset(
+    ['.c', '.cc', '.cpp', '.cxx', '.c++', '.m', '.mm', '.i', '.ii', '.cu',
+     '.cuh', '.s', '.h', '.hh', '.hpp', '.hxx', '.h++', '.inc', '.inl', '.ipp',
+     '.tcc', '.tpp', '.def', '.tbl'])
+
+
 class FileToIndex(FileToIndexBase):
     """C and C++ indexer using clang compiler plugin"""
 
@@ -184,6 +192,9 @@ def not_kind_getter(field, kind, condensed):
 
 
 class TreeToIndex(TreeToIndexBase):
+    # Whether post_build() has run, so the analysis is ready for every file:
+    _built = False
+
     def pre_build(self):
         self._temp_folder = os.path.join(self.tree.temp_folder,
                                          'plugins',
@@ -217,8 +228,25 @@ class TreeToIndex(TreeToIndexBase):
 
     def post_build(self):
         self._overrides, self._overriddens, self._parents, self._children = condense_global(self._temp_folder)
+        self._built = True
+
+    def depends_on_build(self, path):
+        """Guess, by extension, whether the compiler might have analyzed a
+        file, erring toward yes.
+
+        Extensions are compared caselessly, and extensionless files, which
+        may well be headers like libstdc++'s, count as C-family. Everything
+        else gets to be indexed during the build, without clang analysis.
+
+        """
+        extension = os.path.splitext(path)[1].lower()
+        return not extension or extension in BUILD_EXTENSIONS
 
     def file_to_index(self, path, contents):
+        if not self._built:
+            # We're indexing a build-independent file while the build runs,
+            # so there's no analysis to touch yet.
+            return FILE_TO_IGNORE
         return FileToIndex(path,
                            contents,
                            self.plugin_name,
@@ -0,0 +1,5 @@
+#include "widget"
+
+int main(int argc, char* argv[]) {
+    return grow(argc);
+}
@@ -0,0 +1,15 @@
+"""Tests for indexing files while the build runs"""
+
+from dxr.testing import DxrInstanceTestCase
+
+
+class BuildOverlapTests(DxrInstanceTestCase):
+    def test_extensionless_header(self):
+        """An extensionless header should wait for the build, not be indexed
+        alongside it without clang analysis."""
+        self.found_line_eq('function:grow',
+                           'int <b>grow</b>(int size) {',
+                           1)
+        self.found_line_eq('callers:grow',
+                           'return <b>grow(argc)</b>;',
+                           4)
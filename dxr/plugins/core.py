@@ -88,6 +88,10 @@ mappings = {
                 'type': 'binary',
                 'index': 'no'
             },
+            'rendered': {  # present only if the tree is prerendered
+                'type': 'binary',
+                'index': 'no'
+            },
             'is_binary': { # assumed False if not present
                 'type': 'boolean',
                 'index': 'no'
@@ -420,12 +424,18 @@ class TreeToIndex(dxr.indexers.TreeToIndex):
         vars['build_folder'] = self.tree.object_folder
         return vars
 
+    def depends_on_build(self, path):
+        return False
+
     def file_to_index(self, path, contents):
         return FileToIndex(path, contents, self.plugin_name, self.tree,
                            self.vcs_cache.vcs_for_path(path))
 
 
 class FileToIndex(dxr.indexers.FileToIndex):
+    # Only needles() and links() care about the path or VCS.
+    path_independent = True
+
     def __init__(self, path, contents, plugin_name, tree, vcs):
         super(FileToIndex, self).__init__(path, contents, plugin_name, tree)
         self.vcs = vcs
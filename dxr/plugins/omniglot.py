@@ -8,6 +8,9 @@ from os.path import relpath
 import dxr.indexers
 
 class TreeToIndex(dxr.indexers.TreeToIndex):
+    def depends_on_build(self, path):
+        return False
+
     def file_to_index(self, path, contents):
         return FileToIndex(path,
                            contents,
@@ -101,6 +101,9 @@ def _regions_for_contents(lexer, contents):
 class FileToIndex(dxr.indexers.FileToIndex):
     """Emitter of CSS classes for syntax-highlit regions"""
 
+    path_independent = True
+    build_independent = True
+
     def regions(self):
         lexer = _lexer_for_filename(basename(self.path))
         if lexer:
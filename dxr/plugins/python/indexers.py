@@ -1,13 +1,14 @@
 import ast
 import token
 import tokenize
-from os.path import islink
+from os.path import islink, join
 from StringIO import StringIO
 
-from dxr.build import unignored
+from dxr.build import source_manifest
 from dxr.filters import FILE, LINE
 from dxr.indexers import (Extent, FileToIndex as FileToIndexBase,
-                          iterable_per_line, Position, split_into_lines,
+                          FILE_TO_IGNORE, iterable_per_line, Position,
+                          split_into_lines,
                           TreeToIndex as TreeToIndexBase,
                           QUALIFIED_FILE_NEEDLE, QUALIFIED_LINE_NEEDLE,
                           with_start_and_end)
@@ -40,21 +41,11 @@ mappings = {
 }
 
 
-class _FileToIgnore(object):
-    """A file that we don't want to bother indexing, usually due to
-    syntax errors.
-
-    """
-    def is_interesting(self):
-        return False
-FILE_TO_IGNORE = _FileToIgnore()
-
-
 class TreeToIndex(TreeToIndexBase):
     @property
     def unignored_files(self):
-        return unignored(self.tree.source_folder, self.tree.ignore_paths,
-                         self.tree.ignore_filenames)
+        return [join(self.tree.source_folder, path) for path in
+                source_manifest(self.tree).files]
 
     def post_build(self):
         paths = ((path, self.tree.source_encoding)
@@ -64,8 +55,16 @@ class TreeToIndex(TreeToIndexBase):
             source_folder=self.tree.source_folder,
             paths=paths)
 
+    def depends_on_build(self, path):
+        # Only the .py files go into the whole-tree analysis post_build()
+        # does.
+        return is_interesting(path)
+
     def file_to_index(self, path, contents):
-        if path in self.tree_analysis.ignore_paths:
+        # Check is_interesting() first, since other files may come through
+        # here before post_build() has made the tree analysis.
+        if (not is_interesting(path) or
+                path in self.tree_analysis.ignore_paths):
             return FILE_TO_IGNORE
         else:
             return FileToIndex(path, contents, self.plugin_name, self.tree,
@@ -9,6 +9,9 @@ url_re = re.compile(r"https?://[A-Za-z0-9\-\._~:\/\?#[\]@!\$&'()*\+,;=%]+\.[A-Za
 
 
 class FileToIndex(dxr.indexers.FileToIndex):
+    path_independent = True
+    build_independent = True
+
     def refs(self):
         for m in url_re.finditer(self.contents):
             url = m.group(0)
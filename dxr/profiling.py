@@ -0,0 +1,265 @@
+"""Timing of the stages of indexing, for ``dxr index --profile`` and
+``--benchmark``"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from heapq import nlargest
+import json
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+from time import clock, time
+from urlparse import urlparse
+
+from dxr.utils import format_number
+
+
+# The pseudo-plugin name under which we file DXR's own stages:
+FRAMEWORK = 'dxr'
+
+
+class Profile(object):
+    """Wall and CPU time spent in each stage of each plugin, plus the total
+    time spent on each file
+
+    Times are exclusive: while a stage is timed inside another one, the
+    inner stage's time is not counted toward the outer. That way, lazily
+    consumed plugin output, like the refs pulled through
+    :func:`~dxr.lines.finished_tags()`, is charged to the plugin that made
+    it, and the stages add up to the total.
+
+    CPU time is that of the whole process, so it includes anything a
+    background thread, like the bulk sender's, does concurrently.
+
+    Profiles are pickleable so workers can send theirs to the master to be
+    merged.
+
+    """
+    def __init__(self):
+        # (plugin name, stage) -> [wall seconds, CPU seconds, calls]:
+        self.stages = {}
+        # path -> wall seconds:
+        self.files = {}
+        # For each currently running timer, [wall, CPU] spent in timers
+        # nested within it:
+        self._nested = []
+
+    def call(self, plugin, stage, callable, *args, **kwargs):
+        """Call ``callable``, charging its time to ``stage`` of ``plugin``,
+        and return its return value."""
+        start_wall, start_cpu = time(), clock()
+        self._nested.append([0, 0])
+        try:
+            return callable(*args, **kwargs)
+        finally:
+            nested_wall, nested_cpu = self._nested.pop()
+            wall, cpu = time() - start_wall, clock() - start_cpu
+            self.add(plugin, stage, wall - nested_wall, cpu - nested_cpu)
+            if self._nested:
+                self._nested[-1][0] += wall
+                self._nested[-1][1] += cpu
+
+    def iterate(self, plugin, stage, callable, *args, **kwargs):
+        """Call ``callable``, and iterate over what it returns, charging the
+        time of both the call and each step of the iteration to ``stage`` of
+        ``plugin``."""
+        iterator = iter(self.call(plugin, stage, callable, *args, **kwargs))
+        while True:
+            try:
+                yield self.call(plugin, stage, next, iterator)
+            except StopIteration:
+                return
+
+    def add(self, plugin, stage, wall, cpu, calls=1):
+        """Charge some time to ``stage`` of ``plugin`` directly."""
+        totals = self.stages.setdefault((plugin, stage), [0, 0, 0])
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += calls
+
+    def add_file(self, path, wall):
+        """Record the total time spent indexing a file."""
+        self.files[path] = self.files.get(path, 0) + wall
+
+    def merge(self, other):
+        """Add another Profile's times into mine, and return myself."""
+        for (plugin, stage), (wall, cpu, calls) in other.stages.iteritems():
+            self.add(plugin, stage, wall, cpu, calls)
+        for path, wall in other.files.iteritems():
+            self.add_file(path, wall)
+        return self
+
+    def slowest_files(self, count):
+        """Return a list of (path, wall seconds) of the slowest files,
+        slowest first."""
+        return nlargest(count, self.files.iteritems(), key=lambda (p, w): w)
+
+    def report(self, num_files=20):
+        """Return a human-readable table of the stages, slowest first, and
+        the slowest files."""
+        rows = sorted(self.stages.iteritems(),
+                      key=lambda (key, (wall, cpu, calls)): wall,
+                      reverse=True)
+        lines = ['%-12s %-24s %12s %12s %12s' %
+                 ('Plugin', 'Stage', 'Wall (s)', 'CPU (s)', 'Calls')]
+        lines.extend('%-12s %-24s %12.2f %12.2f %12s' %
+                     (plugin, stage, wall, cpu, format_number(calls))
+                     for (plugin, stage), (wall, cpu, calls) in rows)
+        lines.append('')
+        lines.append('Slowest files (wall seconds):')
+        lines.extend('%10.2f  %s' % (wall, path) for path, wall in
+                     self.slowest_files(num_files))
+        return '\n'.join(lines)
+
+    def as_json(self, num_files=100):
+        """Return a JSON-serializable representation of the stages and the
+        slowest files."""
+        return {
+            'stages': [{'plugin': plugin,
+                        'stage': stage,
+                        'wall': wall,
+                        'cpu': cpu,
+                        'calls': calls}
+                       for (plugin, stage), (wall, cpu, calls) in
+                       sorted(self.stages.iteritems(),
+                              key=lambda (key, (wall, cpu, calls)): wall,
+                              reverse=True)],
+            'slowest_files': [{'path': path, 'wall': wall} for path, wall in
+                              self.slowest_files(num_files)]}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_nested'] = []
+        return state
+
+
+class NullProfile(object):
+    """A Profile workalike which just calls things, for when we aren't
+    profiling"""
+
+    def call(self, plugin, stage, callable, *args, **kwargs):
+        return callable(*args, **kwargs)
+
+    def iterate(self, plugin, stage, callable, *args, **kwargs):
+        return callable(*args, **kwargs)
+
+    def add(self, plugin, stage, wall, cpu, calls=1):
+        pass
+
+    def add_file(self, path, wall):
+        pass
+
+
+class NullElasticSearch(ThreadingMixIn, HTTPServer):
+    """An HTTP server which passes for elasticsearch well enough to index
+    into, counting the docs and bytes of bulk requests and throwing them away
+
+    Run it in the master process as a context manager, and point the tree's
+    ``es_hosts`` at :attr:`url`. Worker processes then talk to it just as they
+    would to a real cluster, so everything DXR does, down to encoding the
+    requests, is measured, but elasticsearch's ingest costs nothing.
+
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _NullHandler)
+        self.url = 'http://127.0.0.1:%s/' % self.server_address[1]
+        # kind of doc -> [docs, bytes]:
+        self.counts = {}
+        self.requests = 0
+        # When the first and last bulk requests came in:
+        self.first_bulk = self.last_bulk = None
+        self._lock = Lock()
+
+    def __enter__(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+        self.server_close()
+
+    def count_bulk(self, default_type, body):
+        """Tally the docs in the body of a bulk request."""
+        counts = {}
+        lines = body.splitlines()
+        for action, doc in zip(lines[::2], lines[1::2]):
+            meta = json.loads(action).values()[0]
+            kind = meta.get('_type', default_type)
+            # Folders are FILE docs too, but they'd skew the files/s:
+            if kind == 'file' and json.loads(doc).get('is_folder'):
+                kind = 'folder'
+            totals = counts.setdefault(kind, [0, 0])
+            totals[0] += 1
+            totals[1] += len(action) + len(doc) + 2
+        now = time()
+        with self._lock:
+            for kind, (docs, bytes) in counts.iteritems():
+                totals = self.counts.setdefault(kind, [0, 0])
+                totals[0] += docs
+                totals[1] += bytes
+            self.requests += 1
+            self.first_bulk = self.first_bulk or now
+            self.last_bulk = now
+
+    def report(self):
+        """Return a human-readable table of how many docs and bytes of each
+        kind came in, and how fast."""
+        seconds = ((self.last_bulk - self.first_bulk) if self.first_bulk
+                   else 0) or 1e-9
+        total = [sum(docs for docs, _ in self.counts.itervalues()),
+                 sum(bytes for _, bytes in self.counts.itervalues())]
+        lines = ['%s bulk requests over %.2fs of indexing:' %
+                     (format_number(self.requests), seconds),
+                 '%-12s %14s %12s %16s %14s' %
+                     ('Kind', 'Docs', 'Docs/s', 'Bytes', 'Bytes/s')]
+        lines.extend('%-12s %14s %12s %16s %14s' %
+                     (kind,
+                      format_number(docs),
+                      format_number(int(docs / seconds)),
+                      format_number(bytes),
+                      format_number(int(bytes / seconds)))
+                     for kind, (docs, bytes) in
+                     sorted(self.counts.items()) + [('total', total)])
+        return '\n'.join(lines)
+
+
+class _NullHandler(BaseHTTPRequestHandler):
+    """Answerer of just the requests indexing makes"""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, as with a real cluster
+
+    def do_request(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = [p for p in urlparse(self.path).path.split('/') if p]
+        status, response = 200, {'acknowledged': True}
+        if path[-1:] == ['_bulk']:
+            self.server.count_bulk(path[1] if len(path) == 3 else None, body)
+            response = {'took': 0, 'errors': False, 'items': []}
+        elif path[:2] == ['_cluster', 'health']:
+            response = {'status': 'green'}
+        elif path[-1:] in (['_search'], ['scroll']):
+            # There's nothing to find, whether to copy in incremental
+            # indexing or to warm up with.
+            response = {'_scroll_id': '0', 'hits': {'total': 0, 'hits': []}}
+        elif path[-1:] == ['_msearch']:
+            response = {'responses': [{'hits': {'total': 0, 'hits': []}}] *
+                                     (len(body.splitlines()) // 2)}
+        elif path[-1:] == ['_segments']:
+            response = {'indices': {}}
+        elif self.command in ('GET', 'HEAD'):
+            # There are no docs or aliases.
+            status, response = 404, {'found': False}
+        response = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(response)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = do_request
+
+    def log_message(self, format, *args):
+        pass
@@ -1,5 +1,5 @@
 import cgi
-from itertools import chain, groupby
+from itertools import chain, groupby, izip
 from operator import itemgetter
 import re
 
@@ -32,8 +32,19 @@ def direct_searchers(plugins):
 class Query(object):
     """Query object, constructor will parse any search query"""
 
-    def __init__(self, es_search, querystr, enabled_plugins, is_case_sensitive=True):
+    def __init__(self, es_search, querystr, enabled_plugins, is_case_sensitive=True,
+                 es_multi_search=None):
+        """
+        :arg es_search: A callable like ElasticSearch.search, bound to the
+            index to search
+        :arg es_multi_search: A callable which takes a list of (query, doc
+            type) pairs and returns a list of search responses, running them
+            all in one round trip, as :func:`dxr.es.multi_search()` does. If
+            None, searches that could go together are run one at a time.
+
+        """
         self.es_search = es_search
+        self.es_multi_search = es_multi_search
         self.enabled_plugins = list(enabled_plugins)
         self.is_case_sensitive = is_case_sensitive
 
@@ -85,6 +96,14 @@ class Query(object):
                    [],
                    file.get('is_binary', False))
 
+    def _multi_search(self, searches):
+        """Run a list of (query, doc type) searches, together if possible, and
+        return their responses."""
+        if self.es_multi_search:
+            return self.es_multi_search(searches)
+        return [self.es_search(query, doc_type=doc_type)
+                for query, doc_type in searches]
+
     def results(self, offset=0, limit=100):
         """Return a count of search results and, as an iterable, the results
         themselves::
@@ -97,6 +116,28 @@ class Query(object):
                          ...]}
 
         """
+        (query, doc_type), finish = self._results_search(offset, limit)
+        return finish(self.es_search(query, doc_type=doc_type))
+
+    def direct_result_and_results(self, offset=0, limit=100):
+        """Return a tuple of what :meth:`direct_result()` and
+        :meth:`results()` would, running all the searches at once.
+
+        This saves a round trip when a direct result isn't found, at the
+        cost of a wasted search when it is.
+
+        """
+        results_search, finish = self._results_search(offset, limit)
+        direct_searches = self._direct_searches()
+        responses = self._multi_search([search for search, _ in
+                                        direct_searches] + [results_search])
+        return (self._direct_result_of(direct_searches, responses[:-1]),
+                finish(responses[-1]))
+
+    def _results_search(self, offset, limit):
+        """Return the (query, doc type) of the ES search behind
+        :meth:`results()`, and a function which turns its response into the
+        return value of :meth:`results()`."""
         enabled_filters_by_name = filters_by_name(self.enabled_plugins)
 
         def group_filters_by_term(predicate):
@@ -159,21 +200,28 @@ class Query(object):
                 'match_all': {}
             }
 
-        results = self.es_search(
-            {'query': query,
-             'sort': ['path', 'number'] if is_line_query else ['path'],
-             'from': offset,
-             'size': limit},
-            doc_type=LINE if is_line_query else FILE)['hits']
-        result_count = results['total']
-        results = [r['_source'] for r in results['hits']]
-
-        path_highlighters = [f.highlight_path for f in chain.from_iterable(filters)
-                             if hasattr(f, 'highlight_path')]
-        return {'result_count': result_count,
-                'results': self._line_query_results(filters, results, path_highlighters)
-                           if is_line_query
-                           else self._file_query_results(results, path_highlighters)}
+        search = ({'query': query,
+                   'sort': ['path', 'number'] if is_line_query else ['path'],
+                   'from': offset,
+                   'size': limit},
+                  LINE if is_line_query else FILE)
+        if not is_line_query:
+            # Prerendered files' lines are big, and we don't show them here:
+            search[0]['_source'] = {'exclude': ['rendered']}
+
+        def finish(response):
+            results = response['hits']
+            result_count = results['total']
+            results = [r['_source'] for r in results['hits']]
+
+            path_highlighters = [f.highlight_path for f in chain.from_iterable(filters)
+                                 if hasattr(f, 'highlight_path')]
+            return {'result_count': result_count,
+                    'results': self._line_query_results(filters, results, path_highlighters)
+                               if is_line_query
+                               else self._file_query_results(results, path_highlighters)}
+
+        return search, finish
 
         # Test: If var-ref (or any structural query) returns 2 refs on one line, they should both get highlit.
 
@@ -184,34 +232,61 @@ class Query(object):
         line number). Line number may be None to indicate the entire file
         rather than any specific line. If no result is found, return just None.
 
+        All the direct searchers' searches go out at once, and the winner is
+        picked by priority.
+
         """
+        direct_searches = self._direct_searches()
+        return self._direct_result_of(
+            direct_searches,
+            self._multi_search([search for search, _ in direct_searches]))
+
+    def _direct_searches(self):
+        """Return a list of ((query, doc type), searcher) for each direct
+        searcher which applies to the query, in priority order."""
         term = self.single_term()
         if not term:
-            return None
+            return []
 
+        searches = []
         for searcher in direct_searchers(self.enabled_plugins):
             clause = searcher(term)
             if clause:
-                results = self.es_search(
-                    {
-                        'query': {
-                            'filtered': {
-                                'query': {
-                                    'match_all': {}
-                                },
-                                'filter': clause
-                            }
-                        },
-                        'size': 2
+                query = {
+                    'query': {
+                        'filtered': {
+                            'query': {
+                                'match_all': {}
+                            },
+                            'filter': clause
+                        }
                     },
-                    doc_type=searcher.domain)['hits']['hits']
-                if len(results) == 1:
-                    result = results[0]['_source']
-                    # Everything is stored as arrays in ES. Pull it all out:
-                    return (result['path'][0],
-                            result['number'][0] if searcher.domain == LINE else None)
-                elif len(results) > 1:
-                    return None
+                    'size': 2
+                }
+                if searcher.domain == FILE:
+                    # Prerendered files' lines are big, and we need only
+                    # the path:
+                    query['_source'] = {'exclude': ['rendered']}
+                searches.append(((query, searcher.domain), searcher))
+        return searches
+
+    def _direct_result_of(self, direct_searches, responses):
+        """Return the direct result, as from :meth:`direct_result()`, given
+        the responses to the searches from :meth:`_direct_searches()`.
+
+        The first searcher to find exactly one thing wins. One finding more
+        than that means the query is ambiguous, so nothing does.
+
+        """
+        for (_, searcher), response in izip(direct_searches, responses):
+            results = response['hits']['hits']
+            if len(results) == 1:
+                result = results[0]['_source']
+                # Everything is stored as arrays in ES. Pull it all out:
+                return (result['path'][0],
+                        result['number'][0] if searcher.domain == LINE else None)
+            elif len(results) > 1:
+                return None
 
 
 @cached
@@ -5,13 +5,19 @@ from datetime import datetime
 from errno import ENOENT
 import fnmatch
 from functools import partial, wraps
-from itertools import izip
+from itertools import chain, izip, repeat
 from os import chdir, dup, fdopen, getcwd
 from os.path import join
+import re
 from shutil import rmtree
 from sys import stdout
 
 from flask import url_for
+try:
+    # Several times faster than os.walk(), since it doesn't stat every file:
+    from scandir import walk
+except ImportError:
+    from os import walk
 
 from dxr.exceptions import CommandFailure
 
@@ -122,6 +128,40 @@ def append_by_line(dest_lists, list_per_line):
     return dest_lists
 
 
+def _padded_by_line(iterables, empty):
+    """Yield, for each line, a tuple of what each of ``iterables`` has for
+    it, padding with ``empty`` once they run out. Go on forever."""
+    padded = [chain(iterable, repeat(empty)) for iterable in iterables]
+    return izip(*padded) if padded else repeat(())
+
+
+def lazy_update_by_line(pairses_iterables):
+    """Like :func:`append_update_by_line()`, but merge several iterables of
+    per-line pairs lazily, yielding one line's mapping at a time.
+
+    That way, a huge file's worth of per-line mappings never has to be in
+    memory at once. Yield empty mappings forever once the iterables run out,
+    so zip this against something that knows how many lines there are.
+
+    """
+    for pairses in _padded_by_line(pairses_iterables, ()):
+        mapping = {}
+        for pairs in pairses:
+            append_update(mapping, pairs)
+        yield mapping
+
+
+def lazy_extend_by_line(lists_iterables):
+    """Like :func:`append_by_line()`, but merge several iterables of per-line
+    lists lazily, yielding one line's list at a time.
+
+    Yield empty lists forever once the iterables run out.
+
+    """
+    for lists in _padded_by_line(lists_iterables, ()):
+        yield list(chain.from_iterable(lists))
+
+
 def decode_es_datetime(es_datetime):
     """Turn an elasticsearch datetime into a datetime object."""
     try:
@@ -142,6 +182,20 @@ def glob_to_regex(glob):
     return fnmatch.translate(glob)[:-_FNMATCH_TRANSLATE_SUFFIX_LEN]
 
 
+def glob_matcher(globs):
+    """Return a callable that tells whether a string matches any of some
+    shell-style globs, case-sensitively, like ``fnmatchcase()``.
+
+    The globs are compiled into a single regex, which is much faster than
+    trying them one at a time.
+
+    """
+    if not globs:
+        return lambda string: False
+    return re.compile(r'(?:%s)\Z' % '|'.join(glob_to_regex(g) for g in globs),
+                      re.S).match
+
+
 def cached(f):
     """Cache the result of a function that takes an iterable of plugins."""
     # TODO: Generalize this into a general memoizer function later if needed.
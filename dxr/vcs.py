@@ -28,7 +28,7 @@ from warnings import warn
 import hglib
 from ordereddict import OrderedDict
 
-from dxr.utils import without_ending
+from dxr.utils import walk, without_ending
 
 
 class Vcs(object):
@@ -295,7 +295,7 @@ def tree_to_repos(tree):
     sources = {}
     # Find all of the VCSs in the source directory:
     # We may see multiple VCS if we use git submodules, for example.
-    for cwd, dirs, files in os.walk(tree.source_folder):
+    for cwd, dirs, files in walk(tree.source_folder):
         for vcs in every_vcs:
             attempt = vcs.claim_vcs_source(cwd, dirs, tree)
             if attempt is not None:
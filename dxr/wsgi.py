@@ -1,11 +1,17 @@
 import os
-from os.path import dirname
+from os.path import dirname, getmtime
+from threading import Lock
 
 from dxr.app import make_app
 from dxr.config import Config
 from dxr.utils import file_text
 
 
+# config path -> (modification time of the config file, app):
+_apps = {}
+_apps_lock = Lock()
+
+
 def application(environ, start_response):
     """Pull the config file path out of an env var, and then instantiate the
     WSGI app as normal.
@@ -21,6 +27,27 @@ def application(environ, start_response):
         # Not found in WSGI env. Try process env:
         # If this still fails, this is a fatal error.
         config_path = os.environ['DXR_CONFIG']
-    return make_app(Config(file_text(config_path),
-                           relative_to=dirname(config_path)))(environ,
-                                                              start_response)
+    return app_for(config_path)(environ, start_response)
+
+
+def app_for(config_path):
+    """Return the app for a config file, making it only the first time and
+    whenever the file has since changed.
+
+    Reusing the app saves revalidating the config on every request and lets
+    the ES connection pool actually be shared across requests.
+
+    """
+    modified = getmtime(config_path)
+    cached = _apps.get(config_path)
+    if cached and cached[0] == modified:
+        return cached[1]
+    with _apps_lock:
+        # Another thread may have beaten us to it:
+        cached = _apps.get(config_path)
+        if cached and cached[0] == modified:
+            return cached[1]
+        app = make_app(Config(file_text(config_path),
+                              relative_to=dirname(config_path)))
+        _apps[config_path] = modified, app
+        return app
@@ -6,9 +6,11 @@ everything else. Here are a few unit tests.
 """
 from unittest import TestCase
 
-from nose.tools import eq_
+from jinja2 import Markup
+from nose.tools import eq_, ok_
 
-from dxr.app import _linked_pathname
+from dxr.app import _linked_pathname, _browse_file, browse, make_app
+from dxr.config import Config
 
 
 class LinkedPathnameTests(TestCase):
@@ -22,3 +24,129 @@ class LinkedPathnameTests(TestCase):
     def test_root_folder(self):
         """Make sure the root folder is treated correctly."""
         eq_(_linked_pathname('', 'stuff'), [('/stuff/source', 'stuff')])
+
+
+class CatalogElasticSearch(object):
+    """An ES stand-in with one tree in its catalog"""
+
+    def search(self, query, index, doc_type, size):
+        return {'hits': {'hits': [{'_source': {
+            'name': 'code',
+            'description': '',
+            'enabled_plugins': ['core'],
+            'es_alias': 'dxr_code',
+            'generated_date': 'today'}}]}}
+
+
+def _app():
+    """Return a config with one tree, and an app around it which needs no
+    ES."""
+    config = Config('[DXR]\nenabled_plugins =\n[code]\nsource_folder = /\n')
+    app = make_app(config)
+    app.es = CatalogElasticSearch()
+    return config, app
+
+
+def test_streamed_file():
+    """Source pages should be streamed, and each line should still get its
+    number, annotations, and markup."""
+    config, app = _app()
+    with app.test_request_context('/code/source/a.c'):
+        response = _browse_file('code',
+                                'a.c',
+                                [{'content': u'int main;\n'},
+                                 {'content': u'<b>\n',
+                                  'annotations': [{'title': 'hi'}]}],
+                                {},
+                                config)
+        ok_(response.is_streamed)
+        html = response.get_data()
+    ok_('<span id="2" class="line-number" unselectable="on" rel="#2">2</span>'
+        in html)
+    ok_('<div class="annotation-set" id="aset-2"><div' in html)
+    ok_('<code id="line-2" aria-labelledby="2">&lt;b&gt;\n</code>' in html)
+
+
+def test_prerendered_file():
+    """Lines rendered at index time should be shown as they are."""
+    config, app = _app()
+    with app.test_request_context('/code/source/a.c'):
+        html = _browse_file('code',
+                            'a.c',
+                            [{'content': u'int main;\n'}],
+                            {'rendered': 'unused'},
+                            config,
+                            rendered=[(u'int main;\n',
+                                       Markup(u'<b>int</b> main;\n'),
+                                       [{'title': 'hi'}])]).get_data()
+    ok_('<code id="line-1" aria-labelledby="1"><b>int</b> main;\n</code>' in
+        html)
+    ok_('<div class="annotation-set" id="aset-1"><div' in html)
+
+
+class FileElasticSearch(CatalogElasticSearch):
+    """An ES stand-in whose tree holds a one-line file, a.c, and which keeps
+    track of the multi-searches sent to it"""
+
+    def __init__(self):
+        self.requests = []
+
+    def send_request(self, method, path_components, body):
+        self.requests.append((path_components, body.splitlines()))
+        return {'responses': [
+            {'hits': {'hits': []}},
+            {'hits': {'hits': [{'_source': {}}]}},
+            {'hits': {'hits': [{'_source': {'number': [1],
+                                            'content': [u'int main;\n']}}]}}]}
+
+
+def test_browse_one_round_trip():
+    """Showing a file should take a single request to ES, which asks about
+    the folder, the file, and all its lines at once."""
+    config, app = _app()
+    app.es = FileElasticSearch()
+    with app.test_request_context('/code/source/a.c'):
+        html = browse('code', 'a.c').get_data()
+    eq_(len(app.es.requests), 1)
+    path_components, lines = app.es.requests[0]
+    eq_(path_components, ['dxr_code', '_msearch'])
+    eq_(len(lines), 6)
+    ok_('<code id="line-1" aria-labelledby="1">int main;\n</code>' in html)
+
+
+def test_not_modified():
+    """A client already holding the current page should get a 304 without
+    our asking ES for the page again."""
+    config, app = _app()
+    app.es = FileElasticSearch()
+    client = app.test_client()
+    response = client.get('/code/source/a.c')
+    eq_(response.status_code, 200)
+    eq_(response.headers['Cache-Control'], 'no-cache')
+    etag = response.headers['ETag']
+
+    response = client.get('/code/source/a.c',
+                          headers={'If-None-Match': etag})
+    eq_(response.status_code, 304)
+    eq_(response.headers['ETag'], etag)
+    eq_(len(app.es.requests), 1)
+
+    # Other pages get other tags:
+    response = client.get('/code/source/b.c',
+                          headers={'If-None-Match': etag})
+    eq_(response.status_code, 200)
+    ok_(response.headers['ETag'] != etag)
+
+
+def test_etag_follows_config():
+    """Changing the config, which shapes every page, should change the
+    tags."""
+    def etag(config_text):
+        app = make_app(Config(config_text))
+        app.es = FileElasticSearch()
+        return app.test_client().get('/code/source/a.c').headers['ETag']
+
+    config_text = '[DXR]\nenabled_plugins =\n[code]\nsource_folder = /\n'
+    ok_(etag(config_text) !=
+        etag(config_text.replace('[DXR]\n',
+                                 '[DXR]\ngoogle_analytics_key = UA-1\n')))
@@ -0,0 +1,740 @@
+"""Unit tests for the bits of dxr.build that don't need elasticsearch"""
+
+from datetime import datetime
+import json
+from multiprocessing import Process
+import os
+from os import listdir, makedirs, remove, stat, symlink
+from os.path import dirname, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+
+from concurrent.futures import (Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from funcy import suppress
+from nose.tools import eq_, ok_
+from pyelasticsearch import ElasticSearch, ElasticHttpError
+
+from dxr.build import (is_unchanged, PickledTreeIndexers, balanced_chunks,
+                       extension_weights, EXTENSION_COSTS_FILE, unignored,
+                       walk_source, source_manifest, index_folders,
+                       index_file, LineDocCache, Checkpoint,
+                       build_independent_paths, ChunkQueue, WorkerBudget,
+                       wait_for_replicas, distributed_results, QUEUE_FOLDER,
+                       WORKER_PATHS_FILE, NullCheckpoint, delete_docs)
+from dxr.indexers import FileToIndex, FILE_TO_IGNORE
+from dxr.lines import Region, unpack_rendered_lines
+from dxr.plugins.clang.indexers import TreeToIndex as ClangTreeToIndex
+from dxr.plugins.python.indexers import TreeToIndex as PythonTreeToIndex
+
+
+class IsUnchangedTests(TestCase):
+    """Tests for the diffing behind incremental indexing"""
+
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.path = join(self.folder, 'hello.c')
+        with open(self.path, 'w') as file:
+            file.write('int main;\n')
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def _doc(self, **overrides):
+        """Return a FILE doc matching the file on disk, as ES would hand it
+        back."""
+        file_info = stat(self.path)
+        doc = {'size': file_info.st_size,
+               'modified': datetime.fromtimestamp(file_info.st_mtime)
+                                   .isoformat()}
+        doc.update(overrides)
+        return doc
+
+    def test_unchanged(self):
+        eq_(is_unchanged(self._doc(), self.path), True)
+
+    def test_size_changed(self):
+        eq_(is_unchanged(self._doc(size=2), self.path), False)
+
+    def test_modified_changed(self):
+        eq_(is_unchanged(self._doc(modified='1992-06-27T00:00:00'), self.path),
+            False)
+
+    def test_deleted(self):
+        doc = self._doc()
+        remove(self.path)
+        eq_(is_unchanged(doc, self.path), False)
+
+    def test_symlink(self):
+        """Symlinks should always be reindexed."""
+        link = join(self.folder, 'link.c')
+        symlink(self.path, link)
+        eq_(is_unchanged(self._doc(), link), False)
+
+
+class PickledTreeIndexersTests(TestCase):
+    def setUp(self):
+        self.folder = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def test_load_once(self):
+        """Make sure the indexers survive the trip through the file and are
+        unpickled only once per process."""
+        pickled = PickledTreeIndexers([{'some': 'state'}], self.folder)
+        first_load = pickled.load()
+        eq_(first_load, [{'some': 'state'}])
+        remove(pickled.path)  # A second unpickling would now fail.
+        ok_(pickled.load() is first_load)
+
+    def test_new_build_evicts(self):
+        """Loading a new build's indexers should drop the old ones."""
+        old = PickledTreeIndexers(['old'], self.folder)
+        old.load()
+        eq_(PickledTreeIndexers(['new'], self.folder).load(), ['new'])
+        ok_(old.build_id not in PickledTreeIndexers._loaded)
+
+
+class BalancedChunksTests(TestCase):
+    def setUp(self):
+        self.folder = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def _file(self, name, size):
+        path = join(self.folder, name)
+        with open(path, 'w') as file:
+            file.write('x' * size)
+        return path
+
+    def test_big_files_split_and_first(self):
+        """A pile of huge files should be spread across chunks, and the
+        costliest chunks should come first."""
+        small = [self._file('small%s.c' % i, 10) for i in xrange(20)]
+        big = [self._file('big%s.c' % i, 100000) for i in xrange(2)]
+        chunks = balanced_chunks(small + big, 3)
+        eq_(chunks[0], [big[0]])
+        eq_(chunks[1], [big[1]])
+        eq_(chunks[2], small)
+
+    def test_max_files(self):
+        paths = [self._file('%s.c' % i, 10) for i in xrange(5)]
+        eq_(balanced_chunks(paths, 1, max_files=2),
+            [paths[:2], paths[2:4], paths[4:]])
+
+    def test_weights(self):
+        """Extensions known to be slow should get chunks of their own."""
+        slow = self._file('slow.cpp', 10)
+        fast = [self._file('%s.txt' % i, 10) for i in xrange(10)]
+        eq_(balanced_chunks([slow] + fast, 2, weights={'.cpp': 10}),
+            [[slow], fast])
+
+
+def test_extension_weights():
+    """Make sure weights are relative to the average rate, including the
+    per-file overhead."""
+    folder = mkdtemp()
+    try:
+        with open(join(folder, EXTENSION_COSTS_FILE), 'w') as file:
+            json.dump({'.cpp': [3, 0, 1], '.txt': [1, 0, 1]}, file)
+        eq_(extension_weights(folder), {'.cpp': 1.5, '.txt': 0.5})
+    finally:
+        rmtree(folder)
+
+
+def test_extension_weights_missing():
+    eq_(extension_weights('/nonexistent'), {})
+
+
+class FakeTree(object):
+    """Just enough of a TreeConfig to walk"""
+
+    def __init__(self, folder):
+        self.source_folder = join(folder, 'src')
+        self.temp_folder = join(folder, 'temp')
+        self.ignore_filenames = ['*.o', '.hg']
+        self.ignore_paths = ['/build/', '/docs/old.txt']
+        self.prerender = False
+
+
+class WalkTests(TestCase):
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.tree = FakeTree(self.folder)
+        makedirs(self.tree.temp_folder)
+        for path in ['main.c', 'main.o', 'docs/old.txt', 'docs/new.txt',
+                     'build/out.c', 'lib/a/b.c', '.hg/store']:
+            full_path = join(self.tree.source_folder, path)
+            with suppress(OSError):
+                makedirs(dirname(full_path))
+            open(full_path, 'w').close()
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def test_unignored(self):
+        """Make sure both name- and path-based ignores are obeyed."""
+        source = self.tree.source_folder
+        eq_(sorted(unignored(source,
+                             self.tree.ignore_paths,
+                             self.tree.ignore_filenames)),
+            [join(source, p) for p in
+             ['docs/new.txt', 'lib/a/b.c', 'main.c']])
+        eq_(sorted(unignored(source,
+                             self.tree.ignore_paths,
+                             self.tree.ignore_filenames,
+                             want_folders=True)),
+            [join(source, p) for p in ['docs', 'lib', 'lib/a']])
+
+    def test_parallel_walk(self):
+        """Fanning out across a pool should find the same things, in the
+        same order, as walking serially."""
+        serial = walk_source(self.tree)
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            parallel = walk_source(self.tree, pool)
+        eq_(parallel.files, serial.files)
+        eq_(parallel.folders, serial.folders)
+        eq_(sorted(serial.files), ['docs/new.txt', 'lib/a/b.c', 'main.c'])
+
+    def test_manifest_cached(self):
+        """Once saved, the manifest should be reused rather than rewalked."""
+        walk_source(self.tree).save(self.tree)
+        remove(join(self.tree.source_folder, 'main.c'))
+        ok_('main.c' in source_manifest(self.tree).files)
+
+    def test_index_folders(self):
+        """Folder docs should come from the manifest and go out in bulk."""
+        class RecordingElasticSearch(ElasticSearch):
+            def send_request(self, method, path_components, body='',
+                             query_params=None):
+                requests.append((path_components, body))
+                return {'errors': False}
+
+        requests = []
+        index_folders(self.tree, 'index', RecordingElasticSearch())
+        eq_(len(requests), 1)
+        path_components, body = requests[0]
+        eq_(path_components, ['index', 'file', '_bulk'])
+        docs = [json.loads(line) for line in body.splitlines()[1::2]]
+        eq_(sorted(doc['path'] for doc in docs),
+            [['docs'], ['lib'], ['lib/a']])
+        eq_([doc['folder'] for doc in docs if doc['name'] == 'a'], ['lib'])
+
+
+class LineDocCacheTests(TestCase):
+    def test_lru(self):
+        """The least recently used entries should go first to make room."""
+        cache = LineDocCache(max_size=14)
+        cache.put('a', [{'n': 1}])  # 7 bytes of JSON
+        cache.put('b', [{'n': 2}])
+        cache.get('a')
+        cache.put('c', [{'n': 3}])
+        eq_(cache.get('b'), None)
+        lines, packed = cache.get('a')
+        eq_(list(lines), [{'n': 1}])
+        eq_(packed, None)
+        eq_(cache.size, 14)
+
+    def test_encoded_size(self):
+        """Entries should be measured by their encoded size, packed rendered
+        lines included."""
+        cache = LineDocCache(max_size=100)
+        cache.put('a', [{'n': 1}, {'n': 2}], 'packed')
+        eq_(cache.size, 7 + 7 + 6)
+        eq_(cache.get('a')[1], 'packed')
+
+    def test_too_big(self):
+        cache = LineDocCache(max_size=10)
+        cache.put('a', [{'n': 1}, {'n': 2}])
+        eq_(cache.get('a'), None)
+
+
+class RegionCounter(FileToIndex):
+    """A path-independent plugin that counts its analyses"""
+    path_independent = True
+    calls = 0
+
+    def needles(self):
+        yield 'path', self.path
+
+    def regions(self):
+        RegionCounter.calls += 1
+        yield 0, 3, Region('k')
+
+
+class FakeTreeToIndex(object):
+    plugin_name = 'counter'
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def file_to_index(self, path, contents):
+        return RegionCounter(path, contents, self.plugin_name, self.tree)
+
+
+class DedupTests(TestCase):
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.tree = FakeTree(self.folder)
+        self.tree.source_encoding = 'utf-8'
+        for path in ['a/lib.c', 'b/lib.c', 'b/other.c']:
+            full_path = join(self.tree.source_folder, path)
+            with suppress(OSError):
+                makedirs(dirname(full_path))
+            with open(full_path, 'w') as file:
+                file.write('int x;\nint y;\n')
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def _index(self, path, cache):
+        """Index a file, and return its line docs."""
+        class Sender(object):
+            full = False
+
+            def add(self, op):
+                ops.append(op)
+
+        ops = []
+        index_file(self.tree,
+                   [FakeTreeToIndex(self.tree)],
+                   join(self.tree.source_folder, path),
+                   ElasticSearch(),
+                   Sender(),
+                   line_doc_cache=cache)
+        self.ops = ops
+        return [json.loads(op.splitlines()[1]) for op in ops[:-1]]
+
+    def test_identical_copies(self):
+        """Identical files of the same name should be analyzed once, but
+        each should keep its own path-dependent fields."""
+        RegionCounter.calls = 0
+        cache = LineDocCache()
+        first_lines = self._index('a/lib.c', cache)
+        second_lines = self._index('b/lib.c', cache)
+        eq_(RegionCounter.calls, 1)
+        eq_(len(second_lines), 2)
+        eq_(second_lines[0]['regions'], first_lines[0]['regions'])
+        eq_(first_lines[0]['path'], ['a/lib.c'])
+        eq_(second_lines[0]['path'], ['b/lib.c'])
+
+        # A different name might lex differently, so it isn't shared:
+        self._index('b/other.c', cache)
+        eq_(RegionCounter.calls, 2)
+
+    def test_ids(self):
+        """Every doc should have a deterministic ID, so a retried bulk request
+        overwrites rather than duplicates it."""
+        self._index('a/lib.c', LineDocCache())
+        eq_([json.loads(op.splitlines()[0]).values()[0]['_id'] for
+             op in self.ops],
+            ['a/lib.c:1', 'a/lib.c:2', 'a/lib.c'])
+
+    def test_prerender(self):
+        """Prerendered lines should go into the FILE doc, even for copies
+        whose line docs came from the cache."""
+        self.tree.prerender = True
+        cache = LineDocCache()
+        for path in ['a/lib.c', 'b/lib.c']:
+            self._index(path, cache)
+            file_doc = json.loads(self.ops[-1].splitlines()[1])
+            eq_(unpack_rendered_lines(file_doc['rendered']),
+                [(u'int x;\n', u'<span class="k">int</span> x;\n', []),
+                 (u'int y;\n', u'int y;\n', [])])
+
+
+class CheckpointTests(TestCase):
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.tree = FakeTree(self.folder)
+        makedirs(self.tree.temp_folder)
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def test_none(self):
+        eq_(Checkpoint.load(self.tree), None)
+
+    def test_round_trip(self):
+        """Everything recorded should survive to the next process."""
+        checkpoint = Checkpoint(self.tree, index='dxr_hot_prod')
+        checkpoint.save()
+        checkpoint.finish('pre_build', [{'some': 'state'}])
+        checkpoint.finish('build')
+        checkpoint.add_paths(['a.c', 'b/c.c'])
+        checkpoint.add_paths(['d.c'])
+
+        loaded = Checkpoint.load(self.tree)
+        eq_(loaded.index, 'dxr_hot_prod')
+        ok_(loaded.done('build'))
+        ok_(not loaded.done('post_build'))
+        eq_(loaded.done_paths, set(['a.c', 'b/c.c', 'd.c']))
+        eq_(loaded.tree_indexers(), [{'some': 'state'}])
+
+    def test_no_indexers_yet(self):
+        checkpoint = Checkpoint(self.tree, index='dxr_hot_prod')
+        checkpoint.save()
+        eq_(checkpoint.tree_indexers(), None)
+
+    def test_remove_paths(self):
+        """Removed paths should stay removed in the next process."""
+        checkpoint = Checkpoint(self.tree, index='dxr_hot_prod')
+        checkpoint.save()
+        checkpoint.add_paths(['a.c', 'b.c'])
+        checkpoint.remove_paths(['a.c'])
+        checkpoint.add_paths(['d.c'])
+        eq_(Checkpoint.load(self.tree).done_paths, set(['b.c', 'd.c']))
+
+    def test_worker_paths(self):
+        """Paths recorded by workers should count as done, and removing
+        paths should reach into their records too."""
+        checkpoint = Checkpoint(self.tree, index='dxr_hot_prod')
+        checkpoint.save()
+        checkpoint.add_paths(['a.c'])
+        with open(join(self.tree.temp_folder,
+                       WORKER_PATHS_FILE % ('host', 123)), 'w') as file:
+            file.write('"b.c"\n"c.c"\n')
+        loaded = Checkpoint.load(self.tree)
+        eq_(loaded.done_paths, set(['a.c', 'b.c', 'c.c']))
+        loaded.remove_paths(['b.c'])
+        eq_(Checkpoint.load(self.tree).done_paths, set(['a.c', 'c.c']))
+        loaded.delete()
+        eq_(listdir(self.tree.temp_folder), [])
+
+    def test_null(self):
+        """A NullCheckpoint should keep track without touching the disk."""
+        checkpoint = NullCheckpoint(self.tree, index='dxr_hot_prod')
+        checkpoint.save()
+        checkpoint.finish('pre_build', ['indexer'])
+        checkpoint.add_paths(['a.c', 'b.c'])
+        checkpoint.remove_paths(['b.c'])
+        eq_(checkpoint.stages, ['pre_build'])
+        eq_(checkpoint.done_paths, set(['a.c']))
+        eq_(listdir(self.tree.temp_folder), [])
+        eq_(Checkpoint.load(self.tree), None)
+
+    def test_delete(self):
+        checkpoint = Checkpoint(self.tree)
+        checkpoint.finish('pre_build', [])
+        checkpoint.add_paths(['a.c'])
+        checkpoint.delete()
+        eq_(Checkpoint.load(self.tree), None)
+        eq_(listdir(self.tree.temp_folder), [])
+
+
+class BuildIndependentTests(TestCase):
+    def test_paths(self):
+        """Only files no plugin needs the build for should be picked."""
+        tree_indexers = [ClangTreeToIndex('clang', None, None),
+                         PythonTreeToIndex('python', None, None)]
+        eq_(build_independent_paths(['main.cpp', 'lib/util.h', 'setup.py',
+                                     'README.md', 'docs/index.rst'],
+                                    tree_indexers),
+            ['README.md', 'docs/index.rst'])
+
+    def test_clang_conservative(self):
+        """Clang should hold back C-family files whatever the case of their
+        extensions, and extensionless ones, which might be headers."""
+        tree_indexer = ClangTreeToIndex('clang', None, None)
+        for path in ['Main.CPP', 'lib/Util.HPP', 'kernel.cu', 'start.S',
+                     'include/vector']:
+            ok_(tree_indexer.depends_on_build(path), path)
+        ok_(not tree_indexer.depends_on_build('README.md'))
+
+    def test_before_post_build(self):
+        """Plugins should be able to handle build-independent files before
+        post_build() has run."""
+        for tree_indexer in [ClangTreeToIndex('clang', None, None),
+                             PythonTreeToIndex('python', None, None)]:
+            ok_(tree_indexer.file_to_index('README', u'hi') is FILE_TO_IGNORE)
+
+    def test_after_post_build(self):
+        """Once post_build() has run, clang should analyze files of any
+        extension, like extensionless C++ headers."""
+        folder = mkdtemp()
+        try:
+            tree = FakeTree(folder)
+            tree_indexer = ClangTreeToIndex('clang', tree, None)
+            tree_indexer.pre_build()
+            makedirs(tree_indexer._temp_folder)
+            tree_indexer.post_build()
+            ok_(tree_indexer.file_to_index('include/vector', u'hi') is not
+                FILE_TO_IGNORE)
+        finally:
+            rmtree(folder)
+
+
+class ChunkQueueTests(TestCase):
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.queue = ChunkQueue.create(join(self.folder, 'queue'))
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def test_round_trip(self):
+        """Chunks should be claimed in order, each only once, and their
+        results come back."""
+        self.queue.put(2, ['b.c'])
+        self.queue.put(1, ['a.c'])
+        # A worker elsewhere looks at the same folder:
+        other = ChunkQueue(self.queue.folder)
+        first_name, first = other.claim()
+        second_name, second = self.queue.claim()
+        eq_((first, second), (['a.c'], ['b.c']))
+        eq_(self.queue.claim(), None)
+
+        other.finish(first_name, 'result 1')
+        eq_(self.queue.results(), [(first_name, 'result 1')])
+        eq_(self.queue.results(), [])
+        ok_(not other.closed)
+        self.queue.close()
+        ok_(other.closed)
+
+    def test_missing(self):
+        """A worker started before the queue exists should find nothing to
+        claim."""
+        eq_(ChunkQueue(join(self.folder, 'nope')).claim(), None)
+
+    def test_requeue(self):
+        """A requeued chunk should be claimable again, and a late result
+        from its first worker shouldn't trip anything up."""
+        self.queue.put(1, ['a.c'])
+        name, _ = self.queue.claim()
+        eq_(self.queue.claims().keys(), [name])
+        self.queue.requeue(name)
+        eq_(self.queue.claims(), {})
+        eq_(self.queue.claim(), (name, ['a.c']))
+        self.queue.finish(name, 'result 1')
+        self.queue.finish(name, 'result 2')
+        eq_(self.queue.results(), [(name, 'result 2')])
+
+    def test_dead_worker(self):
+        """A chunk whose worker stops vouching for it should go back in the
+        queue for another."""
+        tree = FakeTree(self.folder)
+        makedirs(tree.temp_folder)
+
+        def claim(queue):
+            while True:
+                claimed = queue.claim()
+                if claimed:
+                    return claimed
+                sleep(0.01)
+
+        def workers():
+            queue = ChunkQueue(join(tree.temp_folder, QUEUE_FOLDER))
+            claim(queue)  # ...and die.
+            name, _ = claim(queue)
+            queue.finish(name, 'result')
+
+        with ThreadPoolExecutor(max_workers=1) as thread:
+            thread.submit(workers)
+            eq_(list(distributed_results(tree, None, [['a.c']], 'index',
+                                         None, 0, poll_interval=0.01,
+                                         claim_timeout=0.1)),
+                ['result'])
+
+    def test_dead_worker_after_local_ones(self):
+        """A chunk requeued after our own workers have run out of chunks and
+        quit should get a new one of ours to index it."""
+        tree = FakeTree(self.folder)
+        makedirs(tree.temp_folder)
+
+        def remote_worker():
+            """Claim the chunk, and die."""
+            queue = ChunkQueue(join(tree.temp_folder, QUEUE_FOLDER))
+            while not queue.claim():
+                sleep(0.01)
+
+        results = []
+
+        def master():
+            results.extend(distributed_results(tree, None, [['a.c']],
+                                               'index', pool, 1,
+                                               poll_interval=0.01,
+                                               claim_timeout=0.1))
+
+        with ThreadPoolExecutor(max_workers=2) as threads:
+            threads.submit(remote_worker)
+            pool = QueuePool(threads)
+            # A daemon, so a master waiting forever can't hang the tests:
+            thread = Thread(target=master)
+            thread.daemon = True
+            thread.start()
+            thread.join(10)
+        eq_(results, ['result'])
+        eq_(pool.submits, 2)
+
+
+class QueuePool(object):
+    """A stand-in for the pool :func:`distributed_results()` runs
+    :func:`work_on_queue()` in
+
+    The first worker submitted has already quit, having found the queue
+    empty. Later ones index whatever they can claim, like the real thing.
+
+    """
+    def __init__(self, threads):
+        self.threads = threads
+        self.submits = 0
+
+    def submit(self, *args):
+        self.submits += 1
+        if self.submits == 1:
+            future = Future()
+            future.set_result(None)
+            return future
+        return self.threads.submit(self._work, args[-1])
+
+    @staticmethod
+    def _work(folder):
+        queue = ChunkQueue(folder)
+        claimed = queue.claim()
+        if claimed:
+            queue.finish(claimed[0], 'result')
+
+
+class WorkerBudgetTests(TestCase):
+    def test_partial(self):
+        """Stages should take what's left, and none should be left holding
+        workers when done."""
+        budget = WorkerBudget(4)
+        with budget.workers(3) as first:
+            with budget.workers(3) as second:
+                eq_((first, second), (3, 1))
+        eq_(budget.free, 4)
+
+    def test_serial(self):
+        """Asking for no workers should never block."""
+        budget = WorkerBudget(1)
+        with budget.workers(1):
+            with budget.workers(0) as workers:
+                eq_(workers, 0)
+
+    def test_wait(self):
+        """When the budget is spent, a stage should wait for another to
+        finish."""
+        budget = WorkerBudget(2)
+        with ThreadPoolExecutor(max_workers=1) as thread:
+            with budget.workers(2):
+                waiter = thread.submit(lambda: budget.workers(2).__enter__())
+                ok_(not waiter.done())
+            eq_(waiter.result(timeout=5), 2)
+
+    def test_minimum(self):
+        """A stage should wait for its minimum rather than take less, unless
+        it wants less."""
+        budget = WorkerBudget(4, minimum=2)
+        with ThreadPoolExecutor(max_workers=1) as thread:
+            with budget.workers(3):
+                with budget.workers(1) as workers:
+                    eq_(workers, 1)
+                waiter = thread.submit(lambda: budget.workers(4).__enter__())
+                sleep(0.1)
+                ok_(not waiter.done())
+            eq_(waiter.result(timeout=5), 4)
+
+    def test_trees_interleave(self):
+        """While one tree's build holds workers, another tree should still
+        get its share."""
+        budget = WorkerBudget.for_trees(4, 2)
+        with ThreadPoolExecutor(max_workers=1) as thread:
+            with budget.workers(4) as building:
+                other = thread.submit(lambda: budget.workers(4).__enter__())
+                eq_(other.result(timeout=5), 2)
+            eq_(building, 2)
+
+    def test_processes(self):
+        """The budget should be shared with forked processes."""
+        budget = WorkerBudget(2)
+
+        def take():
+            """Take a worker, and exit without giving it back."""
+            workers = budget.workers(1)
+            workers.__enter__()
+            os._exit(0)
+
+        process = Process(target=take)
+        process.start()
+        process.join()
+        eq_(budget.free, 1)
+
+
+class FakeHealthElasticSearch(object):
+    """An ES whose cluster health calls return or raise canned responses"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def health(self, **kwargs):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class WaitForReplicasTests(TestCase):
+    def test_timeout_keeps_waiting(self):
+        """A wait that times out with a 408 should be retried, not fatal."""
+        yellow = {'status': 'yellow', 'number_of_data_nodes': 2}
+        es = FakeHealthElasticSearch(ElasticHttpError(408, 'timed out'),
+                                     yellow,
+                                     {'status': 'green'})
+        wait_for_replicas(es, 'index', 1)
+        eq_(es.calls, 3)
+
+    def test_too_few_nodes(self):
+        """If there aren't enough data nodes to hold the replicas, don't wait
+        for them."""
+        es = FakeHealthElasticSearch(
+            ElasticHttpError(408, 'timed out'),
+            {'status': 'yellow', 'number_of_data_nodes': 2})
+        wait_for_replicas(es, 'index', 2)
+        eq_(es.calls, 2)
+
+    def test_other_errors(self):
+        es = FakeHealthElasticSearch(ElasticHttpError(500, 'oops'))
+        self.assertRaises(ElasticHttpError, wait_for_replicas, es, 'index', 1)
+
+
+class ScrollingElasticSearch(ElasticSearch):
+    """An ES whose every search finds a canned set of hits and whose bulk
+    requests are recorded"""
+
+    def __init__(self, hits):
+        super(ScrollingElasticSearch, self).__init__('http://127.0.0.1:9200/')
+        self.hits = hits
+        self.bulk_bodies = []
+
+    def refresh(self, index=None):
+        pass
+
+    def send_request(self, method, path_components, body='',
+                     query_params=None):
+        if path_components[-1] == '_bulk':
+            self.bulk_bodies.append(body)
+            return {'errors': False, 'items': []}
+        if path_components == ['_search', 'scroll']:
+            hits, self.hits = self.hits, []
+            return {'_scroll_id': '1', 'hits': {'hits': hits}}
+        eq_(query_params['search_type'], 'scan')
+        return {'_scroll_id': '0'}
+
+
+def test_delete_docs():
+    """Docs should be deleted by ID, not by query."""
+    es = ScrollingElasticSearch([{'_type': 'file', '_id': 'a.c'},
+                                 {'_type': 'line', '_id': 'a.c:1'}])
+    delete_docs(es, 'dxr_hot_prod', ['a.c'])
+    eq_([json.loads(line) for line in
+         ''.join(es.bulk_bodies).splitlines()],
+        [{'delete': {'_type': 'file', '_id': 'a.c'}},
+         {'delete': {'_type': 'line', '_id': 'a.c:1'}}])
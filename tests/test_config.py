@@ -187,3 +187,81 @@ def test_unknown_plugin():
     else:
         self.fail("An unknown plugin name passed to enabled_plugins didn't "
                   "raise ConfigError")
+
+
+def test_warmup_queries():
+    """Make sure warmup_queries splits on lines, not spaces, and skips blank
+    ones."""
+    config = Config('''
+        [DXR]
+        enabled_plugins =
+
+        [some_tree]
+        source_folder = /some/path
+        warmup_queries = """main
+
+            path:a b.c
+            id:main"""
+
+        [another_tree]
+        source_folder = /some/path
+        ''')
+    eq_(config.trees['some_tree'].warmup_queries,
+        ['main', 'path:a b.c', 'id:main'])
+    eq_(config.trees['another_tree'].warmup_queries, [])
+    eq_(config.es_optimize_segments, 0)
+
+
+def test_indexing_fingerprint():
+    """The fingerprint should change with prerendering and plugin config, but
+    not with settings that don't affect the docs."""
+    config = Config('''
+        [DXR]
+        enabled_plugins = buglink
+
+        [plain]
+        source_folder = /some/path
+            [[buglink]]
+            url = http://example.com/%s
+
+        [described]
+        source_folder = /some/path
+        description = Same docs, different words
+            [[buglink]]
+            url = http://example.com/%s
+
+        [prerendered]
+        source_folder = /some/path
+        prerender = true
+            [[buglink]]
+            url = http://example.com/%s
+
+        [other_bugs]
+        source_folder = /some/path
+            [[buglink]]
+            url = http://example.com/%s
+            regex = issue ([0-9]+)
+        ''')
+    fingerprints = dict((name, tree.indexing_fingerprint) for name, tree in
+                        config.trees.iteritems())
+    eq_(fingerprints['plain'], fingerprints['described'])
+    ok_(fingerprints['plain'] != fingerprints['prerendered'])
+    ok_(fingerprints['plain'] != fingerprints['other_bugs'])
+
+
+def test_overridden():
+    """Overriding settings should make a new config and trees, leaving the
+    old ones alone."""
+    config = Config("""
+        [DXR]
+        es_hosts = http://real:9200/
+
+        [code]
+        source_folder = /some/path
+        """)
+    sink = config.overridden(es_hosts=['http://sink:9200/'])
+    eq_(sink.es_hosts, ['http://sink:9200/'])
+    eq_(sink.trees['code'].config.es_hosts, ['http://sink:9200/'])
+    eq_(sink.trees['code'].source_folder, '/some/path')
+    eq_(config.es_hosts, ['http://real:9200/'])
+    ok_(config.trees['code'].config is config)
@@ -0,0 +1,224 @@
+"""Tests for the elasticsearch utilities that don't need a live cluster"""
+
+from unittest import TestCase
+
+from flask import Flask
+from nose.tools import eq_, assert_raises
+from pyelasticsearch import BulkError, ElasticHttpError, Timeout
+from werkzeug.exceptions import NotFound
+
+from dxr.es import (BulkSender, CatalogCache, SearchCache, frozen_config,
+                    frozen_configs, multi_search)
+
+
+class FakeElasticSearch(object):
+    """An ES stand-in which replays canned bulk responses and records what it
+    was sent"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.bodies = []
+
+    def send_request(self, method, path_components, body='',
+                     query_params=None):
+        self.bodies.append(body)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def item(status):
+    return {'index': {'status': status}}
+
+
+class BulkSenderTests(TestCase):
+    def test_retry_rejected_only(self):
+        """When ES turns away some actions, only those should be resent."""
+        es = FakeElasticSearch({'errors': True, 'items': [item(201), item(429)]},
+                               {'errors': False, 'items': [item(201)]})
+        with BulkSender(es, 'index', backoff=0) as sender:
+            sender.send(['a', 'b'])
+        eq_(es.bodies, ['a\nb\n', 'b\n'])
+
+    def test_retry_timeout(self):
+        es = FakeElasticSearch(Timeout(), {'errors': False})
+        with BulkSender(es, 'index', backoff=0) as sender:
+            sender.send(['a'])
+        eq_(es.bodies, ['a\n', 'a\n'])
+
+    def test_give_up(self):
+        """After running out of retries, the error should surface in the
+        caller's thread."""
+        es = FakeElasticSearch(Timeout(), Timeout())
+        def send():
+            with BulkSender(es, 'index', retries=1, backoff=0) as sender:
+                sender.send(['a'])
+        assert_raises(Timeout, send)
+
+    def test_other_errors(self):
+        """Errors other than rejections shouldn't be retried."""
+        es = FakeElasticSearch({'errors': True, 'items': [item(400)]})
+        def send():
+            with BulkSender(es, 'index', backoff=0) as sender:
+                sender.send(['a'])
+        assert_raises(BulkError, send)
+        eq_(len(es.bodies), 1)
+
+    def test_buffering(self):
+        """Added actions should go out once they fill the buffer, and the
+        rest when the block ends."""
+        es = FakeElasticSearch({'errors': False}, {'errors': False})
+        with BulkSender(es, 'index', min_size=3) as sender:
+            for action in ['ab', 'c', 'd']:
+                sender.add(action)
+                if sender.full:
+                    sender.flush()
+        eq_(es.bodies, ['ab\nc\n', 'd\n'])
+
+    def test_marks(self):
+        """Marks should come back once everything added before them has been
+        sent."""
+        es = FakeElasticSearch({'errors': False})
+        with BulkSender(es, 'index') as sender:
+            sender.add('a')
+            sender.mark('file a')
+            sender.add('b')
+            sender.mark('file b')
+            sender.mark('empty file')
+        eq_(sender.sent(), ['file a', 'file b', 'empty file'])
+        eq_(sender.sent(), [])
+
+    def test_marks_failure(self):
+        """Marks after actions that failed to send shouldn't come back."""
+        es = FakeElasticSearch(Timeout())
+        sender = BulkSender(es, 'index', retries=0)
+        def send():
+            with sender:
+                sender.add('a')
+                sender.mark('file a')
+        assert_raises(Timeout, send)
+        eq_(sender.sent(), [])
+
+    def test_adaptive_size(self):
+        """Quick requests should grow the batches, up to the max, and slow or
+        retried ones should shrink them, down to the min."""
+        with BulkSender(FakeElasticSearch(), 'index', min_size=4, max_size=8,
+                        target_latency=10) as sender:
+            for latency, retried, size in [(1, False, 6),
+                                           (1, False, 8),
+                                           (1, False, 8),
+                                           (7, False, 8),
+                                           (20, False, 4),
+                                           (1, True, 4)]:
+                sender._adapt(latency, retried)
+                eq_(sender.target_size, size)
+
+
+class FakeConfig(object):
+    es_catalog_index = 'dxr_catalog'
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        class CatalogElasticSearch(object):
+            def search(self, query, index, doc_type, size):
+                searches.append(index)
+                return {'hits': {'hits': [{'_source': doc} for doc in docs]}}
+
+        searches = self.searches = []
+        docs = self.docs = [{'name': 'mozilla-central'}]
+        self.app = Flask('dxr')
+        self.app.dxr_config = FakeConfig()
+        self.app.es = CatalogElasticSearch()
+        self.app.catalog = CatalogCache(ttl=60)
+
+    def test_cached(self):
+        """Looking up trees over and over should fetch the catalog once."""
+        with self.app.app_context():
+            eq_(frozen_config('mozilla-central'), {'name': 'mozilla-central'})
+            eq_(frozen_configs(), [{'name': 'mozilla-central'}])
+            frozen_config('mozilla-central')
+        eq_(self.searches, ['dxr_catalog'])
+
+    def test_new_tree(self):
+        """A tree missing from the cached catalog should be looked for
+        right away, in case it has just been deployed."""
+        with self.app.app_context():
+            frozen_configs()
+            self.docs.append({'name': 'comm-central'})
+            eq_(frozen_config('comm-central'), {'name': 'comm-central'})
+            assert_raises(NotFound, frozen_config, 'nonexistent')
+        eq_(len(self.searches), 3)
+
+
+class SearchCacheTests(TestCase):
+    def setUp(self):
+        class SearchingElasticSearch(object):
+            def search(self, query, index, doc_type):
+                searches.append((query, index, doc_type))
+                return {'hits': {'hits': [], 'total': len(searches)}}
+
+        searches = self.searches = []
+        self.es = SearchingElasticSearch()
+
+    def test_hits(self):
+        """Repeated searches of the same index should be answered from the
+        cache, but different ones shouldn't."""
+        cache = SearchCache(max_size=1000)
+        search = cache.searcher(self.es, 'dxr_alias', 'dxr_index_1')
+        first = search({'size': 2}, doc_type='line')
+        eq_(search({'size': 2}, doc_type='line'), first)
+        search({'size': 2}, doc_type='file')
+        search({'size': 3}, doc_type='line')
+        eq_(self.searches, [({'size': 2}, 'dxr_alias', 'line'),
+                            ({'size': 2}, 'dxr_alias', 'file'),
+                            ({'size': 3}, 'dxr_alias', 'line')])
+
+        # A new build of the tree shouldn't see the old build's results:
+        search = cache.searcher(self.es, 'dxr_alias', 'dxr_index_2')
+        search({'size': 2}, doc_type='line')
+        eq_(len(self.searches), 4)
+
+    def test_eviction(self):
+        """The least recently used responses should go first to make room."""
+        cache = SearchCache(max_size=10)
+        cache.put('a', 'a response', 4)
+        cache.put('b', 'b response', 4)
+        cache.get('a')
+        cache.put('c', 'c response', 4)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('a'), 'a response')
+        eq_(cache.size, 8)
+
+    def test_multi_search(self):
+        """Only the searches missing from the cache should be sent, and all in
+        one request."""
+        es = FakeElasticSearch({'responses': [{'hits': 'b'}]})
+        cache = SearchCache(max_size=1000)
+        cache.searcher(self.es, 'dxr_alias', 'dxr_index_1')({'q': 'a'},
+                                                            doc_type='line')
+        eq_(cache.multi_searcher(es, 'dxr_alias', 'dxr_index_1')(
+                [({'q': 'a'}, 'line'), ({'q': 'b'}, 'line')]),
+            [{'hits': {'hits': [], 'total': 1}}, {'hits': 'b'}])
+        eq_(es.bodies, ['{"type": "line"}\n{"q": "b"}\n'])
+
+    def test_unknown_index(self):
+        """Without the concrete index to go by, nothing should be cached."""
+        search = SearchCache(max_size=1000).searcher(self.es, 'dxr_alias')
+        search({}, doc_type='line')
+        search({}, doc_type='line')
+        eq_(len(self.searches), 2)
+
+
+def test_multi_search():
+    """Searches should go out in one request, and a failure of any should
+    raise."""
+    es = FakeElasticSearch({'responses': [{'hits': 1}, {'hits': 2}]},
+                           {'responses': [{'hits': 1}, {'error': 'Boom'}]})
+    searches = [({'size': 1}, 'line'), ({'size': 2}, 'file')]
+    eq_(multi_search(es, 'dxr_alias', searches), [{'hits': 1}, {'hits': 2}])
+    eq_(es.bodies[0],
+        '{"type": "line"}\n{"size": 1}\n{"type": "file"}\n{"size": 2}\n')
+    assert_raises(ElasticHttpError, multi_search, es, 'dxr_alias', searches)
+    eq_(multi_search(es, 'dxr_alias', []), [])
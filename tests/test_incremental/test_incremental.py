@@ -0,0 +1,46 @@
+"""Tests for incremental indexing, which copies unchanged files' docs from
+the deployed index"""
+
+from os import remove
+from os.path import dirname, join
+
+from dxr.testing import DxrInstanceTestCase
+from dxr.utils import run
+
+
+class IncrementalTests(DxrInstanceTestCase):
+    """Index a tree, change one file, and index it again incrementally."""
+
+    @classmethod
+    def _write(cls, contents):
+        with open(join(cls._config_dir_path, 'code', 'changing.txt'),
+                  'w') as file:
+            file.write(contents)
+
+    @classmethod
+    def setup_class(cls):
+        cls._config_dir_path = dirname(__file__)
+        cls._write('Before the change: bygone.\n')
+        super(IncrementalTests, cls).setup_class()
+        # A different size, so it's sure to look changed:
+        cls._write('After the change, which was welcome: novel.\n')
+        run('dxr index --incremental')
+        cls._es().refresh()
+
+    @classmethod
+    def teardown_class(cls):
+        super(IncrementalTests, cls).teardown_class()
+        remove(join(cls._config_dir_path, 'code', 'changing.txt'))
+
+    def test_unchanged_copied(self):
+        """An unchanged file's lines should be copied over exactly once."""
+        self.found_line_eq('steadfast',
+                           'This file stays put: <b>steadfast</b>.',
+                           1)
+
+    def test_changed_reindexed(self):
+        """A changed file should be indexed afresh, its old lines gone."""
+        self.found_line_eq(
+            'novel', 'After the change, which was welcome: <b>novel</b>.', 1)
+        self.found_nothing('bygone')
+
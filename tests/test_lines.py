@@ -12,7 +12,8 @@ from dxr.lines import Ref
 from dxr.lines import (line_boundaries, remove_overlapping_refs, Region, LINE,
                        Ref, balanced_tags, finished_tags, tag_boundaries,
                        html_line, nesting_order, balanced_tags_with_empties,
-                       es_lines, tags_per_line)
+                       es_lines, tags_per_line, pack_rendered_lines,
+                       unpack_rendered_lines)
 from dxr.utils import cumulative_sum
 
 
@@ -309,3 +310,13 @@ class IntegrationTests(TestCase):
         """
         text_to_html_lines('hello!',
                            regions=[(3, 3, Region('a')), (3, 5, Region('b'))])
+
+
+def test_rendered_lines_round_trip():
+    """Prerendered lines should come back as they went in, HTML as Markup so
+    it isn't escaped again."""
+    lines = [(u'int x;\n', u'<span class="k">int</span> x;\n', []),
+             (u'\u2603', u'\u2603', [{'title': 'snowman'}])]
+    unpacked = unpack_rendered_lines(pack_rendered_lines(lines))
+    eq_(unpacked, lines)
+    eq_(type(unpacked[0][1]), type(html_line(u'', [], 0)))
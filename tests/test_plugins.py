@@ -1,8 +1,9 @@
 """Tests for the plugin architecture itself"""
 
-from nose.tools import ok_
+from nose.tools import eq_, ok_
 
-from dxr.plugins import all_plugins
+from dxr.indexers import FileToIndex
+from dxr.plugins import AdHocTreeToIndex, all_plugins, Plugin
 import dxr.plugins.urllink as urllink
 
 
@@ -19,3 +20,15 @@ def test_construction():
     mocked_vcs = None
     ok_(isinstance(plugin.tree_to_index('urllink', mocked_tree, mocked_vcs).file_to_index('/foo/bar', ''),
                    urllink.FileToIndex))
+
+
+def test_ad_hoc_depends_on_build():
+    """An ad hoc TreeToIndex should need the build only if its FileToIndex
+    doesn't say otherwise."""
+    plugin = Plugin.from_namespace(urllink.__dict__)
+    eq_(plugin.tree_to_index('urllink', None, None).depends_on_build('foo.c'),
+        False)
+    eq_(AdHocTreeToIndex('unsure', None, None,
+                         file_to_index_class=FileToIndex)
+        .depends_on_build('foo.c'),
+        True)
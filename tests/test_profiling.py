@@ -0,0 +1,116 @@
+"""Tests for the indexing profiler"""
+
+from cPickle import dumps, loads
+from time import sleep
+from unittest import TestCase
+
+from nose.tools import eq_, ok_
+from pyelasticsearch import ElasticSearch
+
+from dxr.es import BulkSender, create_index_and_wait
+from dxr.profiling import Profile, NullProfile, NullElasticSearch
+
+
+class ProfileTests(TestCase):
+    def test_call(self):
+        """Calls should be counted and their return values passed through."""
+        profile = Profile()
+        eq_(profile.call('clang', 'refs', lambda x: x * 2, 3), 6)
+        eq_(profile.call('clang', 'refs', lambda: 'hi'), 'hi')
+        eq_(profile.stages[('clang', 'refs')][2], 2)
+
+    def test_iterate(self):
+        """Each step of iteration should be charged to the stage, and the
+        items passed through."""
+        profile = Profile()
+        eq_(list(profile.iterate('python', 'needles', lambda: iter('abc'))),
+            ['a', 'b', 'c'])
+        # The call, 3 items, and the StopIteration:
+        eq_(profile.stages[('python', 'needles')][2], 5)
+
+    def test_exclusive(self):
+        """Time spent in a nested stage shouldn't be charged to the outer one.
+        """
+        profile = Profile()
+        profile.call('dxr', 'outer',
+                     profile.call, 'slow', 'inner', sleep, 0.1)
+        ok_(profile.stages[('slow', 'inner')][0] >= 0.1)
+        ok_(profile.stages[('dxr', 'outer')][0] < 0.1)
+        eq_(profile._nested, [])
+
+    def test_exceptions(self):
+        """A raising stage should still be timed, and not leave the nesting
+        stack unbalanced."""
+        profile = Profile()
+
+        def explode():
+            raise ValueError
+
+        self.assertRaises(ValueError, profile.call, 'dxr', 'boom', explode)
+        eq_(profile.stages[('dxr', 'boom')][2], 1)
+        eq_(profile._nested, [])
+
+    def test_merge_and_pickle(self):
+        """Workers' profiles should survive pickling and add up."""
+        one, two = Profile(), Profile()
+        one.add('clang', 'refs', 1, 0.5)
+        one.add_file('a.c', 1)
+        two.add('clang', 'refs', 2, 1, calls=3)
+        two.add_file('a.c', 2)
+        two.add_file('b.c', 0.5)
+        merged = Profile().merge(one).merge(loads(dumps(two)))
+        eq_(merged.stages, {('clang', 'refs'): [3, 1.5, 4]})
+        eq_(merged.slowest_files(1), [('a.c', 3)])
+
+    def test_report(self):
+        profile = Profile()
+        profile.add('clang', 'refs', 1, 0.5)
+        profile.add('python', 'needles', 2, 1)
+        profile.add_file('slow.c', 7)
+        report = profile.report()
+        ok_(report.index('needles') < report.index('refs'))
+        ok_('slow.c' in report)
+        eq_(profile.as_json()['slowest_files'], [{'path': 'slow.c', 'wall': 7}])
+
+
+def test_null_profile():
+    """NullProfile should pass calls and iteration straight through."""
+    profile = NullProfile()
+    eq_(profile.call('dxr', 'x', lambda y: y + 1, 1), 2)
+    eq_(list(profile.iterate('dxr', 'x', lambda: [1, 2])), [1, 2])
+
+
+def test_null_elasticsearch():
+    """The stand-in should get through index creation and bulk indexing,
+    counting docs by kind."""
+    with NullElasticSearch() as sink:
+        es = ElasticSearch(sink.url)
+        create_index_and_wait(es, 'dxr_hot_prod')
+        with BulkSender(es, 'dxr_hot_prod', doc_type='line') as sender:
+            sender.send([es.index_op({'number': 1}),
+                         es.index_op({'number': 2}),
+                         es.index_op({'path': 'a.c', 'is_folder': False},
+                                     doc_type='file')])
+            sender.send([es.index_op({'path': 'lib', 'is_folder': True},
+                                     doc_type='file')])
+        es.refresh('dxr_hot_prod')
+    eq_(sink.requests, 2)
+    eq_(dict((kind, docs) for kind, (docs, bytes) in sink.counts.iteritems()),
+        {'line': 2, 'file': 1, 'folder': 1})
+    ok_('total' in sink.report())
+
+
+def test_null_elasticsearch_folders():
+    """Folders should be told from files by their docs, not their
+    formatting."""
+    sink = NullElasticSearch()
+    try:
+        sink.count_bulk('file', '\n'.join([
+            '{"index": {}}',
+            '{"path": ["lib"],"is_folder":true}',
+            '{"index": {}}',
+            '{"path": ["notes.txt"], "content": "\\"is_folder\\": true"}']))
+    finally:
+        sink.server_close()
+    eq_(dict((kind, docs) for kind, (docs, bytes) in sink.counts.iteritems()),
+        {'file': 1, 'folder': 1})
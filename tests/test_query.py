@@ -8,7 +8,8 @@ from unittest import TestCase
 
 from nose.tools import eq_
 
-from dxr.query import fix_extents_overlap
+from dxr.plugins import core_plugin
+from dxr.query import fix_extents_overlap, Query
 
 
 class FixExtentsOverlapTests(TestCase):
@@ -49,3 +50,42 @@ class FixExtentsOverlapTests(TestCase):
         """Work even if the highlighting starts at offset 0."""
         eq_(list(fix_extents_overlap([(0, 3), (2, 5), (11, 14)])),
             [(0, 5), (11, 14)])
+
+
+class DirectResultTests(TestCase):
+    """Tests for the batching of direct searches"""
+
+    def setUp(self):
+        def multi_search(searches):
+            batches.append(searches)
+            return [responses.get(doc_type, {'hits': {'hits': [], 'total': 0}})
+                    for query, doc_type in searches]
+
+        batches = self.batches = []
+        responses = self.responses = {}
+        self.query = Query(None, 'main.c:3', [core_plugin()],
+                           es_multi_search=multi_search)
+
+    def test_one_round_trip(self):
+        """All applicable direct searchers should be tried at once, and the
+        highest-priority one finding a single thing should win."""
+        self.responses['file'] = {
+            'hits': {'hits': [{'_source': {'path': ['main.c']}}], 'total': 1}}
+        eq_(self.query.direct_result(), ('main.c', None))
+        eq_(len(self.batches), 1)
+        eq_([doc_type for _, doc_type in self.batches[0]], ['line', 'file'])
+
+    def test_no_rendered_lines(self):
+        """Direct FILE searches shouldn't haul prerendered lines out of ES."""
+        self.query.direct_result()
+        eq_([query.get('_source') for query, _ in self.batches[0]],
+            [None, {'exclude': ['rendered']}])
+
+    def test_with_results(self):
+        """The normal search should go out along with the direct ones."""
+        direct, results = self.query.direct_result_and_results(limit=5)
+        eq_(direct, None)
+        eq_(results['result_count'], 0)
+        eq_(len(self.batches), 1)
+        eq_(len(self.batches[0]), 3)
+        eq_(self.batches[0][-1][0]['size'], 5)
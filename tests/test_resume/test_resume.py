@@ -0,0 +1,52 @@
+"""Tests for resuming an indexing run which failed partway through"""
+
+from os import mkdir, remove, symlink
+from os.path import dirname, join
+from shutil import rmtree
+
+from nose.tools import assert_raises, eq_
+
+from dxr.testing import DxrInstanceTestCase
+from dxr.exceptions import CommandFailure
+from dxr.utils import run
+
+
+FILE_COUNT = 30
+
+
+class ResumeTests(DxrInstanceTestCase):
+    """Index a tree with a file that can't be read, fix the file, and resume.
+
+    """
+    @classmethod
+    def setup_class(cls):
+        cls._config_dir_path = dirname(__file__)
+        code = join(cls._config_dir_path, 'code')
+        mkdir(code)
+        for number in xrange(FILE_COUNT):
+            with open(join(code, 'file%02d.txt' % number), 'w') as file:
+                file.write('needle %s\nhaystack\n' % number)
+        # A link to itself raises ELOOP when read, failing its chunk:
+        loop = join(code, 'loop.txt')
+        symlink(loop, loop)
+        assert_raises(CommandFailure, super(ResumeTests, cls).setup_class)
+        remove(loop)
+        with open(loop, 'w') as file:
+            file.write('needle loop\n')
+        run('dxr index --resume')
+        cls._es().refresh()
+
+    @classmethod
+    def teardown_class(cls):
+        super(ResumeTests, cls).teardown_class()
+        rmtree(join(cls._config_dir_path, 'code'))
+
+    def test_lines_once(self):
+        """Every file's line should be found exactly once: neither lost by the
+        failed run nor duplicated by the resumed one."""
+        results = self.search_results('needle')
+        eq_(sorted(result['path'] for result in results),
+            sorted(['file%02d.txt' % n for n in xrange(FILE_COUNT)] +
+                   ['loop.txt']))
+        for result in results:
+            eq_([line['line_number'] for line in result['lines']], [1])
@@ -1,9 +1,10 @@
 from unittest import TestCase
 from datetime import datetime
+from itertools import islice
 
-from nose.tools import eq_, assert_raises
+from nose.tools import eq_, ok_, assert_raises
 
-from dxr.utils import deep_update, append_update, append_update_by_line, append_by_line, glob_to_regex, decode_es_datetime
+from dxr.utils import deep_update, append_update, append_update_by_line, append_by_line, lazy_update_by_line, lazy_extend_by_line, glob_to_regex, glob_matcher, decode_es_datetime
 
 
 class DeepUpdateTests(TestCase):
@@ -84,6 +85,20 @@ def test_append_by_line():
         [[5, 6], [6, 7, 9]])
 
 
+def test_lazy_update_by_line():
+    """Make sure per-line pairs are merged a line at a time and padded out
+    with empties once they run out."""
+    merged = lazy_update_by_line([iter([[('a', 1)], [('b', 2)]]),
+                                  iter([[('a', 3)]])])
+    eq_(list(islice(merged, 3)), [{'a': [1, 3]}, {'b': [2]}, {}])
+
+
+def test_lazy_extend_by_line():
+    merged = lazy_extend_by_line([iter([[5, 6], [7]]), iter([[8]])])
+    eq_(list(islice(merged, 3)), [[5, 6, 8], [7], []])
+    eq_(list(islice(lazy_extend_by_line([]), 2)), [[], []])
+
+
 def test_glob_to_regex():
     """Make sure glob_to_regex() strips the right static suffix off the end of
     the pattern fnmatch.translate() returns.
@@ -94,6 +109,19 @@ def test_glob_to_regex():
     eq_(glob_to_regex('hi'), 'hi')
 
 
+def test_glob_matcher():
+    """Make sure a compiled set of globs matches what fnmatchcase() would."""
+    matches = glob_matcher(['*.o', '/obj/*', 'CVS'])
+    ok_(matches('hello.o'))
+    ok_(matches('/obj/dir/thing.c'))
+    ok_(matches('CVS'))
+    ok_(matches('multi\nline.o'))
+    ok_(not matches('hello.oo'))
+    ok_(not matches('CVSROOT'))
+    ok_(not matches('/src/obj/thing.c'))
+    ok_(not glob_matcher([])('anything'))
+
+
 def test_decode_es_datetime():
     """Test that both ES datetime formats are decoded."""
     eq_(datetime(1992, 6, 27, 0, 0), decode_es_datetime("1992-06-27T00:00:00"))
@@ -0,0 +1,32 @@
+"""Tests for the WSGI entrypoint"""
+
+from os import utime
+from os.path import getmtime, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from nose.tools import ok_
+
+from dxr.wsgi import app_for
+
+
+class AppForTests(TestCase):
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.path = join(self.folder, 'dxr.config')
+        with open(self.path, 'w') as file:
+            file.write('[DXR]\nenabled_plugins =\n\n'
+                       '[code]\nsource_folder = %s\n' % self.folder)
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def test_reuse(self):
+        """The app should be made once and then reused until the config file
+        changes."""
+        app = app_for(self.path)
+        ok_(app_for(self.path) is app)
+        modified = getmtime(self.path) + 10
+        utime(self.path, (modified, modified))
+        ok_(app_for(self.path) is not app)